@@ -1,5 +1,8 @@
 
 # -*- coding: utf-8 -*-
+import time
+_SCRIPT_START = time.perf_counter()  # Start of this script run (for the startup timing report)
+
 import streamlit as st
 
 # --- This MUST be the first Streamlit command ---
@@ -10,107 +13,156 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
-# --- Azure AI SDK Imports ---
-from azure.ai.inference import ChatCompletionsClient
-from azure.ai.inference.models import (
-    SystemMessage,
-    UserMessage,
-    AssistantMessage,
-    ImageUrl,  # Correct class for image URLs
-    TextContentItem,    # <-- ADD THIS LINE
-    ImageContentItem,   # <-- ADD THIS LINE
-    ImageDetailLevel # <-- ADD this if you plan to use the 'detail' parameter later
-
-)
-from azure.core.credentials import AzureKeyCredential
-# --- FIX THIS LINE ---
-from azure.core.exceptions import HttpResponseError, ClientAuthenticationError # Add ClientAuthenticationError here
-
 import json
-import pandas as pd
+import sys
 import os
 import io
 import platform
 import glob
 import re
 import random
-import time
 import socket
 import base64
 import subprocess
+import shutil
+import contextlib
+import email.utils
+import http.server
+import functools
+import hashlib
+import tempfile
+import importlib
+import importlib.util
+import sqlite3
+import atexit
+import threading
+import asyncio
+import struct
+import statistics
+import urllib.parse
+import collections
+import queue
+import ipaddress
+import concurrent.futures
 import traceback  # For detailed error logging
 
+
+# --- Import Timing & Lazy Loading ---
+# Heavy optional libraries (cv2, speedtest, pyttsx3, SpeechRecognition, mss, Azure SDK,
+# quantum libs, pandas/numpy) are only imported when the subsystem using them is first touched.
+# Import cost is recorded process-wide so the sidebar can show a startup timing report.
+
+@st.cache_resource(show_spinner=False)
+def get_import_timings():
+    """Process-wide registry of module import costs: {module: {"subsystem", "mode", "ms", "error"}}."""
+    return {}
+
+
+def _timed_import(module_name, subsystem, mode="lazy"):
+    """Imports a module, recording its first import cost in the timing registry."""
+    timings = get_import_timings()
+    already_loaded = module_name in sys.modules
+    t0 = time.perf_counter()
+    try:
+        module = importlib.import_module(module_name)
+    except Exception as e:
+        if module_name not in timings:
+            timings[module_name] = {"subsystem": subsystem, "mode": mode, "ms": (time.perf_counter() - t0) * 1000, "error": type(e).__name__}
+        raise
+    if module_name not in timings and not already_loaded:
+        timings[module_name] = {"subsystem": subsystem, "mode": mode, "ms": (time.perf_counter() - t0) * 1000, "error": None}
+    return module
+
+
+class _LazyModule:
+    """Module proxy that defers the real import until the first attribute access."""
+
+    def __init__(self, module_name, subsystem):
+        self._module_name = module_name
+        self._subsystem = subsystem
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = _timed_import(self._module_name, self._subsystem)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._module_name}' ({state})>"
+
+
+def _module_available(module_name):
+    """Checks if a top-level module is installed WITHOUT importing it."""
+    try:
+        return importlib.util.find_spec(module_name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
 # --- Third-party Library Imports ---
-import psutil
-import speedtest
-import cv2
-import numpy as np
-import requests  # For Pi-hole and External IP
+# Eager: needed by the login page/sidebar on every run
+psutil = _timed_import("psutil", "System Metrics", mode="eager")
+requests = _timed_import("requests", "HTTP (Pi-hole, External IP)", mode="eager")  # For Pi-hole and External IP
+_timed_import("PIL.Image", "Avatars", mode="eager")
 from PIL import Image, ImageOps, ImageDraw
-from mss import mss
-import pyttsx3
-import speech_recognition as sr
-
-# --- Symbolic Quantum Lib Imports ---
-try:
-    from braket.circuits import Circuit, Qubit, FreeParameter, Observable
-    from braket.devices import LocalSimulator, AwsDevice
-    from qiskit import QuantumCircuit, transpile, Aer, assemble
 
-    HAS_QUANTUM_LIBS = True
+# Lazy: loaded on first use by their subsystem
+pd = _LazyModule("pandas", "Data Tables")
+np = _LazyModule("numpy", "Screen Share / Metrics")
+cv2 = _LazyModule("cv2", "Screen Share")
+mss_lib = _LazyModule("mss", "Screen Share")  # For screen capture (mss_lib.mss)
+speedtest = _LazyModule("speedtest", "Speedtest")
+pyttsx3 = _LazyModule("pyttsx3", "Voice (TTS)")
+sr = _LazyModule("speech_recognition", "Voice (STT)")
+
+# --- Azure AI SDK (Lazy) ---
+azure_inference = _LazyModule("azure.ai.inference", "Azure AI")  # ChatCompletionsClient
+azure_models = _LazyModule("azure.ai.inference.models", "Azure AI")  # SystemMessage, UserMessage, ImageUrl, ...
+azure_credentials = _LazyModule("azure.core.credentials", "Azure AI")  # AzureKeyCredential
+azure_exceptions = _LazyModule("azure.core.exceptions", "Azure AI")  # HttpResponseError, ClientAuthenticationError
+azure_transport = _LazyModule("azure.core.pipeline.transport", "Azure AI")  # RequestsTransport
+azure_inference_aio = _LazyModule("azure.ai.inference.aio", "Azure AI")  # Async ChatCompletionsClient (needs aiohttp)
+
+# --- Symbolic Quantum Lib Imports (Lazy) ---
+# Detected via find_spec only; nothing in the app needs them loaded at startup.
+braket_circuits = _LazyModule("braket.circuits", "Quantum")
+braket_devices = _LazyModule("braket.devices", "Quantum")
+qiskit = _LazyModule("qiskit", "Quantum")
+
+HAS_QUANTUM_LIBS = _module_available("braket") and _module_available("qiskit")
+if HAS_QUANTUM_LIBS:
     quantum_lib_status = "Symbolic Quantum Libraries (braket, qiskit) detected."
-except ImportError:
-    HAS_QUANTUM_LIBS = False
+else:
     quantum_lib_status = (
         "Symbolic Quantum Libraries not found. Classical simulation only."
     )
-    # Dummy placeholders
-    class DummyQuantumClass:
-        pass
 
-    Circuit, Qubit, FreeParameter, Observable = (
-        DummyQuantumClass,
-        DummyQuantumClass,
-        DummyQuantumClass,
-        DummyQuantumClass,
-    )
-    LocalSimulator, AwsDevice = DummyQuantumClass, DummyQuantumClass
-    QuantumCircuit, transpile, Aer, assemble = (
-        DummyQuantumClass,
-        DummyQuantumClass,
-        DummyQuantumClass,
-        DummyQuantumClass,
-    )
+HAS_TTS_LIB = _module_available("pyttsx3")
+HAS_STT_LIB = _module_available("speech_recognition")
 
 # --- Constants ---
 AZURE_AI_ENDPOINT_URL = "https://models.inference.ai.azure.com"  # Correct SDK endpoint
 PHI4_MODEL_NAME = "Phi-4-multimodal-instruct"  # Model identifier for SDK
 
-# --- Azure AI Client Initialization ---
+# --- Azure AI Client Configuration ---
+# The client itself is built on first use by get_azure_client(); only the secrets are checked here.
 azure_ai_enabled = False
 azure_client = None
+AZURE_AI_API_KEY = None
 try:
     AZURE_AI_API_KEY = st.secrets["azure_ai"]["api_key"]
     if not AZURE_AI_API_KEY or AZURE_AI_API_KEY == "YOUR_AZURE_AI_API_KEY_OR_GITHUB_PAT":
         st.error(
             "Azure AI API Key missing/placeholder in secrets.toml [azure_ai]. AI features disabled."
         )
+    elif not _module_available("azure"):
+        st.error("Azure AI SDK not installed (`pip install azure-ai-inference`). AI features disabled.")
     else:
-        try:
-            # @st.cache_resource # Consider caching the client in production
-            def get_azure_client():
-                return ChatCompletionsClient(
-                    endpoint=AZURE_AI_ENDPOINT_URL,
-                    credential=AzureKeyCredential(AZURE_AI_API_KEY),
-                )
-
-            azure_client = get_azure_client()
-            azure_ai_enabled = True
-            # st.sidebar.info("Azure AI Client Initialized.") # Optional confirmation
-        except ClientAuthenticationError:
-            st.error("Azure AI Authentication Failed. Check your API Key.")
-        except Exception as e:
-            st.error(f"Error initializing Azure AI Client: {e}")
+        azure_ai_enabled = True
 
 except (KeyError, FileNotFoundError):
     st.error(
@@ -118,8 +170,546 @@ except (KeyError, FileNotFoundError):
     )
 except AttributeError:
     st.error("Azure AI secrets section ([azure_ai]) malformed? AI disabled.")
-# Make client and status available globally if needed, although passing explicitly is often cleaner
-# global azure_client, azure_ai_enabled
+
+
+class AzureTransportMetrics:
+    """Per-attempt HTTP stats of the shared Azure client: connection reuse and time to first byte.
+
+    Sits in the client's pipeline as a per-retry policy. It is duck-typed (next + send)
+    rather than an azure-core subclass so the SDK stays lazily imported. TTFB is requests'
+    Response.elapsed (request sent until headers parsed); new vs reused connections come
+    from the urllib3 pool's connection counter, so overlapping requests are approximate.
+    """
+
+    def __init__(self, session, window=200):
+        self.next = None # Set by the azure-core pipeline
+        self._session = session
+        self._lock = threading.Lock()
+        self.requests = self.new_connections = self.errors = 0
+        self.ttfb_ms = collections.deque(maxlen=window)
+        self.first_token_ms = collections.deque(maxlen=window)
+
+    def _connections_opened(self):
+        """Connections ever opened by the session's urllib3 pools (one pool per host)."""
+        total = 0
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                try: total += pools[key].num_connections
+                except KeyError: pass # Evicted meanwhile
+        return total
+
+    def send(self, request):
+        connections_before = self._connections_opened()
+        try:
+            response = self.next.send(request)
+        except Exception:
+            with self._lock: self.requests += 1; self.errors += 1
+            raise
+        elapsed = getattr(getattr(response.http_response, "internal_response", None), "elapsed", None)
+        with self._lock:
+            self.requests += 1
+            if self._connections_opened() > connections_before: self.new_connections += 1
+            if response.http_response.status_code >= 400: self.errors += 1
+            if elapsed is not None: self.ttfb_ms.append(elapsed.total_seconds() * 1000)
+        return response
+
+    def record_first_token(self, ms):
+        """Time from sending a streaming request to its first content delta."""
+        with self._lock: self.first_token_ms.append(ms)
+
+    def snapshot(self):
+        with self._lock:
+            ttfb, first_token = sorted(self.ttfb_ms), sorted(self.first_token_ms)
+            requests_done, new_connections, errors = self.requests, self.new_connections, self.errors
+        pick = lambda values, q: values[min(len(values) - 1, int(len(values) * q))] if values else None
+        return {
+            "requests": requests_done, "new_connections": new_connections, "errors": errors,
+            "reused_pct": (requests_done - new_connections) / requests_done * 100 if requests_done else None,
+            "ttfb_p50_ms": pick(ttfb, 0.5), "ttfb_p95_ms": pick(ttfb, 0.95),
+            "first_token_p50_ms": pick(first_token, 0.5), "first_token_p95_ms": pick(first_token, 0.95),
+        }
+
+
+def get_azure_transport_config():
+    """[azure_ai] pool_size (default: 10), connection_timeout (default: 10) and read_timeout (default: 120)."""
+    try: azure_secrets = st.secrets.get("azure_ai", {})
+    except Exception: azure_secrets = {}
+    return int(azure_secrets.get("pool_size", 10)), float(azure_secrets.get("connection_timeout", 10)), float(azure_secrets.get("read_timeout", 120))
+
+@st.cache_resource(show_spinner=False)
+def build_azure_client(api_key, endpoint, pool_size=10, connection_timeout=10.0, read_timeout=120.0):
+    """One ChatCompletionsClient per process (and key) on a pooled keep-alive transport. Returns (client, metrics).
+
+    Streamlit re-executes the module on every rerun, so a module-level client would be
+    rebuilt constantly; caching it here shares one HTTP pipeline and connection pool
+    between all sessions, chat and vision.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    metrics = AzureTransportMetrics(session)
+    client = azure_inference.ChatCompletionsClient(
+        endpoint=endpoint,
+        credential=azure_credentials.AzureKeyCredential(api_key),
+        transport=azure_transport.RequestsTransport(session=session, session_owner=False,
+                                                    connection_timeout=connection_timeout, read_timeout=read_timeout),
+        per_retry_policies=[metrics],
+        retry_total=0, # Retries, backoff and the circuit breaker live in AzureCallGuard
+    )
+    get_azure_runtime()["metrics"] = metrics
+    return client, metrics
+
+@st.cache_resource(show_spinner=False)
+def get_azure_runtime():
+    """Process-wide record of the Azure objects built so far ({"metrics": ..., "service": ...}).
+
+    Module globals are reset on every rerun, so this is how the sidebar can tell whether a
+    client exists and show its stats without building one (and importing the SDK) itself.
+    """
+    return {}
+
+def get_azure_client():
+    """Shared process-wide Azure ChatCompletionsClient, built on first use. Returns None if unavailable."""
+    global azure_client, azure_ai_enabled
+    if not azure_ai_enabled:
+        return azure_client
+    try:
+        azure_client = build_azure_client(AZURE_AI_API_KEY, AZURE_AI_ENDPOINT_URL, *get_azure_transport_config())[0]
+    except azure_exceptions.ClientAuthenticationError:
+        st.error("Azure AI Authentication Failed. Check your API Key.")
+        azure_ai_enabled = False
+    except Exception as e:
+        st.error(f"Error initializing Azure AI Client: {e}")
+        azure_ai_enabled = False
+    return azure_client
+
+def get_azure_transport_metrics():
+    """Transport metrics of the shared client, or None if Azure AI is unavailable."""
+    if not get_azure_client(): return None
+    return build_azure_client(AZURE_AI_API_KEY, AZURE_AI_ENDPOINT_URL, *get_azure_transport_config())[1]
+
+
+
+class AzureUnavailableError(Exception):
+    """Raised by AzureCallGuard instead of calling Azure (circuit open or no free concurrency slot)."""
+
+
+class AzureCallGuard:
+    """Process-wide resilience layer around ChatCompletionsClient.complete.
+
+    - Retries 408/429/5xx and connection errors with full-jitter exponential backoff,
+      waiting at least as long as the response's Retry-After / retry-after-ms asks.
+    - A circuit breaker opens after `failure_threshold` consecutive transient failures
+      (or a Retry-After longer than max_delay) and short-circuits calls for `cooldown`
+      seconds; then one trial call decides whether it closes again.
+    - slot() limits concurrent requests per process so sessions don't stampede the endpoint.
+    """
+    RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, max_retries=3, base_delay=1.0, max_delay=20.0, failure_threshold=5, cooldown=60.0, max_concurrent=2, slot_timeout=30.0):
+        self.max_retries, self.base_delay, self.max_delay = max(0, int(max_retries)), float(base_delay), float(max_delay)
+        self.failure_threshold, self.cooldown = max(1, int(failure_threshold)), float(cooldown)
+        self.max_concurrent, self.slot_timeout = max(1, int(max_concurrent)), float(slot_timeout)
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0.0 # time.monotonic() before which calls are short-circuited
+        self._trial_running = False
+        self.in_flight = self.retries = self.short_circuits = self.slot_timeouts = 0
+
+    def _slot_acquired(self):
+        with self._lock: self.in_flight += 1
+
+    def _slot_released(self):
+        with self._lock: self.in_flight -= 1
+        self._slots.release()
+
+    def _slot_timed_out(self):
+        with self._lock: self.slot_timeouts += 1
+        return AzureUnavailableError(f"Too many concurrent Azure AI requests ({self.max_concurrent} in flight); try again shortly.")
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Holds one of max_concurrent request slots (raises AzureUnavailableError after slot_timeout)."""
+        if not self._slots.acquire(timeout=self.slot_timeout): raise self._slot_timed_out()
+        self._slot_acquired()
+        try: yield
+        finally: self._slot_released()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self):
+        """slot() for coroutines: polls for a free slot instead of blocking the event loop."""
+        deadline = time.monotonic() + self.slot_timeout
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() > deadline: raise self._slot_timed_out()
+            await asyncio.sleep(0.05)
+        self._slot_acquired()
+        try: yield
+        finally: self._slot_released()
+
+    def _before_attempt(self):
+        with self._lock:
+            remaining = self.open_until - time.monotonic()
+            if remaining > 0 or (self.open_until and self._trial_running):
+                self.short_circuits += 1
+                raise AzureUnavailableError(f"Azure AI paused after repeated failures; retrying in {max(remaining, 1):.0f}s.")
+            if self.open_until: self._trial_running = True # Half-open: this call is the trial
+
+    def _record(self, ok, open_for=None):
+        with self._lock:
+            self._trial_running = False
+            if ok:
+                self.consecutive_failures, self.open_until = 0, 0.0
+                return
+            self.consecutive_failures += 1
+            if open_for or self.consecutive_failures >= self.failure_threshold or self.open_until:
+                self.open_until = time.monotonic() + max(open_for or 0.0, self.cooldown)
+
+    @staticmethod
+    def retry_after(error):
+        """Seconds the server asked us to wait (retry-after-ms / Retry-After seconds or HTTP date), or None."""
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms"): return float(headers["retry-after-ms"]) / 1000
+            value = headers.get("Retry-After") or headers.get("retry-after")
+            if not value: return None
+            try: return max(0.0, float(value))
+            except ValueError: return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _retry_delay(self, error, attempt):
+        """Records a failed attempt; returns (delay, reason) to retry, or re-raises error."""
+        if isinstance(error, azure_exceptions.HttpResponseError):
+            if error.status_code not in self.RETRYABLE_STATUS:
+                self._record(True) # The service answered; a client error says nothing about its health
+                raise error
+            retry_after, reason = self.retry_after(error), f"HTTP {error.status_code}"
+        elif isinstance(error, (azure_exceptions.ServiceRequestError, azure_exceptions.ServiceResponseError)):
+            retry_after, reason = None, type(error).__name__
+        else:
+            with self._lock: self._trial_running = False # Not a service failure; don't leave a trial dangling
+            raise error
+        if retry_after is not None and retry_after > self.max_delay: # e.g. a daily quota: stop asking until it resets
+            self._record(False, open_for=retry_after)
+            raise error
+        self._record(False)
+        if attempt > self.max_retries: raise error
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))) # Full jitter
+        if retry_after is not None: delay = max(delay, retry_after)
+        with self._lock: self.retries += 1
+        return delay, reason
+
+    def call(self, fn, *args, on_retry=None, **kwargs):
+        """fn(*args, **kwargs) with retries; on_retry(attempt, delay, reason) is called before each wait."""
+        attempt = 0
+        while True:
+            self._before_attempt()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                delay, reason = self._retry_delay(e, attempt)
+                if on_retry: on_retry(attempt, delay, reason)
+                time.sleep(delay)
+                continue
+            self._record(True)
+            return result
+
+    async def acall(self, fn, *args, on_retry=None, **kwargs):
+        """call() for coroutine functions; waits with asyncio.sleep."""
+        attempt = 0
+        while True:
+            self._before_attempt()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                delay, reason = self._retry_delay(e, attempt)
+                if on_retry: on_retry(attempt, delay, reason)
+                await asyncio.sleep(delay)
+                continue
+            self._record(True)
+            return result
+
+    def snapshot(self):
+        with self._lock:
+            remaining = self.open_until - time.monotonic()
+            state = "open" if remaining > 0 else ("half-open" if self.open_until else "closed")
+            return {"state": state, "open_for": max(0.0, remaining), "consecutive_failures": self.consecutive_failures,
+                    "retries": self.retries, "short_circuits": self.short_circuits, "slot_timeouts": self.slot_timeouts,
+                    "in_flight": self.in_flight, "max_concurrent": self.max_concurrent}
+
+
+@st.cache_resource(show_spinner=False)
+def get_azure_call_guard(max_retries, max_delay, failure_threshold, cooldown, max_concurrent):
+    return AzureCallGuard(max_retries=max_retries, max_delay=max_delay, failure_threshold=failure_threshold,
+                          cooldown=cooldown, max_concurrent=max_concurrent)
+
+def get_azure_call_guard_from_secrets():
+    """Guard configured by [azure_ai] max_retries (3), retry_max_delay (20), breaker_threshold (5), breaker_cooldown (60), max_concurrent (2)."""
+    try: azure_secrets = st.secrets.get("azure_ai", {})
+    except Exception: azure_secrets = {}
+    return get_azure_call_guard(int(azure_secrets.get("max_retries", 3)), float(azure_secrets.get("retry_max_delay", 20)),
+                                int(azure_secrets.get("breaker_threshold", 5)), float(azure_secrets.get("breaker_cooldown", 60)),
+                                int(azure_secrets.get("max_concurrent", 2)))
+
+
+class InferenceTicket:
+    """One queued inference request. Any thread reads its output with stream() / result().
+
+    Streaming requests deliver text deltas; non-streaming ones a single ChatCompletions
+    response. A failure is delivered as the exception and re-raised in the reader, so
+    callers keep their usual except clauses.
+    """
+    _END = object()
+
+    def __init__(self, session_id, kind, priority, request):
+        self.id = os.urandom(6).hex()
+        self.session_id, self.kind, self.priority, self.request = session_id, kind, int(priority), request
+        self.status = "queued" # queued -> running -> done / error / cancelled
+        self.submitted, self.started, self.first_token, self.finished = time.monotonic(), None, None, None
+        self.retries = [] # "HTTP 429, retry 1 after 2.0s", ...
+        self.cancelled = False
+        self._chunks = queue.Queue()
+
+    def _put(self, item):
+        self._chunks.put(item)
+
+    def _close(self):
+        self._chunks.put(self._END)
+
+    def stream(self, timeout=300.0):
+        """Yields output as it arrives; raises the request's exception, or AzureUnavailableError after `timeout` idle seconds."""
+        while True:
+            try: item = self._chunks.get(timeout=timeout)
+            except queue.Empty: raise AzureUnavailableError(f"No response from the inference queue within {timeout:.0f}s.") from None
+            if item is self._END: return
+            if isinstance(item, BaseException): raise item
+            yield item
+
+    def result(self, timeout=300.0):
+        """Whole answer: the joined text of a streaming request, else the response object."""
+        items = list(self.stream(timeout))
+        if self.request.get("stream"): return "".join(items)
+        return items[0] if items else None
+
+    def cancel(self):
+        """Drops the request if still queued, or stops reading its stream at the next chunk."""
+        self.cancelled = True
+
+
+class AsyncInferenceService:
+    """Process-wide asyncio front end to Azure AI for all sessions.
+
+    A daemon thread runs an event loop with one aio ChatCompletionsClient (aiohttp,
+    keep-alive) and `workers` coroutines. submit() may be called from any thread; the
+    loop serves the lowest priority number first (chat 0, vision 1, background 2) and,
+    within a priority, round-robins between sessions so one busy session can't starve
+    the others. Calls still go through the AzureCallGuard (retries, circuit breaker,
+    concurrency slots shared with the synchronous path).
+    """
+    STAT_WINDOW = 500
+
+    def __init__(self, endpoint, api_key, guard, workers=2, max_queued_per_session=4, connection_timeout=10.0, read_timeout=120.0, start_timeout=30.0):
+        self.endpoint, self.guard = endpoint, guard
+        self.workers, self.max_queued_per_session = max(1, int(workers)), max(1, int(max_queued_per_session))
+        self._client_kwargs = {"endpoint": endpoint, "credential": azure_credentials.AzureKeyCredential(api_key),
+                               "retry_total": 0, "connection_timeout": connection_timeout, "read_timeout": read_timeout}
+        self._lock = threading.Lock()
+        self._pending = {} # priority -> OrderedDict(session_id -> deque of tickets)
+        self.running = 0
+        self.completed = self.failed = self.cancelled = self.rejected = 0
+        self._timings = collections.defaultdict(lambda: {key: collections.deque(maxlen=self.STAT_WINDOW) for key in ("wait_ms", "first_token_ms", "total_ms")})
+        self._served_by_session = collections.Counter()
+        self._loop = asyncio.new_event_loop()
+        self._main_task = self._loop.create_task(self._main()) # Runs once the thread starts the loop
+        self._started = threading.Event()
+        self._start_error = None
+        self._thread = threading.Thread(target=self._run, name="azure-inference", daemon=True)
+        self._thread.start()
+        if not self._started.wait(timeout=start_timeout): # e.g. slow DNS/TLS: don't hand out a half-built service
+            self._loop.call_soon_threadsafe(self._main_task.cancel)
+            self._thread.join(5)
+            raise AzureUnavailableError(f"Azure AI inference client not ready within {start_timeout:g}s.")
+        if self._start_error: raise self._start_error
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try: self._loop.run_until_complete(self._main_task)
+        except asyncio.CancelledError: pass # Start-up timed out
+        except Exception as e:
+            self._start_error = e
+            self._started.set()
+        finally:
+            self._fail_pending(AzureUnavailableError("Azure AI inference service stopped."))
+            self._loop.close()
+
+    async def _main(self):
+        self._available = asyncio.Semaphore(0) # One release per submitted ticket
+        self._stopping = asyncio.Event()
+        async with azure_inference_aio.ChatCompletionsClient(**self._client_kwargs) as client:
+            self._started.set()
+            tasks = [asyncio.create_task(self._worker(client)) for _ in range(self.workers)]
+            await self._stopping.wait()
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, messages, session_id, kind="chat", priority=0, **request):
+        """Queues a ChatCompletions request (model defaults to PHI4_MODEL_NAME) and returns its InferenceTicket.
+
+        Raises AzureUnavailableError if the session already has max_queued_per_session
+        requests waiting or the service has stopped.
+        """
+        request.setdefault("model", PHI4_MODEL_NAME)
+        ticket = InferenceTicket(session_id, kind, priority, dict(request, messages=messages))
+        with self._lock:
+            if not self._thread.is_alive(): raise AzureUnavailableError("Azure AI inference service stopped.")
+            sessions = self._pending.setdefault(ticket.priority, collections.OrderedDict())
+            waiting = sessions.setdefault(session_id, collections.deque())
+            if len(waiting) >= self.max_queued_per_session:
+                self.rejected += 1
+                if not waiting: del sessions[session_id]
+                raise AzureUnavailableError(f"{len(waiting)} requests from this session are already queued; wait for them to finish.")
+            waiting.append(ticket)
+        self._loop.call_soon_threadsafe(self._available.release)
+        return ticket
+
+    def _next_ticket(self):
+        """Head of the next session's queue at the best priority; that session moves to the back of the line."""
+        with self._lock:
+            for priority in sorted(self._pending):
+                sessions = self._pending[priority]
+                while sessions:
+                    session_id, waiting = next(iter(sessions.items()))
+                    ticket = waiting.popleft()
+                    if waiting: sessions.move_to_end(session_id)
+                    else: del sessions[session_id]
+                    if ticket.cancelled:
+                        self.cancelled += 1
+                        ticket.status = "cancelled"
+                        ticket._close()
+                        continue
+                    self.running += 1
+                    return ticket
+        return None
+
+    async def _worker(self, client):
+        while True:
+            await self._available.acquire()
+            ticket = self._next_ticket()
+            if ticket: await self._serve(client, ticket)
+
+    async def _serve(self, client, ticket):
+        ticket.status, ticket.started = "running", time.monotonic()
+        attempt_started = {}
+        async def complete(**kwargs):
+            attempt_started["t"] = time.monotonic() # First-token latency excludes backoff waits
+            return await client.complete(**kwargs)
+        try:
+            async with self.guard.aslot():
+                response = await self.guard.acall(
+                    complete, on_retry=lambda attempt, delay, reason: ticket.retries.append(f"{reason}, retry {attempt} after {delay:.1f}s"),
+                    **ticket.request)
+                if ticket.request.get("stream"):
+                    async with response:
+                        async for chunk in response:
+                            if ticket.cancelled: break
+                            delta = chunk.choices[0].delta if chunk.choices else None
+                            if delta and delta.content:
+                                if ticket.first_token is None: ticket.first_token = time.monotonic()
+                                ticket._put(delta.content)
+                else:
+                    ticket.first_token = time.monotonic()
+                    ticket._put(response)
+            ticket.status = "cancelled" if ticket.cancelled else "done"
+        except asyncio.CancelledError:
+            ticket.status = "cancelled"
+            ticket._put(AzureUnavailableError("Azure AI inference service stopped."))
+            raise
+        except Exception as e:
+            ticket.status = "error"
+            ticket._put(e)
+        finally:
+            ticket.finished = time.monotonic()
+            ticket._close()
+            self._record(ticket, attempt_started.get("t"))
+
+    def _record(self, ticket, attempt_started):
+        with self._lock:
+            self.running -= 1
+            if ticket.status == "done": self.completed += 1
+            elif ticket.status == "error": self.failed += 1
+            else: self.cancelled += 1
+            self._served_by_session[ticket.session_id] += 1
+            timings = self._timings[ticket.kind]
+            timings["wait_ms"].append((ticket.started - ticket.submitted) * 1000)
+            timings["total_ms"].append((ticket.finished - ticket.submitted) * 1000)
+            if ticket.first_token and attempt_started: timings["first_token_ms"].append((ticket.first_token - attempt_started) * 1000)
+
+    def _fail_pending(self, error):
+        with self._lock:
+            tickets = [ticket for sessions in self._pending.values() for waiting in sessions.values() for ticket in waiting]
+            self._pending.clear()
+        for ticket in tickets:
+            ticket.status = "cancelled"
+            ticket._put(error)
+            ticket._close()
+
+    def stop(self, timeout=10.0):
+        """Cancels running requests, fails queued ones and ends the loop thread."""
+        if self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+            self._thread.join(timeout)
+
+    def snapshot(self):
+        with self._lock:
+            queued = {priority: sum(len(waiting) for waiting in sessions.values()) for priority, sessions in self._pending.items()}
+            kinds = {}
+            for kind, timings in self._timings.items():
+                kinds[kind] = {}
+                for key, values in timings.items():
+                    if values: kinds[kind].update({f"{key[:-3]}_p{point}_ms": value for point, value in zip((50, 95), latency_percentiles(values, (50, 95)))})
+            return {"workers": self.workers, "running": self.running, "queued": sum(queued.values()),
+                    "queued_by_priority": dict(sorted(queued.items())), "sessions_waiting": len({s for sessions in self._pending.values() for s in sessions}),
+                    "completed": self.completed, "failed": self.failed, "cancelled": self.cancelled, "rejected": self.rejected,
+                    "kinds": kinds, "served_by_session": dict(self._served_by_session)}
+
+
+INFERENCE_PRIORITY = {"chat": 0, "vision": 1, "background": 2} # Lower is served first
+
+@st.cache_resource(show_spinner=False)
+def get_inference_service(api_key, endpoint, workers, max_queued_per_session, connection_timeout, read_timeout):
+    service = AsyncInferenceService(endpoint, api_key, get_azure_call_guard_from_secrets(), workers=workers,
+                                    max_queued_per_session=max_queued_per_session,
+                                    connection_timeout=connection_timeout, read_timeout=read_timeout)
+    get_azure_runtime()["service"] = service
+    return service
+
+def get_inference_service_from_secrets():
+    """Shared AsyncInferenceService, or None to use the synchronous client.
+
+    [azure_ai] async_inference (default: true if aiohttp is installed) turns it on; it runs
+    max_concurrent workers and queues up to max_queued_per_session (default: 4) requests per session.
+    """
+    if not azure_ai_enabled: return None
+    try: azure_secrets = st.secrets.get("azure_ai", {})
+    except Exception: azure_secrets = {}
+    if not azure_secrets.get("async_inference", True) or not _module_available("aiohttp"): return None
+    _, connection_timeout, read_timeout = get_azure_transport_config()
+    try:
+        return get_inference_service(AZURE_AI_API_KEY, AZURE_AI_ENDPOINT_URL, get_azure_call_guard_from_secrets().max_concurrent,
+                                     int(azure_secrets.get("max_queued_per_session", 4)), connection_timeout, read_timeout)
+    except Exception as e:
+        print(f"Async inference service unavailable, using the synchronous client: {e}")
+        return None
+
+def get_session_uid():
+    """Random id of this browser session, used for fair queueing between sessions."""
+    if "session_uid" not in st.session_state: st.session_state.session_uid = os.urandom(8).hex()
+    return st.session_state.session_uid
 
 # --- Pi-hole API Configuration ---
 pihole_enabled = False
@@ -218,20 +808,109 @@ system_instruction = f"""
 """
 
 
+# --- Conversation Context Budget ---
+# Short system prompt for plain status questions; the full one above costs well over a thousand tokens per request.
+compact_system_instruction = f"""You are CyberNexus Q, an AI agent ({PHI4_MODEL_NAME}) monitoring a Raspberry Pi: system resources, network, Pi-hole and a *simulated* Azure Quantum-inspired security audit (no real quantum jobs run).
+Answer briefly and precisely in markdown, with `code` for values, commands, filenames and IPs."""
+
+MESSAGE_OVERHEAD_TOKENS = 4 # Role/separator tokens the chat format adds per message
+TOKEN_PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+STATUS_QUERY_PATTERN = re.compile(r"\b(cpu|ram|memory|disk|temp\w*|uptime|load|status|ip|ping|speed\w*|bandwidth|network|pi-?hole|dns|interfaces?|process\w*)\b", re.I)
+FULL_PROMPT_PATTERN = re.compile(r"\b(who are you|identity|quantum|security|audit|screen|explain|analy[sz]e|why|how)\b", re.I)
+
+def get_context_config():
+    """[azure_ai] context_token_budget (default: 3000), max_message_tokens (default: 1000), compact_system_prompt (default: true)."""
+    try: azure_secrets = st.secrets.get("azure_ai", {})
+    except Exception: azure_secrets = {}
+    return (int(azure_secrets.get("context_token_budget", 3000)), int(azure_secrets.get("max_message_tokens", 1000)),
+            bool(azure_secrets.get("compact_system_prompt", True)))
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Approximate token count, computed once per distinct message text.
+
+    No tokenizer ships with the app; the larger of chars/4 and word/punctuation
+    pieces errs on the high side for both prose and pasted logs.
+    """
+    return max(1, len(text) // 4, len(TOKEN_PIECE_PATTERN.findall(text)))
+
+def truncate_to_tokens(text, max_tokens):
+    """Keeps the head and tail of an oversized message (logs usually matter at both ends)."""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens: return text
+    keep = max(0, int(len(text) * max_tokens / tokens) - 60)
+    return f"{text[:keep * 2 // 3]}\n…[~{tokens - max_tokens:,} tokens omitted]…\n{text[len(text) - keep // 3:]}"
+
+def is_status_query(prompt):
+    """Short plain status questions ("cpu temp?", "what's my ip") that don't need the full persona prompt."""
+    return len(prompt) < 200 and bool(STATUS_QUERY_PATTERN.search(prompt)) and not FULL_PROMPT_PATTERN.search(prompt)
+
+def summarize_dropped_turns(turns, max_tokens):
+    """One line per dropped user question, newest first until max_tokens is spent."""
+    header = "Earlier in this conversation the user asked (oldest omitted):"
+    lines, used = [], count_tokens(header) + 2
+    for role, content in reversed(turns):
+        if role != "user": continue
+        line = f"- {' '.join(content.split())[:100]}"
+        cost = count_tokens(line)
+        if used + cost > max_tokens: break
+        lines.append(line); used += cost
+    if not lines: return ""
+    return header + "\n" + "\n".join(reversed(lines))
+
+
+def build_chat_context(prompt, chat_history, budget=3000, max_message_tokens=1000, compact=True):
+    """Fits system prompt, history and prompt into a token budget.
+
+    Each message is capped at max_message_tokens; the newest turns are kept while they
+    fit and older ones collapse into a short summary appended to the system prompt.
+    Returns {"system", "turns": [(role, content)], "prompt", "tokens", "dropped", "compact"}.
+    """
+    use_compact = compact and is_status_query(prompt)
+    system = compact_system_instruction if use_compact else system_instruction
+    prompt = truncate_to_tokens(prompt, max_message_tokens)
+    used = count_tokens(system) + count_tokens(prompt) + 2 * MESSAGE_OVERHEAD_TOKENS
+    history = [(msg["role"], truncate_to_tokens(msg["content"], max_message_tokens)) for msg in chat_history
+               if isinstance(msg, dict) and msg.get("content") and msg.get("role") in ("user", "assistant")]
+    costs = [count_tokens(content) + MESSAGE_OVERHEAD_TOKENS for _role, content in history]
+    reserve = budget // 10 if used + sum(costs) > budget else 0 # Room for the summary once something must go
+    kept = 0
+    for cost in reversed(costs):
+        if used + cost > budget - reserve: break
+        used += cost; kept += 1
+    dropped, turns = history[:len(history) - kept], history[len(history) - kept:]
+    summary = summarize_dropped_turns(dropped, max(0, budget - used)) if dropped else ""
+    if summary:
+        system += "\n\n" + summary
+        used += count_tokens(summary) + 1
+    return {"system": system, "turns": turns, "prompt": prompt, "tokens": used, "dropped": len(dropped), "compact": use_compact}
+
+
 # --- TTS Setup ---
-if "tts_engine" not in st.session_state:
+# The pyttsx3 engine is created on first use (not at page load) and shared by all sessions.
+@st.cache_resource(show_spinner=False)
+def get_tts_engine():
+    """Initializes the pyttsx3 engine once per process. Returns (engine, error_message)."""
+    if not HAS_TTS_LIB:
+        return None, "pyttsx3 not installed"
     try:
-        st.session_state.tts_engine = pyttsx3.init()
+        engine = pyttsx3.init()
         # Optional: Configure TTS properties (rate, volume, voice)
-        # engine = st.session_state.tts_engine
         # engine.setProperty('rate', 180) # Example: Adjust speed
         # voices = engine.getProperty('voices')
         # if voices: engine.setProperty('voice', voices[1].id) # Example: Change voice if available
+        return engine, None
     except Exception as e:
-        st.warning(
-            f"Failed to initialize TTS engine: {e}. TTS features will be unavailable."
-        )
-        st.session_state.tts_engine = None
+        return None, str(e)
+
+
+@st.cache_resource(show_spinner=False)
+def get_tts_lock():
+    """Process-wide lock around the shared engine: pyttsx3 is not thread-safe and every session runs in its own thread.
+
+    Cached rather than a plain global, since each rerun re-executes this module.
+    """
+    return threading.Lock()
 
 
 def speak_text(text):
@@ -260,16 +939,16 @@ def speak_text(text):
 
     if not text_to_speak: return # Skip if still no text after extraction
 
-    # Final check for TTS engine and toggle state
-    if (
-        st.session_state.get("tts_engine")
-        and st.session_state.get("tts_toggle", True) # Check toggle state from sidebar
-    ):
-        engine = st.session_state.tts_engine
+    # Final check for TTS toggle state, then engine (initialized lazily on first speech)
+    if not HAS_TTS_LIB or not st.session_state.get("tts_toggle", True): # Check toggle state from sidebar
+        return
+    engine, tts_error = get_tts_engine()
+    if engine:
         try:
-            engine.stop()  # Stop any currently speaking utterance
-            engine.say(text_to_speak)
-            engine.runAndWait()
+            with get_tts_lock(): # One session at a time: stop/say/runAndWait on one engine must not interleave
+                engine.stop()  # Stop any currently speaking utterance
+                engine.say(text_to_speak)
+                engine.runAndWait()
         except RuntimeError as e:
             # Common error if engine is busy or in a bad state
             # Display only once to avoid spamming warnings
@@ -281,24 +960,26 @@ def speak_text(text):
                  st.toast(f"TTS Error: Could not speak text. {e}", icon="🔊")
                  st.session_state.tts_general_error_shown = True
 
-    elif not st.session_state.get("tts_engine"):
-        # Engine failed init, warning already shown
-        pass
-    # else: # TTS is toggled off, do nothing
+    elif 'tts_init_error_shown' not in st.session_state:
+        st.warning(f"Failed to initialize TTS engine: {tts_error}. TTS features will be unavailable.")
+        st.session_state.tts_init_error_shown = True
 
 
 # --- STT Setup ---
-if "recognizer" not in st.session_state:
-    try:
-        st.session_state.recognizer = sr.Recognizer()
-    except Exception as e:
-        st.warning(f"Failed to initialize Speech Recognizer: {e}. Voice input disabled.")
-        st.session_state.recognizer = None
+def get_speech_recognizer():
+    """Creates this session's SpeechRecognition Recognizer on first use. Returns None if unavailable."""
+    if "recognizer" not in st.session_state:
+        try:
+            st.session_state.recognizer = sr.Recognizer() if HAS_STT_LIB else None
+        except Exception as e:
+            st.warning(f"Failed to initialize Speech Recognizer: {e}. Voice input disabled.")
+            st.session_state.recognizer = None
+    return st.session_state.recognizer
 
 
 def listen_for_command():
     """Listens for voice command using microphone and Google Speech Recognition."""
-    r = st.session_state.get("recognizer")
+    r = get_speech_recognizer()
     if not r:
         st.error("Speech recognizer not available.")
         return ""
@@ -825,16 +1506,55 @@ st.markdown(
 
 # --- Helper Functions ---
 
-# Use caching for functions that don't need real-time data every second
-@st.cache_data(ttl=15)  # Cache for 15 seconds (can adjust)
-def get_pi_status():
-    """Gets basic system status using psutil, with improved temperature detection."""
-    cpu_percent = psutil.cpu_percent(interval=0.1)
-    memory = psutil.virtual_memory()
-    memory_percent = memory.percent
-    disk = psutil.disk_usage("/")
-    disk_percent = disk.percent
+def _resolve_psutil_temp_sysfs_path(key, celsius):
+    """Maps a psutil sensor key to the sysfs file psutil reads it from (Linux), or None."""
+    if platform.system() != "Linux":
+        return None
+    candidates = []
+    for hwmon_dir in glob.glob("/sys/class/hwmon/hwmon*"): # psutil names hwmon sensors after their 'name' file
+        try:
+            with open(os.path.join(hwmon_dir, "name"), "r") as f_name:
+                if f_name.read().strip() != key: continue
+        except (OSError, ValueError):
+            continue
+        candidates.extend(glob.glob(os.path.join(hwmon_dir, "temp*_input")))
+    for zone_dir in glob.glob("/sys/class/thermal/thermal_zone*"): # ...and thermal zones after their 'type'
+        try:
+            with open(os.path.join(zone_dir, "type"), "r") as f_type:
+                if f_type.read().strip() == key: candidates.append(os.path.join(zone_dir, "temp"))
+        except (OSError, ValueError):
+            continue
+    # Pick the file whose current value matches the psutil reading
+    best_path, best_diff = None, None
+    for path in candidates:
+        value = _read_sysfs_millidegrees(path)
+        if value is None: continue
+        diff = abs(value - celsius)
+        if best_diff is None or diff < best_diff:
+            best_path, best_diff = path, diff
+    return best_path if best_diff is not None and best_diff <= 2.0 else None
+
+
+def _read_sysfs_millidegrees(path):
+    """Reads a single sysfs temperature file (millidegrees C). Returns Celsius or None."""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read(16).strip()
+        celsius = int(raw) / 1000.0
+    except (OSError, ValueError):
+        return None
+    return celsius if -20 < celsius < 130 else None
+
+
+def discover_cpu_temperature_source():
+    """Full CPU temperature discovery via psutil, falling back to /sys/class/thermal on Linux.
+
+    Returns (source_or_None, celsius_or_None, display_string). source is
+    {"kind": "sysfs", "path": ...} or {"kind": "psutil", "key": ..., "index": ...}.
+    """
     cpu_temp = "N/A"
+    cpu_temp_celsius = None
+    source = None
     found_primary_temp = False
     found_alt_temp = False
     psutil_error_msg = None
@@ -861,6 +1581,7 @@ def get_pi_status():
                         cpu_temp_celsius = valid_readings[0]
                         cpu_temp = f"{cpu_temp_celsius:.1f}°C"
                         temp_details = f"(psutil: {key})"
+                        source = {"kind": "psutil", "key": key, "index": [r.current for r in temp_sensors[key]].index(cpu_temp_celsius)}
                         found_primary_temp = True
                         break # Found primary, stop searching preferred
 
@@ -876,6 +1597,7 @@ def get_pi_status():
                             cpu_temp_celsius = valid_readings[0]
                             cpu_temp = f"{cpu_temp_celsius:.1f}°C"
                             temp_details = f"(psutil: {key})"
+                            source = {"kind": "psutil", "key": key, "index": [r.current for r in readings].index(cpu_temp_celsius)}
                             found_primary_temp = True
                             break # Found any valid sensor temp
         else:
@@ -931,8 +1653,10 @@ def get_pi_status():
                                 # Check reasonable range again
                                 if -20 < cpu_temp_celsius_alt < 130:
                                     zone_name = os.path.basename(os.path.dirname(zone_file))
+                                    cpu_temp_celsius = cpu_temp_celsius_alt
                                     cpu_temp = f"{cpu_temp_celsius_alt:.1f}°C"
                                     temp_details = f"(Alt: {zone_name})"
+                                    source = {"kind": "sysfs", "path": zone_file}
                                     found_alt_temp = True
                                     break # Found a good fallback temp
                     except (IOError, ValueError, PermissionError, Exception):
@@ -950,17 +1674,646 @@ def get_pi_status():
     if cpu_temp.startswith("N/A") and not found_primary_temp and not found_alt_temp:
         cpu_temp = "N/A (Temp monitoring unavailable)"
 
+    # A psutil sensor on Linux is backed by one sysfs file: read that directly afterwards
+    if source and source["kind"] == "psutil":
+        sysfs_path = _resolve_psutil_temp_sysfs_path(source["key"], cpu_temp_celsius)
+        if sysfs_path: source = {"kind": "sysfs", "path": sysfs_path}
+    if source: source["details"] = temp_details
+
+    return source, cpu_temp_celsius, f"{cpu_temp} {temp_details}".strip()
+
+
+class CpuTemperatureSensor:
+    """Resolves the CPU temperature source once, then reads only that source on each sample.
+
+    A failed read triggers rediscovery. If nothing is found, discovery is retried
+    at most every `retry_seconds` instead of on every sample.
+    """
+
+    def __init__(self, retry_seconds=300):
+        self.retry_seconds = retry_seconds
+        self.source = None
+        self._unavailable_display = None
+        self._last_discovery = None
+        self._lock = threading.Lock()
+
+    def _discover(self):
+        self._last_discovery = time.monotonic()
+        self.source, celsius, display = discover_cpu_temperature_source()
+        self._unavailable_display = None if self.source else display
+        return celsius, display
+
+    def _read_source(self):
+        source = self.source
+        if source["kind"] == "sysfs":
+            return _read_sysfs_millidegrees(source["path"])
+        readings = psutil.sensors_temperatures(fahrenheit=False).get(source["key"]) or []
+        if source["index"] < len(readings):
+            current = readings[source["index"]].current
+            if current is not None and -20 < current < 130: return current
+        return None
+
+    def read(self):
+        """Returns (celsius_or_None, display_string) like the 'cpu_temperature' status field."""
+        with self._lock:
+            if self.source is None:
+                retry_due = self._last_discovery is None or time.monotonic() - self._last_discovery >= self.retry_seconds
+                if not retry_due:
+                    return None, self._unavailable_display
+                return self._discover()
+            try:
+                celsius = self._read_source()
+            except Exception:
+                celsius = None
+            if celsius is None: # Sensor vanished or returned garbage: rediscover
+                return self._discover()
+            return celsius, f"{celsius:.1f}°C {self.source['details']}".strip()
+
+
+# --- Persistent Metrics History (SQLite, WAL) ---
+class MetricsStore:
+    """Embedded SQLite time-series store with batched writes, 1-minute/1-hour rollups and retention.
+
+    record()/record_many() only append to an in-memory batch; a writer thread flushes
+    the batch every `flush_interval` seconds in one transaction and updates the
+    rollup tables incrementally (n/sum/min/max per bucket, so averages stay exact).
+    """
+
+    ROLLUP_TIERS = (("rollup_1m", 60), ("rollup_1h", 3600))
+
+    def __init__(self, db_path, flush_interval=10.0, raw_retention_hours=48,
+                 minute_retention_days=30, hour_retention_days=365):
+        self.db_path = db_path
+        self.flush_interval = max(1.0, float(flush_interval))
+        self.retention_seconds = {
+            "samples_raw": float(raw_retention_hours) * 3600,
+            "rollup_1m": float(minute_retention_days) * 86400,
+            "rollup_1h": float(hour_retention_days) * 86400,
+        }
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._db_lock = threading.Lock() # One connection shared by the writer thread and readers
+        self._metric_ids = {}
+        self._last_prune = 0.0
+        self._stop_event = threading.Event()
+        self._conn = self._connect(db_path)
+        self._create_schema()
+        self._thread = threading.Thread(target=self._run, name="cnq-metrics-store", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _connect(db_path):
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL") # Readers never block the writer
+        conn.execute("PRAGMA synchronous=NORMAL") # Safe with WAL, far fewer fsyncs on SD cards
+        return conn
+
+    def _create_schema(self):
+        with self._db_lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS metrics (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+                CREATE TABLE IF NOT EXISTS samples_raw (metric_id INTEGER NOT NULL, ts REAL NOT NULL, value REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS idx_samples_raw ON samples_raw (metric_id, ts);
+                CREATE TABLE IF NOT EXISTS rollup_1m (
+                    metric_id INTEGER NOT NULL, bucket INTEGER NOT NULL,
+                    n INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL,
+                    PRIMARY KEY (metric_id, bucket)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS rollup_1h (
+                    metric_id INTEGER NOT NULL, bucket INTEGER NOT NULL,
+                    n INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL,
+                    PRIMARY KEY (metric_id, bucket)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS kv_state (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL);
+            """)
+            self._metric_ids = dict(self._conn.execute("SELECT name, id FROM metrics").fetchall())
+
+    def _metric_id(self, name):
+        """Returns the id for a metric name, creating it if needed. Caller holds _db_lock."""
+        metric_id = self._metric_ids.get(name)
+        if metric_id is None:
+            self._conn.execute("INSERT OR IGNORE INTO metrics (name) VALUES (?)", (name,))
+            metric_id = self._conn.execute("SELECT id FROM metrics WHERE name = ?", (name,)).fetchone()[0]
+            self._metric_ids[name] = metric_id
+        return metric_id
+
+    # --- Writes ---
+    def record(self, metric, value, ts=None):
+        """Queues one sample. Non-numeric/NaN values are ignored."""
+        if value is None or not isinstance(value, (int, float)) or value != value:
+            return
+        with self._pending_lock:
+            self._pending.append((metric, time.time() if ts is None else ts, float(value)))
+
+    def record_many(self, values, ts=None):
+        """Queues several metrics sharing one timestamp: {metric_name: value}."""
+        ts = time.time() if ts is None else ts
+        for metric, value in values.items():
+            self.record(metric, value, ts)
+
+    def flush(self):
+        """Writes the pending batch and updates rollups in a single transaction."""
+        with self._pending_lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+        with self._db_lock, self._conn:
+            rows = [(self._metric_id(metric), ts, value) for metric, ts, value in batch]
+            self._conn.executemany("INSERT INTO samples_raw (metric_id, ts, value) VALUES (?, ?, ?)", rows)
+            for table, width in self.ROLLUP_TIERS:
+                buckets = {}
+                for metric_id, ts, value in rows:
+                    key = (metric_id, int(ts // width) * width)
+                    agg = buckets.get(key)
+                    if agg is None: buckets[key] = [1, value, value, value]
+                    else: agg[0] += 1; agg[1] += value; agg[2] = min(agg[2], value); agg[3] = max(agg[3], value)
+                self._conn.executemany(
+                    f"""INSERT INTO {table} (metric_id, bucket, n, sum, min, max) VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (metric_id, bucket) DO UPDATE SET
+                            n = n + excluded.n, sum = sum + excluded.sum,
+                            min = MIN(min, excluded.min), max = MAX(max, excluded.max)""",
+                    [(k[0], k[1], a[0], a[1], a[2], a[3]) for k, a in buckets.items()],
+                )
+        return len(rows)
+
+    def prune(self):
+        """Deletes rows older than each tier's retention."""
+        now = time.time()
+        with self._db_lock, self._conn:
+            self._conn.execute("DELETE FROM samples_raw WHERE ts < ?", (now - self.retention_seconds["samples_raw"],))
+            for table, _width in self.ROLLUP_TIERS:
+                self._conn.execute(f"DELETE FROM {table} WHERE bucket < ?", (now - self.retention_seconds[table],))
+        self._last_prune = now
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+                if time.time() - self._last_prune > 600: self.prune()
+            except Exception:
+                print(f"Metrics store writer error: {traceback.format_exc()}")
+
+    def close(self):
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+    # --- Small persistent key/value state (JSON) for other subsystems ---
+    def save_state(self, key, value):
+        with self._db_lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv_state (key, value, updated) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()))
+
+    def load_state(self, key, default=None, max_age=None):
+        """Returns the saved JSON value for key, or default if missing (or older than max_age seconds)."""
+        with self._db_lock:
+            row = self._conn.execute("SELECT value, updated FROM kv_state WHERE key = ?", (key,)).fetchone()
+        if not row or (max_age is not None and time.time() - row[1] > max_age):
+            return default
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return default
+
+    # --- Reads ---
+    def list_metrics(self):
+        with self._db_lock:
+            return [name for (name,) in self._conn.execute("SELECT name FROM metrics ORDER BY name")]
+
+    def pick_resolution(self, start, end, max_points=50_000):
+        """Finest tier that covers [start, end] within retention and stays under max_points per metric."""
+        age = time.time() - start
+        span = max(1.0, end - start)
+        if age <= self.retention_seconds["samples_raw"] and span <= 6 * 3600:
+            return "raw"
+        for table, width in self.ROLLUP_TIERS:
+            if age <= self.retention_seconds[table] + width and span / width <= max_points:
+                return table
+        return "rollup_1h"
+
+    def query(self, metric, start, end=None, resolution="auto"):
+        """Range query. Returns (timestamps, values) NumPy arrays; rollups return bucket averages.
+
+        resolution: "auto", "raw", "rollup_1m" or "rollup_1h".
+        """
+        end = time.time() if end is None else end
+        if resolution == "auto":
+            resolution = self.pick_resolution(start, end)
+        with self._db_lock:
+            metric_id = self._metric_ids.get(metric)
+            if metric_id is None:
+                return np.empty(0), np.empty(0)
+            if resolution == "raw":
+                rows = self._conn.execute(
+                    "SELECT ts, value FROM samples_raw WHERE metric_id = ? AND ts BETWEEN ? AND ? ORDER BY ts",
+                    (metric_id, start, end)).fetchall()
+            else:
+                width = dict(self.ROLLUP_TIERS)[resolution]
+                rows = self._conn.execute(
+                    f"SELECT bucket, sum / n FROM {resolution} WHERE metric_id = ? AND bucket BETWEEN ? AND ? ORDER BY bucket",
+                    (metric_id, int(start // width) * width, end)).fetchall()
+        if not rows:
+            return np.empty(0), np.empty(0)
+        data = np.asarray(rows, dtype=np.float64)
+        return data[:, 0], data[:, 1]
+
+    def query_frame(self, metrics, start, end=None, resolution="auto"):
+        """Range query for several metrics as a DataFrame (datetime index, one column per metric)."""
+        end = time.time() if end is None else end
+        if resolution == "auto":
+            resolution = self.pick_resolution(start, end)
+        series = {}
+        for metric in metrics:
+            ts, values = self.query(metric, start, end, resolution)
+            if len(ts):
+                series[metric] = pd.Series(values, index=pd.to_datetime(ts, unit="s"))
+        return pd.DataFrame(series), resolution
+
+
+@st.cache_resource(show_spinner=False)
+def get_metrics_store(db_path, flush_interval=10.0, raw_retention_hours=48,
+                      minute_retention_days=30, hour_retention_days=365):
+    """One history store (and writer thread) per server process. Falls back to in-memory on error."""
+    try:
+        return MetricsStore(db_path, flush_interval, raw_retention_hours, minute_retention_days, hour_retention_days)
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warning: Could not open metrics history at {db_path} ({e}). Using in-memory history.")
+        return MetricsStore(":memory:", flush_interval, raw_retention_hours, minute_retention_days, hour_retention_days)
+
+
+def get_history_store():
+    """Returns the process-wide MetricsStore configured from optional [history] secrets."""
+    try:
+        history_secrets = st.secrets.get("history", {})
+        config = (
+            os.path.expanduser(history_secrets.get("db_path", "~/.cybernexus_q/metrics.db")),
+            float(history_secrets.get("flush_interval", 10.0)),
+            float(history_secrets.get("raw_retention_hours", 48)),
+            float(history_secrets.get("minute_retention_days", 30)),
+            float(history_secrets.get("hour_retention_days", 365)),
+        )
+    except Exception:
+        config = (os.path.expanduser("~/.cybernexus_q/metrics.db"),)
+    return get_metrics_store(*config)
+
+
+# --- Linux /proc Fast Path ---
+# /proc/net/dev columns (after "iface:") for each NIC_COUNTER_FIELDS entry, same mapping psutil uses
+PROC_NET_DEV_COLUMNS = (8, 0, 9, 1, 2, 10, 3, 11)
+TCP_STATES = {"01": "ESTABLISHED", "02": "SYN_SENT", "03": "SYN_RECV", "04": "FIN_WAIT1", "05": "FIN_WAIT2",
+              "06": "TIME_WAIT", "07": "CLOSE", "08": "CLOSE_WAIT", "09": "LAST_ACK", "0A": "LISTEN", "0B": "CLOSING"}
+
+def proc_fast_path_available():
+    return sys.platform.startswith("linux") and os.path.exists("/proc/net/dev") and os.path.exists("/proc/stat")
+
+
+class ProcFastPath:
+    """Linux-only collectors that parse /proc directly instead of going through psutil.
+
+    Each file is kept open (unbuffered) and re-read from offset 0 into one reusable
+    bytearray per file, so a poll allocates no file objects or namedtuples. Results
+    match what the psutil-based code produces (same fields, same formulas).
+    Not thread-safe by itself: give each collector thread its own instance.
+    """
+
+    def __init__(self, initial_buffer=16384):
+        self._files = {} # path -> open FileIO
+        self._buffers = {} # path -> bytearray, grown when a file outgrows it
+        self._initial_buffer = initial_buffer
+        self._prev_cpu = None # (total, busy) jiffies from the previous cpu_percent() call
+
+    def read(self, path):
+        """Returns the file's current content as bytes, read via readinto() into the reusable buffer."""
+        f = self._files.get(path)
+        if f is None:
+            f = self._files[path] = open(path, "rb", buffering=0)
+        buf = self._buffers.get(path)
+        if buf is None:
+            buf = self._buffers[path] = bytearray(self._initial_buffer)
+        while True:
+            f.seek(0)
+            n, total = 0, len(buf)
+            view = memoryview(buf)
+            while n < total:
+                got = f.readinto(view[n:])
+                if not got: break
+                n += got
+            if n < total:
+                return bytes(view[:n])
+            buf = self._buffers[path] = bytearray(total * 2) # Content filled the buffer: grow and re-read
+
+    def net_dev(self):
+        """(names tuple, uint64 array of NIC_COUNTER_FIELDS) from /proc/net/dev, like psutil pernic nowrap=False."""
+        names, tokens = [], []
+        for line in self.read("/proc/net/dev").splitlines()[2:]:
+            name, _, values = line.partition(b":")
+            names.append(name.strip().decode())
+            tokens.extend(map(int, values.split()[:16]))
+        table = np.array(tokens, dtype=np.uint64).reshape(len(names), 16)
+        return tuple(names), table[:, PROC_NET_DEV_COLUMNS]
+
+    def cpu_percent(self):
+        """System-wide CPU % since the previous call (0.0 on the first call), computed like psutil.cpu_percent()."""
+        fields = [int(v) for v in self.read("/proc/stat").split(b"\n", 1)[0].split()[1:]]
+        total = sum(fields) - sum(fields[8:10]) # guest/guest_nice are already counted in user/nice
+        busy = total - fields[3] - (fields[4] if len(fields) > 4 else 0) # minus idle and iowait
+        prev, self._prev_cpu = self._prev_cpu, (total, busy)
+        if prev is None or total <= prev[0]:
+            return 0.0
+        return round(min(100.0, max(0.0, (busy - prev[1]) / (total - prev[0]) * 100)), 1)
+
+    def virtual_memory(self):
+        """(percent, used, total) in bytes from /proc/meminfo, with psutil's used = total - available."""
+        values = {}
+        for line in self.read("/proc/meminfo").splitlines():
+            key, _, rest = line.partition(b":")
+            if key in (b"MemTotal", b"MemAvailable", b"MemFree"):
+                values[key] = int(rest.split()[0]) * 1024
+                if len(values) == 3: break
+        total = values[b"MemTotal"]
+        available = values.get(b"MemAvailable", values.get(b"MemFree", 0))
+        return round((total - available) / total * 100, 1) if total else 0.0, total - available, total
+
+    def tcp_sockets(self):
+        """[(family, local_ip, local_port, remote_ip, remote_port, state)] from /proc/net/tcp and tcp6 (no pid lookup)."""
+        sockets = []
+        for path, family in (("/proc/net/tcp", socket.AF_INET), ("/proc/net/tcp6", socket.AF_INET6)):
+            try: lines = self.read(path).splitlines()[1:]
+            except OSError: continue # e.g. IPv6 disabled
+            for line in lines:
+                parts = line.split(None, 4)
+                local, remote, state = parts[1].decode(), parts[2].decode(), parts[3].decode()
+                sockets.append((family, *self._decode_address(local, family), *self._decode_address(remote, family),
+                                TCP_STATES.get(state, state)))
+        return sockets
+
+    @staticmethod
+    def _decode_address(address, family):
+        ip_hex, port_hex = address.split(":")
+        raw = bytes.fromhex(ip_hex)
+        # The kernel prints each 32-bit word in host byte order
+        words = b"".join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4)) if sys.byteorder == "little" else raw
+        return socket.inet_ntop(family, words), int(port_hex, 16)
+
+
+def get_proc_fast_path_enabled():
+    """[metrics] proc_fast_path (default: on when /proc is available)."""
+    try: enabled = bool(st.secrets.get("metrics", {}).get("proc_fast_path", True))
+    except Exception: enabled = True
+    return enabled and proc_fast_path_available()
+
+
+@st.cache_resource(show_spinner=False)
+def get_shared_proc_fast_path():
+    """(ProcFastPath, lock) for on-demand readers in session threads (security audit, collector benchmark).
+
+    One instance keeps its file descriptors for the process; hold the lock while using it.
+    """
+    return ProcFastPath(), threading.Lock()
+
+
+def _tcp_socket_key(family, local_ip, local_port, remote_ip, remote_port, state):
+    if not remote_ip: remote_ip = "0.0.0.0" if family == socket.AF_INET else "::" # psutil leaves raddr empty
+    return local_ip, local_port, remote_ip, remote_port, state
+
+def _collectors_agree(psutil_fn, proc_fn, key, between):
+    """Reads psutil, /proc, psutil back to back; the /proc value must lie between the two psutil ones."""
+    before, proc_value, after = key(psutil_fn()), key(proc_fn()), key(psutil_fn())
+    return between(before, proc_value, after)
+
+def benchmark_collectors(iterations=200):
+    """Times the psutil collectors against ProcFastPath. Returns rows of {collector, psutil_us, proc_us, speedup, match}.
+
+    match compares like-for-like snapshots with no slack beyond what changed between
+    reads: /proc readings taken between two psutil readings must lie within them (NIC
+    counters, memory, socket sets), and both CPU % values cover the same 1 s window.
+    """
+    proc, proc_lock = get_shared_proc_fast_path()
+    def timed(fn):
+        fn() # Warm up (opens files, primes CPU baseline)
+        started = time.perf_counter()
+        for _ in range(iterations): fn()
+        return (time.perf_counter() - started) / iterations * 1e6
+    def same_cpu_window():
+        psutil.cpu_percent(interval=None); proc.cpu_percent() # Common baseline
+        time.sleep(1.0)
+        return abs(psutil.cpu_percent(interval=None) - proc.cpu_percent()) <= 1.0 # One jiffy per CPU of skew
+    within = lambda low, value, high: (np.minimum(low, high) <= value).all() and (value <= np.maximum(low, high)).all()
+    cases = [
+        ("NIC counters (net/dev)", lambda: CounterNormalizer.read_psutil(), proc.net_dev,
+         lambda: _collectors_agree(CounterNormalizer.read_psutil, proc.net_dev, lambda r: (r[0], r[1].astype(np.int64)),
+                                   lambda a, b, c: a[0] == b[0] == c[0] and within(a[1], b[1], c[1]))),
+        ("CPU % (stat)", lambda: psutil.cpu_percent(interval=None), proc.cpu_percent, same_cpu_window),
+        ("Memory (meminfo)", psutil.virtual_memory, proc.virtual_memory,
+         lambda: _collectors_agree(psutil.virtual_memory, proc.virtual_memory,
+                                   lambda r: np.array([r.total, r.total - r.available] if hasattr(r, "available") else [r[2], r[1]]),
+                                   lambda a, b, c: a[0] == b[0] == c[0] and within(a[1], b[1], c[1]))),
+        ("TCP sockets (net/tcp*)", lambda: psutil.net_connections(kind="tcp"), proc.tcp_sockets,
+         lambda: _collectors_agree(lambda: psutil.net_connections(kind="tcp"), proc.tcp_sockets,
+                                   lambda r: {_tcp_socket_key(s.family, s.laddr.ip, s.laddr.port, s.raddr.ip if s.raddr else None,
+                                                              s.raddr.port if s.raddr else 0, s.status) if hasattr(s, "laddr") else
+                                              _tcp_socket_key(*s) for s in r},
+                                   lambda a, b, c: a & c <= b <= a | c)),
+    ]
+    rows = []
+    with proc_lock:
+        for label, psutil_fn, proc_fn, same in cases:
+            try:
+                psutil_us, proc_us = timed(psutil_fn), timed(proc_fn)
+                rows.append({"collector": label, "psutil_us": psutil_us, "proc_us": proc_us,
+                             "speedup": psutil_us / proc_us if proc_us else float("nan"), "match": bool(same())})
+            except Exception as e:
+                rows.append({"collector": label, "psutil_us": None, "proc_us": None, "speedup": None, "match": f"error: {type(e).__name__}"})
+    return rows
+
+
+# --- Background System Metrics Sampler ---
+# Column layout of the sampler ring buffer (one row per sample)
+METRIC_COLUMNS = (
+    "timestamp", "cpu_percent", "ram_percent", "ram_used", "ram_total",
+    "disk_percent", "disk_used", "disk_total", "cpu_temp_c",
+    "net_rx_bps", "net_tx_bps",
+)
+_METRIC_INDEX = {name: i for i, name in enumerate(METRIC_COLUMNS)}
+
+
+class SystemMetricsSampler:
+    """Process-wide daemon thread sampling CPU/RAM/Disk/Temp into a preallocated NumPy ring buffer.
+
+    Readers (sidebar, chat actions) call latest() which is O(1) and never blocks on psutil.
+    """
+
+    def __init__(self, interval=2.0, capacity=1800, on_sample=None, counter_normalizer=None, proc=None):
+        self.on_sample = on_sample # Optional callback(sample_dict), e.g. the history store
+        self.counter_normalizer = counter_normalizer or CounterNormalizer() # Wrap/reset-safe NIC totals
+        self.proc = proc # Optional ProcFastPath (Linux): CPU/RAM straight from /proc instead of psutil
+        self.interval = max(0.2, float(interval))
+        self.capacity = max(2, int(capacity))
+        self._buffer = np.full((self.capacity, len(METRIC_COLUMNS)), np.nan, dtype=np.float64)
+        self._count = 0 # Total samples written (write slot = _count % capacity)
+        self._temp_display = "N/A"
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._last_error = None
+        self._temp_sensor = CpuTemperatureSensor() # Resolved once, then one file read per sample
+        self._prev_net = None # (monotonic time, bytes_recv, bytes_sent) for aggregate rates
+        self._read_cpu_percent() # Prime: first non-blocking call only sets the baseline
+        self._thread = threading.Thread(target=self._run, name="cnq-metrics-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self.sample_once()
+            except Exception as e:
+                if self._last_error != type(e).__name__: # Log each distinct error once
+                    print(f"Metrics sampler error: {traceback.format_exc()}")
+                    self._last_error = type(e).__name__
+            self._stop_event.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def _read_cpu_percent(self):
+        return self.proc.cpu_percent() if self.proc else psutil.cpu_percent(interval=None)
+
+    def _read_memory(self):
+        """(percent, used, total) in bytes."""
+        if self.proc: return self.proc.virtual_memory()
+        memory = psutil.virtual_memory()
+        return memory.percent, memory.used, memory.total
+
+    def sample_once(self):
+        """Takes one sample (non-blocking CPU reading since the previous call) and stores it."""
+        cpu_percent = self._read_cpu_percent()
+        ram_percent, ram_used, ram_total = self._read_memory()
+        disk = psutil.disk_usage("/") # A single statvfs() call either way
+        temp_celsius, temp_display = self._temp_sensor.read()
+        rx_bps, tx_bps = self._sample_network_rates()
+        row = (
+            time.time(), cpu_percent, ram_percent, ram_used, ram_total,
+            disk.percent, disk.used, disk.total, np.nan if temp_celsius is None else temp_celsius,
+            rx_bps, tx_bps,
+        )
+        with self._lock:
+            self._buffer[self._count % self.capacity] = row
+            self._count += 1
+            self._temp_display = temp_display
+        if self.on_sample:
+            self.on_sample(dict(zip(METRIC_COLUMNS, row)))
+        return row
+
+    def _sample_network_rates(self):
+        """Aggregate receive/transmit bits per second since the previous sample (NaN on first sample)."""
+        now = time.monotonic()
+        aggregate = self.counter_normalizer.read_aggregate() # Monotonic, even when NICs appear or disappear
+        recv, sent = (int(aggregate[NIC_COUNTER_FIELDS.index(f)]) for f in ("bytes_recv", "bytes_sent"))
+        prev, self._prev_net = self._prev_net, (now, recv, sent)
+        if prev is None or now - prev[0] <= 0:
+            return np.nan, np.nan
+        elapsed = now - prev[0]
+        return (recv - prev[1]) * 8 / elapsed, (sent - prev[2]) * 8 / elapsed
+
+    def latest(self):
+        """Returns the most recent sample as a dict (plus 'temp_display'), or None if no sample yet."""
+        with self._lock:
+            if self._count == 0:
+                return None
+            row = self._buffer[(self._count - 1) % self.capacity].copy()
+            temp_display = self._temp_display
+        sample = {name: float(row[i]) for i, name in enumerate(METRIC_COLUMNS)}
+        sample["temp_display"] = temp_display
+        return sample
+
+    def history(self, column=None, last_n=None):
+        """Returns samples in chronological order (a copy). Optionally one column and/or the last N rows."""
+        with self._lock:
+            n = min(self._count, self.capacity)
+            if last_n is not None: n = min(n, int(last_n))
+            end = self._count % self.capacity
+            idx = (np.arange(end - n, end) % self.capacity) if n else np.arange(0)
+            data = self._buffer[idx].copy()
+        if column is not None:
+            return data[:, _METRIC_INDEX[column]]
+        return data
+
+    def reconfigure(self, interval, capacity):
+        """Applies new settings in place; the thread keeps running. A new capacity keeps the newest samples."""
+        interval, capacity = max(0.2, float(interval)), max(2, int(capacity))
+        with self._lock:
+            self.interval = interval # Used from the next wait on
+            if capacity == self.capacity: return
+            kept = min(self._count, self.capacity, capacity)
+            idx = np.arange(self._count - kept, self._count) % self.capacity
+            buffer = np.full((capacity, len(METRIC_COLUMNS)), np.nan, dtype=np.float64)
+            buffer[:kept] = self._buffer[idx]
+            self._buffer, self.capacity, self._count = buffer, capacity, kept
+
+    def stop(self):
+        self._stop_event.set()
+
+
+@st.cache_resource(show_spinner=False)
+def _build_metrics_sampler():
+    """The process-wide sampler, built once; get_metrics_sampler() applies the current [metrics] settings to it."""
+    history_store = get_history_store()
+
+    def persist_sample(sample):
+        history_store.record_many({
+            "system.cpu_percent": sample["cpu_percent"], "system.ram_percent": sample["ram_percent"],
+            "system.disk_percent": sample["disk_percent"], "system.cpu_temp_c": sample["cpu_temp_c"],
+            "network.rx_bps": sample["net_rx_bps"], "network.tx_bps": sample["net_tx_bps"],
+        }, ts=sample["timestamp"])
+
+    return SystemMetricsSampler(on_sample=persist_sample, counter_normalizer=get_counter_normalizer(),
+                                proc=ProcFastPath() if get_proc_fast_path_enabled() else None)
+
+def get_metrics_sampler(interval=2.0, capacity=1800):
+    """One sampler thread per server process (shared by all sessions). Samples are also persisted.
+
+    The cache is not keyed on the settings: changing [metrics] reconfigures the running
+    sampler instead of starting a second thread and leaking the first.
+    """
+    sampler = _build_metrics_sampler()
+    if (max(0.2, float(interval)), max(2, int(capacity))) != (sampler.interval, sampler.capacity):
+        sampler.reconfigure(interval, capacity)
+    return sampler
+
+
+def get_metrics_sampler_config():
+    """Reads optional [metrics] settings from secrets: sample_interval (s) and history_size (samples)."""
+    try:
+        metrics_secrets = st.secrets.get("metrics", {})
+        interval = float(metrics_secrets.get("sample_interval", 2.0))
+        capacity = int(metrics_secrets.get("history_size", 1800))
+    except Exception:
+        interval, capacity = 2.0, 1800
+    return interval, capacity
+
+
+def get_pi_status():
+    """Gets basic system status from the background sampler's latest sample (O(1), non-blocking)."""
+    sampler = get_metrics_sampler(*get_metrics_sampler_config())
+    sample = sampler.latest()
+    if sample is None: # Sampler just started, take the first sample inline
+        sampler.sample_once()
+        sample = sampler.latest()
+
     # Format RAM/Disk nicely
-    ram_gb_used = memory.used / (1024**3)
-    ram_gb_total = memory.total / (1024**3)
-    disk_gb_used = disk.used / (1024**3)
-    disk_gb_total = disk.total / (1024**3)
+    ram_gb_used = sample["ram_used"] / (1024**3)
+    ram_gb_total = sample["ram_total"] / (1024**3)
+    disk_gb_used = sample["disk_used"] / (1024**3)
+    disk_gb_total = sample["disk_total"] / (1024**3)
 
     return {
-        "cpu_usage": f"{cpu_percent:.1f}%",
-        "ram_usage": f"{memory_percent:.1f}% ({ram_gb_used:.1f}/{ram_gb_total:.1f} GiB)",
-        "disk_usage": f"{disk_percent:.1f}% ({disk_gb_used:.1f}/{disk_gb_total:.1f} GiB)",
-        "cpu_temperature": f"{cpu_temp} {temp_details}".strip(),
+        "cpu_usage": f"{sample['cpu_percent']:.1f}%",
+        "ram_usage": f"{sample['ram_percent']:.1f}% ({ram_gb_used:.1f}/{ram_gb_total:.1f} GiB)",
+        "disk_usage": f"{sample['disk_percent']:.1f}% ({disk_gb_used:.1f}/{disk_gb_total:.1f} GiB)",
+        "cpu_temperature": sample["temp_display"],
     }
 
 
@@ -1050,79 +2403,261 @@ def format_interface_details_psutil(iface_info, interface_name):
     return details
 
 
-@st.cache_data(ttl=300)  # Cache initial network status for 5 minutes
-def get_initial_network_status():
-    """Gets INITIAL network speed, external IP. Run once or infrequently. Uses cache."""
-    results = {
-         "download_speed": None, "upload_speed": None, "ping": None,
-         "speedtest_server": None, "client_isp": None, "speedtest_error": None,
-         "external_ip": None, "external_ip_error": None
-         }
-    # --- Speed Test ---
+# --- External IP Lookup ---
+DEFAULT_EXTERNAL_IP_SERVICES = [
+    'https://api.ipify.org?format=json',
+    'https://ipinfo.io/json',
+    'https://checkip.amazonaws.com/',
+    'https://httpbin.org/ip',
+]
+
+def _parse_external_ip(response):
+    """Extracts a valid IP from a JSON ({'ip'} / {'origin'}) or plain-text IP service response."""
     try:
-        st_cli = speedtest.Speedtest(secure=True, timeout=25) # Allow reasonable time
-        st_cli.get_best_server() # This can take time
-        st_cli.download(threads=None) # Use Speedtest default threads
-        st_cli.upload(threads=None)
-        results["download_speed"] = st_cli.results.download / 1_000_000
-        results["upload_speed"] = st_cli.results.upload / 1_000_000
-        results["ping"] = st_cli.results.ping
-        results["speedtest_server"] = st_cli.results.server.get("name", "N/A") # Use .get
-        results["client_isp"] = st_cli.results.client.get("isp", "N/A")
-    except speedtest.SpeedtestException as e:
-        results["speedtest_error"] = f"Speedtest Error: {e}" # Include error message
-    except Exception as e:
-        results["speedtest_error"] = f"General Error during Speedtest: {type(e).__name__}"
-        print(f"Speedtest Error Traceback: {traceback.format_exc()}") # Log details
+        ip_data = response.json()
+        candidate = (ip_data.get('ip') or ip_data.get('origin', '').split(',')[0]) if isinstance(ip_data, dict) else ''
+    except ValueError: # Plain text body (e.g. checkip.amazonaws)
+        candidate = response.content.decode('ascii', 'ignore') # IPs are ASCII; avoid charset guessing
+    try:
+        return str(ipaddress.ip_address(str(candidate).strip()))
+    except ValueError:
+        return None
 
-    # --- External IP ---
-    external_ip = "N/A"
-    ext_ip_error = None
-    ip_services = [ # Try multiple services
-        'https://api.ipify.org?format=json',
-        'https://ipinfo.io/json',
-        'https://checkip.amazonaws.com/',
-        'https://httpbin.org/ip'
-    ]
-    for service_url in ip_services:
-         try:
-             response = requests.get(service_url, timeout=6)
-             response.raise_for_status()
-             # Parse based on service
-             if 'ipify' in service_url or 'httpbin' in service_url or 'ipinfo' in service_url:
-                 ip_data = response.json()
-                 if 'ip' in ip_data: external_ip = ip_data['ip']; break
-                 if 'origin' in ip_data: external_ip = ip_data['origin'].split(',')[0].strip(); break
-             elif 'amazonaws' in service_url:
-                 potential_ip = response.text.strip()
-                 if re.match(r"^\d{1,3}(\.\d{1,3}){3}$", potential_ip) or ':' in potential_ip: # Basic IP check
-                      external_ip = potential_ip; break
-         except requests.exceptions.Timeout: ext_ip_error = f"Ext. IP Timeout ({service_url.split('/')[2]})"
-         except requests.exceptions.RequestException: ext_ip_error = f"Ext. IP Req Error ({service_url.split('/')[2]})"
-         except json.JSONDecodeError: ext_ip_error = f"Ext. IP JSON Error ({service_url.split('/')[2]})"
-         except Exception as e: ext_ip_error = f"Ext. IP Error ({type(e).__name__})"
-         # Keep trying next service if error or IP still N/A
-         if external_ip != "N/A": break # Stop if found
-
-    results["external_ip"] = external_ip
-    # Assign error only if IP remains N/A after trying all services
-    results["external_ip_error"] = ext_ip_error if external_ip == "N/A" else None
 
+class ExternalIpResolver:
+    """Races several "what is my IP" services and returns the first valid answer.
+
+    The service that won last time gets a short head start; if it answers within
+    head_start seconds the others are never contacted. Otherwise all remaining
+    services are queried concurrently and the slower requests are abandoned (their
+    daemon threads finish on their own within timeout). The winner is remembered
+    in the history store so it is tried first after a restart too.
+    """
+    STATE_KEY = "external_ip.preferred_service"
+
+    def __init__(self, services=None, timeout=6.0, head_start=0.3, store=None):
+        self.services = list(services or DEFAULT_EXTERNAL_IP_SERVICES)
+        self.timeout = float(timeout)
+        self.head_start = float(head_start)
+        self.store = store
+        self.preferred = store.load_state(self.STATE_KEY) if store else None
+        self.last_timings = {} # service URL -> seconds (or error string) from the last race
+
+    def _ordered_services(self):
+        if self.preferred in self.services:
+            return [self.preferred] + [url for url in self.services if url != self.preferred]
+        return list(self.services)
+
+    def _query(self, url, answers, stop):
+        if stop.is_set(): return # Race already decided before this service was launched
+        start = time.perf_counter()
+        host = url.split('/')[2] if '//' in url else url
+        try:
+            response = requests.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            ip = _parse_external_ip(response)
+            answers.put((url, ip, None if ip else f"Ext. IP Invalid Response ({host})", time.perf_counter() - start))
+        except requests.exceptions.Timeout: answers.put((url, None, f"Ext. IP Timeout ({host})", None))
+        except requests.exceptions.RequestException: answers.put((url, None, f"Ext. IP Req Error ({host})", None))
+        except Exception as e: answers.put((url, None, f"Ext. IP Error ({type(e).__name__})", None))
+
+    def resolve(self):
+        """Returns (ip, service_url, error). ip/service_url are None if every service failed."""
+        services = self._ordered_services()
+        if not services: return None, None, "No external IP services configured."
+        answers, stop = queue.Queue(), threading.Event()
+        launched, pending, last_error = 0, 0, None
+        self.last_timings = {}
+
+        def launch(urls):
+            nonlocal launched, pending
+            for url in urls:
+                threading.Thread(target=self._query, args=(url, answers, stop), daemon=True, name="external-ip").start()
+            launched += len(urls); pending += len(urls)
+
+        launch(services[:1])
+        deadline = time.monotonic() + self.timeout + self.head_start + 1.0
+        while pending:
+            wait = self.head_start if launched == 1 and len(services) > 1 else deadline - time.monotonic()
+            try:
+                url, ip, error, elapsed = answers.get(timeout=max(0.0, wait))
+            except queue.Empty:
+                if launched < len(services): launch(services[launched:]); continue # Head start expired: hedge
+                break # Overall deadline reached
+            pending -= 1
+            self.last_timings[url] = elapsed if ip else error
+            if ip:
+                stop.set() # Services not yet started skip their request
+                if url != self.preferred:
+                    self.preferred = url
+                    if self.store: self.store.save_state(self.STATE_KEY, url)
+                return ip, url, None
+            last_error = error
+            if launched < len(services) and pending == 0: launch(services[launched:]) # Preferred failed fast
+        stop.set()
+        return None, None, last_error or "Ext. IP lookup timed out."
+
+
+@st.cache_resource(show_spinner=False)
+def get_external_ip_resolver_cached(services, timeout, head_start):
+    return ExternalIpResolver(services, timeout, head_start, store=get_history_store())
+
+def get_external_ip_resolver():
+    """Process-wide resolver configured from optional [network] secrets."""
+    try:
+        network_secrets = st.secrets.get("network", {})
+        services = tuple(network_secrets.get("external_ip_services", DEFAULT_EXTERNAL_IP_SERVICES))
+        timeout = float(network_secrets.get("external_ip_timeout", 6.0))
+        head_start = float(network_secrets.get("external_ip_head_start", 0.3))
+    except Exception:
+        services, timeout, head_start = tuple(DEFAULT_EXTERNAL_IP_SERVICES), 6.0, 0.3
+    return get_external_ip_resolver_cached(services, timeout, head_start)
+
+
+@st.cache_data(ttl=300)  # Cache external IP lookup for 5 minutes
+def get_initial_network_status():
+    """Gets the external IP (services raced in parallel). Uses cache.
+
+    The speedtest is no longer part of this scan: it runs as a background job
+    (see start_speedtest_job) and get_network_overview() merges in its last result.
+    """
+    results = {"external_ip": None, "external_ip_error": None}
+    external_ip, _service, ext_ip_error = get_external_ip_resolver().resolve()
+    results["external_ip"] = external_ip or "N/A"
+    # Assign error only if no service returned a valid IP
+    results["external_ip_error"] = ext_ip_error if not external_ip else None
     return results
 
 
+def get_network_overview():
+    """External IP plus the last stored speedtest result, in the format the UI and chat actions expect."""
+    overview = {
+         "download_speed": None, "upload_speed": None, "ping": None,
+         "speedtest_server": None, "client_isp": None, "speedtest_error": None,
+         "speedtest_finished": None,
+         }
+    last = get_last_speedtest_result()
+    if last:
+        for key in ("download_speed", "upload_speed", "ping", "speedtest_server", "client_isp"):
+            overview[key] = last.get(key)
+        overview["speedtest_error"] = last.get("error")
+        overview["speedtest_finished"] = last.get("finished")
+    overview.update(get_initial_network_status())
+    return overview
+
+
+# --- NIC Counter Normalization ---
+NIC_COUNTER_FIELDS = ("bytes_sent", "bytes_recv", "packets_sent", "packets_recv", "errin", "errout", "dropin", "dropout")
+COUNTER_MASK_32 = 0xFFFFFFFF
+
+class CounterNormalizer:
+    """Turns raw kernel NIC counters into monotonic 64-bit totals per interface.
+
+    Raw counters (psutil nowrap=False) can go backwards for two reasons:
+      - wrap: 32-bit counters (older ARM kernels/drivers) wrap at 2^32, 64-bit ones at 2^64.
+        A field that has never exceeded 2^32 is treated as 32-bit; the delta is taken
+        modulo the counter width, so a busy interval is not lost.
+      - reset: the interface was re-created (Linux ifindex changed) or most of its
+        traffic counters dropped at once; counting restarts from zero, so the new raw
+        value is the delta.
+    The aggregate (read_aggregate) only accumulates deltas of interfaces seen before, so
+    a new NIC (docker/veth) adds its traffic from then on rather than its whole raw
+    counter, and a departed NIC keeps its last totals instead of dropping out of the sum.
+    All interfaces are processed in one vectorized step. Reading and updating happen
+    under one lock, so concurrent callers (sampler, monitor, sessions) cannot feed
+    readings out of order.
+    """
+    TRAFFIC_FIELDS = 4 # The first four NIC_COUNTER_FIELDS: bytes/packets sent/recv
+
+    def __init__(self, proc=None):
+        self._lock = threading.Lock()
+        self._state = {} # name -> (raw uint64[8], totals uint64[8], seen_64bit bool[8], ifindex)
+        self.proc = proc # Optional ProcFastPath: parse /proc/net/dev directly (used under self._lock)
+        self._aggregate = None # uint64[8]: all interfaces ever seen, starting from the first read's totals
+        self.wraps = 0
+        self.resets = 0
+
+    def read_raw(self):
+        """(names tuple, uint64 array of NIC_COUNTER_FIELDS) straight from the kernel, without psutil's wrap fix-up."""
+        return self.proc.net_dev() if self.proc else self.read_psutil()
+
+    @staticmethod
+    def read_psutil():
+        pernic = psutil.net_io_counters(pernic=True, nowrap=False)
+        names = tuple(pernic)
+        raw = np.array([[getattr(pernic[name], field) for field in NIC_COUNTER_FIELDS] for name in names],
+                       dtype=np.uint64).reshape(len(names), len(NIC_COUNTER_FIELDS))
+        return names, raw
+
+    @staticmethod
+    def read_ifindex(name):
+        try:
+            with open(f"/sys/class/net/{name}/ifindex") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def read(self):
+        """Reads all NICs and returns (names, monotonic totals as a uint64 array aligned with names)."""
+        with self._lock:
+            names, raw = self.read_raw()
+            return names, self._absorb(names, raw)
+
+    def read_aggregate(self):
+        """Reads all NICs and returns the monotonic totals summed over every interface seen so far (uint64 array)."""
+        with self._lock:
+            names, raw = self.read_raw()
+            self._absorb(names, raw)
+            return self._aggregate.copy()
+
+    def _absorb(self, names, raw):
+        known = np.array([name in self._state for name in names], dtype=bool)
+        prev = raw.copy()
+        totals = raw.copy()
+        wide = raw > COUNTER_MASK_32
+        for i, name in enumerate(names):
+            if known[i]:
+                prev[i], totals[i], seen_wide, _ = self._state[name]
+                wide[i] |= seen_wide
+        decreased = known[:, None] & (raw < prev)
+        delta = raw - prev # uint64 arithmetic: a decrease is already the modulo-2^64 wrap delta
+        wrap_32 = decreased & ~wide
+        delta = np.where(wrap_32, delta & np.uint64(COUNTER_MASK_32), delta)
+
+        reset = decreased[:, :self.TRAFFIC_FIELDS].sum(axis=1) >= 3
+        ifindexes = {}
+        for i in np.nonzero(decreased.any(axis=1) | ~known)[0]: # ifindex only read when something looks off
+            ifindexes[names[i]] = self.read_ifindex(names[i])
+            old_ifindex = self._state[names[i]][3] if known[i] else None
+            if known[i] and None not in (old_ifindex, ifindexes[names[i]]) and old_ifindex != ifindexes[names[i]]:
+                reset[i] = True
+        delta[reset] = raw[reset]
+        totals = np.where(known[:, None], totals + delta, raw)
+        if self._aggregate is None: self._aggregate = totals.sum(axis=0, dtype=np.uint64)
+        else: self._aggregate = self._aggregate + np.where(known[:, None], delta, np.uint64(0)).sum(axis=0, dtype=np.uint64) # New NICs start at a zero delta
+
+        self.resets += int(reset.sum())
+        self.wraps += int((decreased & ~reset[:, None]).sum())
+        for i, name in enumerate(names):
+            ifindex = ifindexes.get(name, self._state[name][3] if known[i] else None)
+            self._state[name] = (raw[i], totals[i], wide[i], ifindex)
+        return totals
+
+
+@st.cache_resource(show_spinner=False)
+def get_counter_normalizer():
+    """One normalizer per server process: every consumer sees the same monotonic totals."""
+    return CounterNormalizer(proc=ProcFastPath() if get_proc_fast_path_enabled() else None)
+
+
 def get_network_io_stats():
-    """Retrieves network I/O statistics using psutil."""
+    """Aggregate network I/O totals (wrap/reset-normalized, summed over all interfaces seen so far)."""
     try:
-        net_io = psutil.net_io_counters()
+        aggregate = get_counter_normalizer().read_aggregate() # Stable when NICs come and go
         # Return only the necessary fields plus timestamp
-        return {
-            "bytes_sent": net_io.bytes_sent, "bytes_recv": net_io.bytes_recv,
-            "packets_sent": net_io.packets_sent, "packets_recv": net_io.packets_recv,
-            "errin": net_io.errin, "errout": net_io.errout,
-            "dropin": net_io.dropin, "dropout": net_io.dropout,
-            "timestamp": time.monotonic(), # Use monotonic for accurate interval calculation
-        }
+        stats = {field: int(value) for field, value in zip(NIC_COUNTER_FIELDS, aggregate)}
+        stats["timestamp"] = time.monotonic() # Use monotonic for accurate interval calculation
+        return stats
     except Exception as e:
         # Log the error once to avoid spamming
         if 'network_io_error_logged' not in st.session_state:
@@ -1144,9 +2679,13 @@ def format_bytes(size):
     else: return f"{size:.1f} {power_labels[n]}" # KiB+, 1 decimal
 
 
-def analyze_network_traffic(prev_stats, current_stats):
-    """Analyzes network traffic changes based on psutil IO counters."""
-    anomalies = []
+def analyze_network_traffic(prev_stats, current_stats, adaptive_anomalies=None):
+    """Analyzes network traffic changes based on psutil IO counters.
+
+    adaptive_anomalies: optional per-interface findings from TrafficAnomalyDetector,
+    reported alongside the fixed error/drop thresholds.
+    """
+    anomalies = [f"{a['label']} on {a['interface']} ({a['z']:.1f}σ above baseline)" for a in (adaptive_anomalies or [])]
     if not prev_stats or not current_stats:
         return "Insufficient data points for rate analysis."
     if not isinstance(prev_stats, dict) or not isinstance(current_stats, dict):
@@ -1162,15 +2701,14 @@ def analyze_network_traffic(prev_stats, current_stats):
     interval_warning = ""
     if time_diff > 60: interval_warning = f"_(Interval: {time_diff:.0f}s)_" # Note long interval
 
-    # Calculate differences, handle potential counter wraps/resets (max(0, ...))
-    bytes_sent_diff = max(0, current_stats["bytes_sent"] - prev_stats["bytes_sent"])
-    bytes_recv_diff = max(0, current_stats["bytes_recv"] - prev_stats["bytes_recv"])
-    packet_sent_diff = max(0, current_stats["packets_sent"] - prev_stats["packets_sent"])
-    packet_recv_diff = max(0, current_stats["packets_recv"] - prev_stats["packets_recv"])
-    errin_diff = max(0, current_stats["errin"] - prev_stats["errin"])
-    errout_diff = max(0, current_stats["errout"] - prev_stats["errout"])
-    dropin_diff = max(0, current_stats["dropin"] - prev_stats["dropin"])
-    dropout_diff = max(0, current_stats["dropout"] - prev_stats["dropout"])
+    # Calculate differences. get_network_io_stats() totals are already wrap/reset-normalized (CounterNormalizer),
+    # so a decrease can only mean the two readings came from different processes: report it instead of clamping.
+    diffs = {key: current_stats[key] - prev_stats[key] for key in required_keys if key != "timestamp"}
+    if any(diff < 0 for diff in diffs.values()): return "Counters went backwards (baseline reset). Waiting for next interval."
+    bytes_sent_diff, bytes_recv_diff = diffs["bytes_sent"], diffs["bytes_recv"]
+    packet_sent_diff, packet_recv_diff = diffs["packets_sent"], diffs["packets_recv"]
+    errin_diff, errout_diff = diffs["errin"], diffs["errout"]
+    dropin_diff, dropout_diff = diffs["dropin"], diffs["dropout"]
 
     # Calculate rates per second
     sent_rate_mbps = (bytes_sent_diff * 8) / (time_diff * 1_000_000)
@@ -1185,7 +2723,7 @@ def analyze_network_traffic(prev_stats, current_stats):
     # --- Classical Thresholds (Adjust based on typical network behavior) ---
     error_rate_threshold = 5 # Errors per second
     drop_rate_threshold = 10 # Drops per second
-    # Add more potential anomaly checks here? E.g., unexpected bandwidth spike?
+    # Bandwidth/PPS spikes are judged per interface against learned baselines (adaptive_anomalies)
 
     if error_rate_in > error_rate_threshold: anomalies.append(f"High Input Error Rate ({error_rate_in:.1f}/s)")
     if error_rate_out > error_rate_threshold: anomalies.append(f"High Output Error Rate ({error_rate_out:.1f}/s)")
@@ -1206,10 +2744,943 @@ def analyze_network_traffic(prev_stats, current_stats):
 
 
 
+
+# --- Per-Interface Traffic Monitor ---
+NIC_RATE_COLUMNS = ("tx_bps", "rx_bps", "tx_pps", "rx_pps", "errin_ps", "errout_ps", "dropin_ps", "dropout_ps")
+NIC_RATE_SCALE = (8, 8, 1, 1, 1, 1, 1, 1) # Bytes -> bits for the first two columns (broadcast over rates)
+
+class InterfaceTrafficMonitor:
+    """Daemon thread computing per-NIC rates from psutil.net_io_counters(pernic=True).
+
+    All interfaces are handled in one vectorized pass: counters for every NIC go into
+    one (n_interfaces, 8) array and rates are (current - previous) / elapsed. Rates are
+    kept in a preallocated ring buffer of shape (capacity, n_interfaces, 8); the
+    interface axis grows when a new NIC appears. Readers never call psutil.
+    """
+
+    def __init__(self, interval=2.0, capacity=600, on_rates=None, normalizer=None):
+        self.on_rates = on_rates # Optional callback(wall_time, names, rates), e.g. the anomaly detector
+        self.normalizer = normalizer or CounterNormalizer() # Wrap/reset-safe monotonic totals
+        self.interval = max(0.5, float(interval))
+        self.capacity = max(2, int(capacity))
+        self.interfaces = [] # Column order of the interface axis
+        self._times = np.full(self.capacity, np.nan, dtype=np.float64)
+        self._rates = np.full((self.capacity, 0, len(NIC_RATE_COLUMNS)), np.nan, dtype=np.float64)
+        self._count = 0
+        self._prev = None # (monotonic time, names tuple, counters array)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._last_error = None
+        self._thread = threading.Thread(target=self._run, name="cnq-nic-monitor", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self.poll()
+            except Exception as e:
+                if self._last_error != type(e).__name__: # Log each distinct error once
+                    print(f"Interface monitor error: {traceback.format_exc()}")
+                    self._last_error = type(e).__name__
+            self._stop_event.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def read_counters(self):
+        """Returns (interface names tuple, float64 array of monotonic NIC_COUNTER_FIELDS totals per interface)."""
+        names, totals = self.normalizer.read()
+        return names, totals.astype(np.float64)
+
+    def poll(self):
+        """Reads counters once and appends one row of per-NIC rates (nothing on the first poll)."""
+        now, wall = time.monotonic(), time.time()
+        names, counters = self.read_counters()
+        prev, self._prev = self._prev, (now, names, counters)
+        if prev is None or now - prev[0] <= 0:
+            return None
+        prev_time, prev_names, prev_counters = prev
+        if prev_names != names: # NIC added/removed: align previous counters by name
+            index = {name: i for i, name in enumerate(prev_names)}
+            aligned = np.full_like(counters, np.nan)
+            for i, name in enumerate(names):
+                if name in index: aligned[i] = prev_counters[index[name]]
+            prev_counters = aligned
+        rates = (counters - prev_counters) / (now - prev_time) * NIC_RATE_SCALE # Totals are monotonic: no clamping
+        self._append(wall, names, rates)
+        if self.on_rates:
+            self.on_rates(wall, names, rates)
+        return rates
+
+    def _append(self, wall, names, rates):
+        with self._lock:
+            missing = [name for name in names if name not in self.interfaces]
+            if missing: # Grow the interface axis; older rows stay NaN for new NICs
+                grown = np.full((self.capacity, len(self.interfaces) + len(missing), len(NIC_RATE_COLUMNS)), np.nan)
+                grown[:, :len(self.interfaces)] = self._rates
+                self._rates, self.interfaces = grown, self.interfaces + missing
+            slot = self._count % self.capacity
+            self._rates[slot] = np.nan
+            self._rates[slot, [self.interfaces.index(name) for name in names]] = rates
+            self._times[slot] = wall
+            self._count += 1
+
+    def _window(self, last_n=None):
+        n = min(self._count, self.capacity)
+        if last_n is not None: n = min(n, int(last_n))
+        end = self._count % self.capacity
+        return (np.arange(end - n, end) % self.capacity) if n else np.arange(0)
+
+    def latest(self):
+        """Latest rates as {interface: {rate column: value}} (NaN-free interfaces only), or {} before 2 polls."""
+        with self._lock:
+            if self._count == 0: return {}
+            row = self._rates[(self._count - 1) % self.capacity].copy()
+            names = list(self.interfaces)
+        return {name: dict(zip(NIC_RATE_COLUMNS, row[i].tolist())) for i, name in enumerate(names) if not np.isnan(row[i]).any()}
+
+    def history(self, column, interfaces=None, last_n=None):
+        """DataFrame (time index, one column per interface) of one rate column over the window."""
+        with self._lock:
+            idx = self._window(last_n)
+            times = self._times[idx].copy()
+            values = self._rates[idx, :, NIC_RATE_COLUMNS.index(column)].copy()
+            names = list(self.interfaces)
+        frame = pd.DataFrame(values, index=pd.to_datetime(times, unit="s"), columns=names)
+        return frame[[name for name in interfaces if name in names]] if interfaces is not None else frame
+
+
+class TrafficAnomalyDetector:
+    """Streaming per-interface, per-metric baseline (EWMA mean/variance) that scores each sample in O(1).
+
+    observe() takes one (n_interfaces, 8) rate array from InterfaceTrafficMonitor and
+    updates every baseline in one vectorized step. A value is anomalous when it is
+    above the baseline by more than `threshold` standard deviations (with a per-metric
+    noise floor, so idle links don't alarm on a few packets). With seasonal=True a
+    second baseline is kept per hour of day and used once it has warmed up. Flagged
+    samples only nudge the baseline, so a flood doesn't become the new normal.
+    The state is saved to the history store and reloaded, so scoring starts
+    from the first sample after a restart.
+    """
+    STATE_KEY = "traffic.anomaly_baseline"
+    STD_FLOOR = (64_000, 64_000, 20, 20, 0.5, 0.5, 0.5, 0.5) # Per NIC_RATE_COLUMNS: 8 KB/s, 20 pps, 0.5 err|drop/s
+    LABELS = ("Tx bandwidth spike", "Rx bandwidth spike", "Tx packet flood", "Rx packet flood",
+              "Input error burst", "Output error burst", "Input drop burst", "Output drop burst")
+
+    def __init__(self, half_life=300.0, interval=2.0, threshold=4.0, warmup=30, seasonal=False, store=None, save_interval=60.0):
+        self.alpha = 1.0 - 0.5 ** (float(interval) / max(float(half_life), float(interval)))
+        self.threshold = float(threshold)
+        self.warmup = int(warmup)
+        self.seasonal = bool(seasonal)
+        self.store = store
+        self.save_interval = float(save_interval)
+        self.interfaces = []
+        # Baseline arrays: index 0 is the all-day baseline, 1..24 the hour-of-day baselines
+        self._mean = np.zeros((25, 0, len(NIC_RATE_COLUMNS)))
+        self._var = np.zeros_like(self._mean)
+        self._n = np.zeros_like(self._mean)
+        self._lock = threading.Lock()
+        self._last_saved = time.monotonic()
+        self.last_anomalies = [] # From the latest observe()
+        self.last_observed = None
+        self.recent = collections.deque(maxlen=50) # Latest flagged anomalies, newest last
+        if store is not None:
+            self._load(store.load_state(self.STATE_KEY))
+
+    def _columns_for(self, names):
+        missing = [name for name in names if name not in self.interfaces]
+        if missing:
+            pad = ((0, 0), (0, len(missing)), (0, 0))
+            self._mean, self._var, self._n = (np.pad(a, pad) for a in (self._mean, self._var, self._n))
+            self.interfaces = self.interfaces + missing
+        return [self.interfaces.index(name) for name in names]
+
+    def observe(self, wall, names, rates):
+        """Scores then learns one sample of rates (shape (len(names), 8)); returns the anomalies found."""
+        rates = np.asarray(rates, dtype=np.float64)
+        with self._lock:
+            cols = self._columns_for(names)
+            layers = [0, 1 + time.localtime(wall).tm_hour] if self.seasonal else [0]
+            mean, var, n = self._mean[layers][:, cols], self._var[layers][:, cols], self._n[layers][:, cols]
+            # Score against the hour-of-day baseline where it is warm, else the all-day one
+            base_mean, base_var = mean[0], var[0]
+            if self.seasonal:
+                hour_warm = n[1] >= self.warmup
+                base_mean, base_var = np.where(hour_warm, mean[1], mean[0]), np.where(hour_warm, var[1], var[0])
+            std = np.maximum(np.sqrt(base_var), np.asarray(self.STD_FLOOR) + 0.1 * base_mean)
+            z = (rates - base_mean) / std
+            flagged = (z > self.threshold) & (n[0] >= self.warmup) & ~np.isnan(rates)
+            # EWMA update (flagged samples use a 10x smaller step); alpha grows to 1/n during warmup
+            alpha = np.maximum(self.alpha, 1.0 / (n + 1)) * np.where(flagged, 0.1, 1.0)
+            diff = np.nan_to_num(rates - mean)
+            valid = ~np.isnan(rates)
+            mean = mean + np.where(valid, alpha * diff, 0)
+            var = np.where(valid, (1 - alpha) * (var + alpha * diff * diff), var)
+            n = n + valid
+            for k, layer in enumerate(layers):
+                self._mean[layer, cols], self._var[layer, cols], self._n[layer, cols] = mean[k], var[k], n[k]
+            anomalies = [{
+                "interface": names[i], "metric": NIC_RATE_COLUMNS[j], "label": self.LABELS[j],
+                "value": float(rates[i, j]), "baseline": float(base_mean[i, j]),
+                "z": float(z[i, j]), "time": wall,
+            } for i, j in zip(*np.nonzero(flagged))]
+            self.last_anomalies, self.last_observed = anomalies, wall
+            self.recent.extend(anomalies)
+        if self.store is not None and time.monotonic() - self._last_saved >= self.save_interval:
+            self.save()
+        return anomalies
+
+    def save(self):
+        with self._lock:
+            state = {"interfaces": self.interfaces, "alpha": self.alpha,
+                     "mean": self._mean.tolist(), "var": self._var.tolist(), "n": self._n.tolist()}
+        self.store.save_state(self.STATE_KEY, state)
+        self._last_saved = time.monotonic()
+
+    def _load(self, state):
+        try:
+            mean, var, n = (np.asarray(state[key], dtype=np.float64) for key in ("mean", "var", "n"))
+            if mean.shape != (25, len(state["interfaces"]), len(NIC_RATE_COLUMNS)) or var.shape != mean.shape or n.shape != mean.shape:
+                return
+            self.interfaces, self._mean, self._var, self._n = list(state["interfaces"]), mean, var, n
+        except (TypeError, KeyError, ValueError):
+            return # No or incompatible saved baseline: learn from scratch
+
+    def current_anomalies(self, max_age):
+        """Anomalies from the latest sample, if it is no older than max_age seconds."""
+        if self.last_observed is None or time.time() - self.last_observed > max_age:
+            return []
+        return list(self.last_anomalies)
+
+    def recent_anomalies(self):
+        """Copy of the latest flagged anomalies, newest first (safe while the monitor thread observes)."""
+        with self._lock:
+            return list(reversed(self.recent))
+
+
+@st.cache_resource(show_spinner=False)
+def get_interface_monitor(interval=2.0, capacity=600, anomaly_threshold=4.0, anomaly_half_life=300.0, anomaly_seasonal=False):
+    """One per-NIC traffic monitor thread (and anomaly detector) per server process, started on first use."""
+    detector = TrafficAnomalyDetector(half_life=anomaly_half_life, interval=interval, threshold=anomaly_threshold,
+                                      seasonal=anomaly_seasonal, store=get_history_store())
+    monitor = InterfaceTrafficMonitor(interval=interval, capacity=capacity, on_rates=detector.observe,
+                                      normalizer=get_counter_normalizer())
+    monitor.detector = detector
+    atexit.register(detector.save)
+    return monitor
+
+
+def get_interface_monitor_config():
+    """Reads optional [metrics] traffic monitor and anomaly detector settings from secrets."""
+    try:
+        metrics_secrets = st.secrets.get("metrics", {})
+        return (float(metrics_secrets.get("traffic_interval", 2.0)), int(metrics_secrets.get("traffic_window", 600)),
+                float(metrics_secrets.get("anomaly_threshold", 4.0)), float(metrics_secrets.get("anomaly_half_life", 300.0)),
+                bool(metrics_secrets.get("anomaly_seasonal", False)))
+    except Exception:
+        return 2.0, 600, 4.0, 300.0, False
+
+
+
+# --- LAN Device Inventory ---
+class LanDeviceInventory:
+    """Persistent inventory of LAN devices seen in the kernel neighbor (ARP/NDP) table. No scanning.
+
+    poll() reads `ip -j neigh` (falls back to /proc/net/arp) at most once per `interval`
+    seconds, diffs the result against an in-memory mirror of the lan_devices table and
+    writes only what changed: new devices, changed IP/interface/hostname, and last_seen
+    for present devices at most once per `touch_interval` seconds. The neighbor state
+    (REACHABLE/STALE/DELAY churns constantly) is kept current in memory and only
+    persisted along with those writes.
+    """
+    IGNORED_STATES = {"FAILED", "INCOMPLETE", "NOARP"}
+
+    def __init__(self, db_path, interval=30.0, touch_interval=300.0):
+        self.interval = float(interval)
+        self.touch_interval = float(touch_interval)
+        self._lock = threading.Lock()
+        self._conn = MetricsStore._connect(db_path)
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS lan_devices (
+                mac TEXT PRIMARY KEY, ip TEXT, other_ips TEXT, interface TEXT, state TEXT, hostname TEXT,
+                first_seen REAL NOT NULL, last_seen REAL NOT NULL)""")
+        self._devices = {row[0]: dict(zip(("mac", "ip", "other_ips", "interface", "state", "hostname", "first_seen", "last_seen"), row))
+                         for row in self._conn.execute("SELECT mac, ip, other_ips, interface, state, hostname, first_seen, last_seen FROM lan_devices")}
+        self.online = set() # MACs present in the latest poll
+        self.last_poll = 0.0
+        self.last_changes = {"added": [], "changed": [], "gone": []}
+        self.source = None
+
+    @staticmethod
+    def read_neighbors():
+        """Returns ({mac: {"ips": [...], "interface", "state"}}, source). IPv4 addresses are listed first."""
+        neighbors, source = {}, None
+        if shutil.which("ip"):
+            try:
+                result = subprocess.run(["ip", "-j", "neigh", "show"], capture_output=True, text=True, timeout=3)
+                if result.returncode != 0 or not result.stdout.strip():
+                    raise ValueError("ip -j neigh failed or printed nothing") # Old iproute2 without -j prints nothing
+                for entry in json.loads(result.stdout):
+                    states = set(entry.get("state", []))
+                    mac = (entry.get("lladdr") or "").lower()
+                    if not mac or states & LanDeviceInventory.IGNORED_STATES: continue
+                    device = neighbors.setdefault(mac, {"ips": [], "interface": entry.get("dev"), "state": "/".join(sorted(states)) or "?"})
+                    device["ips"].append(entry.get("dst"))
+                source = "ip neigh"
+            except (subprocess.SubprocessError, OSError, ValueError):
+                neighbors = {} # Old iproute2 without -j, or no permission: use /proc below
+        if source is None:
+            try:
+                with open("/proc/net/arp") as f:
+                    for line in f.readlines()[1:]:
+                        parts = line.split()
+                        if len(parts) < 6 or parts[2] == "0x0" or parts[3] == "00:00:00:00:00:00": continue # Incomplete
+                        device = neighbors.setdefault(parts[3].lower(), {"ips": [], "interface": parts[5], "state": "ARP"})
+                        device["ips"].append(parts[0])
+                source = "/proc/net/arp"
+            except OSError:
+                return {}, None
+        for device in neighbors.values():
+            device["ips"].sort(key=lambda ip: (":" in ip, ip)) # IPv4 first
+        return neighbors, source
+
+    def poll(self, hostnames=None, force=False):
+        """Refreshes the inventory if due. hostnames: optional {ip: name} (e.g. from Pi-hole). Returns last_changes."""
+        with self._lock:
+            now = time.time()
+            if not force and now - self.last_poll < self.interval:
+                return self.last_changes
+            neighbors, self.source = self.read_neighbors()
+            hostnames = hostnames or {}
+            added, changed, writes = [], [], []
+            for mac, seen in neighbors.items():
+                ip, other_ips = seen["ips"][0], ",".join(seen["ips"][1:])
+                hostname = next((hostnames[i] for i in seen["ips"] if hostnames.get(i)), None)
+                known = self._devices.get(mac)
+                if known is None:
+                    known = self._devices[mac] = {"mac": mac, "ip": ip, "other_ips": other_ips, "interface": seen["interface"],
+                                                  "state": seen["state"], "hostname": hostname, "first_seen": now, "last_seen": now}
+                    added.append(mac); writes.append(known)
+                    continue
+                known["state"] = seen["state"] # Not a change on its own
+                update = {"ip": ip, "other_ips": other_ips, "interface": seen["interface"]}
+                if hostname: update["hostname"] = hostname
+                if any(known.get(k) != v for k, v in update.items()):
+                    known.update(update); known["last_seen"] = now
+                    changed.append(mac); writes.append(known)
+                elif now - known["last_seen"] >= self.touch_interval:
+                    known["last_seen"] = now; writes.append(known)
+            gone = sorted(self.online - neighbors.keys())
+            if writes:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO lan_devices (mac, ip, other_ips, interface, state, hostname, first_seen, last_seen) "
+                        "VALUES (:mac, :ip, :other_ips, :interface, :state, :hostname, :first_seen, :last_seen)", writes)
+            self.online = set(neighbors)
+            self.last_poll = now
+            self.last_changes = {"added": added, "changed": changed, "gone": gone, "writes": len(writes)}
+            return self.last_changes
+
+    def devices(self):
+        """Copy of all known devices (dicts) with an 'online' flag."""
+        with self._lock:
+            return [dict(d, online=mac in self.online) for mac, d in self._devices.items()]
+
+
+@st.cache_resource(show_spinner=False)
+def get_lan_inventory(db_path, interval=30.0):
+    """One LAN device inventory per server process, stored next to the metrics history."""
+    return LanDeviceInventory(db_path, interval=interval)
+
+
+@st.cache_data(ttl=60)
+def get_pihole_client_activity():
+    """{client ip: (hostname or None, query count)} from Pi-hole getQuerySources, or {} if unavailable."""
+    if not pihole_enabled: return {}
+    result = get_pihole_query_sources_api()
+    if not result.get("success"): return {}
+    activity = {}
+    for client, count in result["data"].get("top_sources", {}).items():
+        hostname, _, ip = client.rpartition("|") if "|" in client else ("", "", client)
+        activity[ip] = (hostname or None, count)
+    return activity
+
+
+def render_lan_devices():
+    """LAN devices from the neighbor table, joined with Pi-hole query counts where the IPs match."""
+    store = get_history_store()
+    try: interval = float(st.secrets.get("network", {}).get("lan_scan_interval", 30))
+    except Exception: interval = 30.0
+    inventory = get_lan_inventory(store.db_path, interval)
+    activity = get_pihole_client_activity()
+    force = st.button("🔄 Re-read Neighbor Table", key="lan_devices_refresh")
+    changes = inventory.poll(hostnames={ip: name for ip, (name, _count) in activity.items() if name}, force=force)
+    devices = inventory.devices()
+    if not devices:
+        st.caption("No neighbors found (the kernel only lists devices this host has talked to recently).")
+        return
+    for d in devices:
+        d["queries"] = sum(activity.get(ip, (None, 0))[1] for ip in [d["ip"]] + [i for i in (d["other_ips"] or "").split(",") if i])
+    devices.sort(key=lambda d: (not d["online"], -d["queries"], d["ip"] or "")) # Online, busiest first
+    st.dataframe(pd.DataFrame([{
+        "Online": "🟢" if d["online"] else "⚪", "IP": d["ip"], "MAC": d["mac"], "Hostname": d["hostname"] or "",
+        "Pi-hole Queries": d["queries"] if activity else None, "Interface": d["interface"], "State": d["state"],
+        "First Seen": time.strftime('%Y-%m-%d %H:%M', time.localtime(d["first_seen"])),
+        "Last Seen": time.strftime('%Y-%m-%d %H:%M', time.localtime(d["last_seen"])),
+    } for d in devices]), hide_index=True, use_container_width=True)
+    st.caption(f"{sum(d['online'] for d in devices)} online / {len(devices)} known | Source: `{inventory.source or 'N/A'}` | "
+               f"Last poll: +{len(changes['added'])} new, {len(changes['changed'])} changed, {len(changes['gone'])} gone"
+               + ("" if activity else " | Pi-hole query counts unavailable"))
+
+
+# --- Connection Inventory ---
+class ConnectionInventory:
+    """Cached, incrementally diffed view of psutil.net_connections() grouped by remote host and by process.
+
+    snapshot() re-reads the socket table at most once per `ttl` seconds (shared by all
+    sessions). Each poll is diffed against the previous one by connection key; when
+    nothing changed the previous version (and its already-built tables) is reused, so
+    readers only rebuild DataFrames when the version number moves.
+    """
+
+    def __init__(self, ttl=5.0, max_events=200):
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self._taken = 0.0 # monotonic time of the last poll
+        self._connections = {} # key -> (remote_ip, remote_port, local_port, status, pid)
+        self._process_names = {} # (pid, create_time) -> name, kept while the pid is seen; a reused pid gets a new key
+        self.version = 0
+        self.error = None
+        self.poll_ms = None
+        self.events = collections.deque(maxlen=max_events) # (time, "+"/"-", connection tuple), newest last
+        self._tables = (None, None, None) # (version, established_only, (by_host frame, by_process frame))
+
+    def _process_name(self, pid):
+        """Name of pid, cached per (pid, create_time). Called outside self._lock: it reads /proc."""
+        if pid is None: return "?"
+        try:
+            proc = psutil.Process(pid)
+            key = (pid, proc.create_time())
+        except psutil.NoSuchProcess: return "?"
+        except psutil.AccessDenied: proc, key = None, (pid, None)
+        name = self._process_names.get(key)
+        if name is None:
+            try: name = proc.name() if proc else "?"
+            except (psutil.NoSuchProcess, psutil.AccessDenied): name = "?"
+            self._process_names[key] = name
+        return name
+
+    def snapshot(self):
+        """Polls if the cached snapshot is older than ttl. Returns (version, connections dict)."""
+        with self._lock:
+            if time.monotonic() - self._taken < self.ttl:
+                return self.version, self._connections
+            started = time.perf_counter()
+            try:
+                raw = psutil.net_connections(kind="inet")
+                self.error = None
+            except psutil.AccessDenied:
+                raw, self.error = [], "Access denied listing sockets (run with more privileges to see all processes)."
+            current = {}
+            for conn in raw:
+                if not conn.raddr: continue # Listening / unconnected sockets
+                key = (conn.laddr.ip, conn.laddr.port, conn.raddr.ip, conn.raddr.port, conn.pid)
+                current[key] = (conn.raddr.ip, conn.raddr.port, conn.laddr.port, conn.status, conn.pid)
+            added = current.keys() - self._connections.keys()
+            removed = self._connections.keys() - current.keys()
+            changed = added or removed or any(current[k][3] != self._connections[k][3] for k in current.keys() & self._connections.keys())
+            if changed:
+                now = time.time()
+                if self.version: # The first poll is the baseline, not a burst of "new" connections
+                    self.events.extend((now, "-", self._connections[k]) for k in removed)
+                    self.events.extend((now, "+", current[k]) for k in added)
+                self._connections = current
+                self.version += 1
+                live_pids = {c[4] for c in current.values()}
+                self._process_names = {key: name for key, name in self._process_names.items() if key[0] in live_pids}
+            self._taken = time.monotonic()
+            self.poll_ms = (time.perf_counter() - started) * 1000
+            return self.version, self._connections
+
+    def recent_events(self, n=15):
+        """Last n connection changes, newest last (safe while another session polls)."""
+        with self._lock:
+            return list(self.events)[-n:]
+
+    def tables(self, established_only=True):
+        """(version, by_host DataFrame, by_process DataFrame), rebuilt only when the snapshot changed."""
+        version, connections = self.snapshot()
+        with self._lock:
+            cached_version, cached_key, frames = self._tables[0], self._tables[1], self._tables[2]
+            if cached_version == version and cached_key == established_only:
+                return version, frames[0], frames[1]
+            rows = [c for c in connections.values() if not established_only or c[3] == psutil.CONN_ESTABLISHED]
+        # One /proc lookup per distinct pid (not per socket), without blocking other sessions' snapshot()
+        names = {pid: self._process_name(pid) for pid in {row[4] for row in rows}}
+        with self._lock:
+            by_host, by_process = {}, {}
+            for remote_ip, remote_port, _local_port, status, pid in rows:
+                name = names[pid]
+                host = by_host.setdefault(remote_ip, {"count": 0, "ports": set(), "processes": set(), "states": collections.Counter()})
+                host["count"] += 1; host["ports"].add(remote_port); host["processes"].add(name); host["states"][status] += 1
+                proc = by_process.setdefault((name, pid), {"count": 0, "hosts": set(), "states": collections.Counter()})
+                proc["count"] += 1; proc["hosts"].add(remote_ip); proc["states"][status] += 1
+            def states_text(counter): return ", ".join(f"{state} {n}" for state, n in counter.most_common())
+            host_frame = pd.DataFrame([{
+                "Remote Host": ip, "Connections": h["count"], "Ports": ", ".join(map(str, sorted(h["ports"])[:8])) + (" …" if len(h["ports"]) > 8 else ""),
+                "Processes": ", ".join(sorted(h["processes"])[:5]), "States": states_text(h["states"]),
+            } for ip, h in by_host.items()], columns=["Remote Host", "Connections", "Ports", "Processes", "States"])
+            process_frame = pd.DataFrame([{
+                "Process": name, "PID": pid if pid is not None else "?", "Connections": p["count"],
+                "Remote Hosts": len(p["hosts"]), "States": states_text(p["states"]),
+            } for (name, pid), p in by_process.items()], columns=["Process", "PID", "Connections", "Remote Hosts", "States"])
+            frames = (host_frame.sort_values("Connections", ascending=False, ignore_index=True),
+                      process_frame.sort_values("Connections", ascending=False, ignore_index=True))
+            self._tables = (version, established_only, frames)
+            return version, frames[0], frames[1]
+
+
+@st.cache_resource(show_spinner=False)
+def get_connection_inventory(ttl=5.0):
+    """One connection inventory per server process; polls are shared by all sessions."""
+    return ConnectionInventory(ttl=ttl)
+
+
+# --- Latency / Jitter / Loss Prober ---
+def build_dns_query(name, query_id, qtype=1):
+    """Minimal DNS query packet (recursion desired) for name; qtype 1 = A."""
+    qname = b"".join(bytes([len(label)]) + label.encode("idna") for label in name.strip(".").split(".")) + b"\0"
+    return struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0) + qname + struct.pack("!HH", qtype, 1)
+
+def parse_dns_response_header(data):
+    """(query_id, rcode) of a DNS response, or None if data is not a response."""
+    if len(data) < 12: return None
+    query_id, flags = struct.unpack("!HH", data[:4])
+    if not flags & 0x8000: return None # QR bit: not a response
+    return query_id, flags & 0x000F
+
+
+class _DnsProbeProtocol(asyncio.DatagramProtocol):
+    """Resolves a future with the first response carrying the expected query ID."""
+    def __init__(self, query_id, future):
+        self.query_id, self.future = query_id, future
+    def datagram_received(self, data, addr):
+        header = parse_dns_response_header(data)
+        if header and header[0] == self.query_id and not self.future.done():
+            self.future.set_result(header[1])
+    def error_received(self, exc):
+        if not self.future.done(): self.future.set_exception(exc)
+
+
+async def probe_tcp_connect(host, port, timeout):
+    """TCP handshake time in ms (raises on timeout/refusal)."""
+    started = time.perf_counter()
+    _reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    elapsed = (time.perf_counter() - started) * 1000
+    writer.close()
+    try: await writer.wait_closed()
+    except OSError: pass
+    return elapsed
+
+async def dns_query_rcode(host, port, timeout, name="example.com"):
+    """(round trip in ms, rcode) of one UDP DNS query for name (raises on timeout)."""
+    loop = asyncio.get_running_loop()
+    query_id = random.randint(0, 0xFFFF)
+    future = loop.create_future()
+    transport, _protocol = await loop.create_datagram_endpoint(lambda: _DnsProbeProtocol(query_id, future), remote_addr=(host, port))
+    try:
+        started = time.perf_counter()
+        transport.sendto(build_dns_query(name, query_id))
+        rcode = await asyncio.wait_for(future, timeout)
+        return (time.perf_counter() - started) * 1000, rcode
+    finally:
+        transport.close()
+
+async def probe_dns_query(host, port, timeout, name="example.com"):
+    """Round trip of one UDP DNS query in ms (raises on timeout). Any DNS response counts, even NXDOMAIN."""
+    return (await dns_query_rcode(host, port, timeout, name))[0]
+
+
+def get_default_gateway():
+    """IPv4 default gateway from /proc/net/route (Linux), or None."""
+    try:
+        with open("/proc/net/route") as f:
+            for line in f.readlines()[1:]:
+                parts = line.split()
+                if len(parts) > 2 and parts[1] == "00000000" and parts[2] != "00000000":
+                    return socket.inet_ntoa(struct.pack("<I", int(parts[2], 16)))
+    except (OSError, ValueError):
+        pass
+    return None
+
+def parse_probe_target(spec):
+    """'tcp:host:port' / 'dns:host[:port]' (optionally 'label=' prefixed) -> dict, or None if malformed."""
+    label, _, rest = spec.rpartition("=")
+    kind, _, address = rest.partition(":")
+    host, _, port = address.rpartition(":") if address.count(":") == 1 or address.startswith("[") else (address, "", "")
+    host = host.strip("[]")
+    if kind not in ("tcp", "dns") or not host or (kind == "tcp" and not port): return None
+    try: port = int(port) if port else 53
+    except ValueError: return None
+    return {"name": label or f"{kind}:{host}:{port}", "kind": kind, "host": host, "port": port}
+
+def get_pihole_host():
+    """Hostname/IP of the configured Pi-hole (its DNS server), or None."""
+    if not (pihole_enabled and PIHOLE_API_URL_BASE): return None
+    return urllib.parse.urlsplit(PIHOLE_API_URL_BASE if "//" in PIHOLE_API_URL_BASE else f"http://{PIHOLE_API_URL_BASE}").hostname
+
+def default_probe_targets():
+    """Gateway (TCP 80), Pi-hole DNS and an upstream resolver (DNS + TCP 443)."""
+    targets = []
+    gateway = get_default_gateway()
+    if gateway: targets.append(f"gateway=tcp:{gateway}:80")
+    pihole_host = get_pihole_host()
+    if pihole_host: targets.append(f"pihole-dns=dns:{pihole_host}:53")
+    targets += ["upstream-dns=dns:1.1.1.1:53", "upstream-tcp=tcp:1.1.1.1:443"]
+    return targets
+
+
+class LatencyProber:
+    """Background asyncio prober: TCP-connect and DNS latency, jitter and loss for many targets at once.
+
+    Every `interval` seconds each target gets `count` probes (spaced `spacing` s apart);
+    all targets run concurrently on one event loop in a daemon thread. Per round it
+    records mean RTT, jitter (mean absolute difference of consecutive RTTs, as in
+    RFC 3550) and loss into a per-target rolling window, and optionally into the
+    history store as prober.<target>.rtt_ms / jitter_ms / loss_pct.
+
+    It only probes while someone is watching: keep_alive() (called by each panel
+    refresh) keeps it running for `keepalive` seconds, pause() idles it at once.
+    reconfigure() swaps targets and timings on the running loop.
+    """
+
+    def __init__(self, targets=(), interval=5.0, count=3, timeout=1.0, spacing=0.05, window=720, dns_name="example.com", store=None, keepalive=30.0):
+        self.spacing, self.window, self.keepalive = float(spacing), int(window), float(keepalive)
+        self.store = store
+        self.targets, self.history, self.config = [], {}, None # history: name -> deque of (ts, rtt, jitter, loss)
+        self.last_error = {}
+        self._store_error = None
+        self._wanted_until = 0.0 # monotonic time after which the loop idles
+        self._lock = threading.Lock()
+        self.reconfigure(targets, interval, count, timeout, dns_name)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._main()), name="cnq-latency-prober", daemon=True)
+        self._thread.start()
+
+    def reconfigure(self, targets, interval=5.0, count=3, timeout=1.0, dns_name="example.com"):
+        """Applies new settings from the next round on; targets that stay keep their history."""
+        parsed = [t for t in (parse_probe_target(spec) for spec in targets) if t]
+        with self._lock:
+            self.config = (tuple(targets), float(interval), int(count), float(timeout), dns_name)
+            self.targets = parsed
+            self.interval, self.count, self.timeout, self.dns_name = float(interval), max(1, int(count)), float(timeout), dns_name
+            self.history = {t["name"]: self.history.get(t["name"]) or collections.deque(maxlen=self.window) for t in parsed}
+            self.last_error = {name: error for name, error in self.last_error.items() if name in self.history}
+
+    def keep_alive(self):
+        """Probe (or keep probing) for the next `keepalive` seconds."""
+        self._wanted_until = time.monotonic() + self.keepalive
+
+    def pause(self):
+        self._wanted_until = 0.0
+
+    @property
+    def paused(self):
+        return time.monotonic() > self._wanted_until
+
+    async def _probe_once(self, target):
+        if target["kind"] == "tcp": return await probe_tcp_connect(target["host"], target["port"], self.timeout)
+        return await probe_dns_query(target["host"], target["port"], self.timeout, self.dns_name)
+
+    async def _probe_target(self, target):
+        rtts = []
+        for i in range(self.count):
+            if i: await asyncio.sleep(self.spacing)
+            try:
+                rtts.append(await self._probe_once(target))
+            except Exception as e: # Anything (e.g. UnicodeError from a bad dns_query_name) counts as a lost probe, never kills the loop
+                self.last_error[target["name"]] = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+        loss = (self.count - len(rtts)) / self.count * 100
+        rtt = statistics.fmean(rtts) if rtts else float("nan")
+        jitter = statistics.fmean(abs(a - b) for a, b in zip(rtts, rtts[1:])) if len(rtts) > 1 else (0.0 if rtts else float("nan"))
+        if rtts: self.last_error.pop(target["name"], None)
+        return rtt, jitter, loss
+
+    async def _main(self):
+        while not self._stop_event.is_set():
+            if self.paused: # Nobody is looking: no packets, no history writes
+                await asyncio.sleep(0.5)
+                continue
+            started = time.monotonic()
+            with self._lock: targets, interval = list(self.targets), self.interval
+            results = await asyncio.gather(*(self._probe_target(t) for t in targets))
+            now = time.time()
+            with self._lock:
+                for target, (rtt, jitter, loss) in zip(targets, results):
+                    if target["name"] in self.history: self.history[target["name"]].append((now, rtt, jitter, loss)) # Unless reconfigured away
+            if self.store is not None:
+                values = {}
+                for target, (rtt, jitter, loss) in zip(targets, results):
+                    if rtt == rtt: values[f"prober.{target['name']}.rtt_ms"], values[f"prober.{target['name']}.jitter_ms"] = rtt, jitter # Skip NaN
+                    values[f"prober.{target['name']}.loss_pct"] = loss
+                try:
+                    self.store.record_many(values, ts=now)
+                except Exception as e:
+                    if self._store_error != type(e).__name__: # Log each distinct error once
+                        print(f"Latency prober history write failed: {traceback.format_exc()}")
+                        self._store_error = type(e).__name__
+                else:
+                    self._store_error = None
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def stop(self):
+        self._stop_event.set()
+
+    def summary(self):
+        """Per target: latest RTT/jitter/loss plus window mean loss and p95 RTT."""
+        rows = []
+        with self._lock:
+            for target in self.targets:
+                samples = list(self.history[target["name"]])
+                rtts = sorted(r[1] for r in samples if r[1] == r[1])
+                last = samples[-1] if samples else (None, float("nan"), float("nan"), float("nan"))
+                rows.append({
+                    "Target": target["name"], "Probe": f"{target['kind'].upper()} {target['host']}:{target['port']}",
+                    "RTT (ms)": last[1], "Jitter (ms)": last[2], "Loss (%)": last[3],
+                    "p95 RTT (ms)": rtts[min(len(rtts) - 1, int(len(rtts) * 0.95))] if rtts else float("nan"),
+                    "Window Loss (%)": statistics.fmean(r[3] for r in samples) if samples else float("nan"),
+                    "Rounds": len(samples), "Last Error": self.last_error.get(target["name"], ""),
+                })
+        return rows
+
+    def rtt_frame(self):
+        """DataFrame (time index, one column per target) of mean RTT per round."""
+        with self._lock:
+            series = {name: pd.Series([r[1] for r in rows], index=pd.to_datetime([r[0] for r in rows], unit="s"))
+                      for name, rows in self.history.items() if rows}
+        return pd.DataFrame(series)
+
+
+@st.cache_resource(show_spinner=False)
+def get_latency_prober():
+    """One prober thread per server process (idle until keep_alive()); settings are applied by get_latency_prober_from_secrets()."""
+    return LatencyProber(store=get_history_store())
+
+def get_latency_prober_from_secrets():
+    """Prober configured from optional [prober] secrets (targets, interval, count, timeout, dns_query_name).
+
+    The cache is not keyed on the settings (the default targets follow the gateway), so a
+    change reconfigures the running prober instead of starting a second thread.
+    """
+    try: prober_secrets = st.secrets.get("prober", {})
+    except Exception: prober_secrets = {}
+    config = (tuple(prober_secrets.get("targets", default_probe_targets())),
+              float(prober_secrets.get("interval", 5.0)), int(prober_secrets.get("count", 3)),
+              float(prober_secrets.get("timeout", 1.0)), prober_secrets.get("dns_query_name", "example.com"))
+    prober = get_latency_prober()
+    if config != prober.config: prober.reconfigure(*config)
+    return prober
+
+
+# --- DNS Benchmark ---
+DNS_BENCHMARK_JOB_KEY = "dns_benchmark"
+DNS_BENCHMARK_CATEGORIES = ("cached", "uncached", "blocked")
+DNS_BENCHMARK_CACHED_NAMES = ("google.com", "cloudflare.com", "github.com", "wikipedia.org", "amazon.com", "microsoft.com", "apple.com", "youtube.com")
+DNS_BENCHMARK_BLOCKED_NAMES = ("doubleclick.net", "googleadservices.com", "adservice.google.com", "pagead2.googlesyndication.com", "ads.yahoo.com")
+DNS_FAILURE_RCODES = (1, 2, 4, 5) # FORMERR, SERVFAIL, NOTIMP, REFUSED; NXDOMAIN is a valid answer
+
+def get_dns_benchmark_config():
+    """[dns_benchmark] resolvers, cached_names, blocked_names, queries (default: 30), concurrency (default: 10), timeout (default: 2.0)."""
+    try: benchmark_secrets = st.secrets.get("dns_benchmark", {})
+    except Exception: benchmark_secrets = {}
+    pihole_host = get_pihole_host()
+    default_resolvers = ([f"pihole={pihole_host}:53"] if pihole_host else []) + ["cloudflare=1.1.1.1:53", "google=8.8.8.8:53", "quad9=9.9.9.9:53"]
+    return {
+        "resolvers": [r for r in (parse_dns_resolver(spec) for spec in benchmark_secrets.get("resolvers", default_resolvers)) if r],
+        "cached_names": list(benchmark_secrets.get("cached_names", DNS_BENCHMARK_CACHED_NAMES)),
+        "blocked_names": list(benchmark_secrets.get("blocked_names", DNS_BENCHMARK_BLOCKED_NAMES)),
+        "queries": int(benchmark_secrets.get("queries", 30)), "concurrency": int(benchmark_secrets.get("concurrency", 10)),
+        "timeout": float(benchmark_secrets.get("timeout", 2.0)),
+    }
+
+def parse_dns_resolver(spec):
+    """'label=host[:port]' (label optional) -> {"name", "host", "port"}, or None if malformed."""
+    label, _, address = spec.rpartition("=")
+    target = parse_probe_target(f"dns:{address}")
+    if not target: return None
+    return {"name": label or f"{target['host']}:{target['port']}", "host": target["host"], "port": target["port"]}
+
+def latency_percentiles(values, points=(50, 95, 99)):
+    """Nearest-rank percentiles of values, NaN for an empty list."""
+    ordered = sorted(values)
+    return [ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else float("nan") for p in points]
+
+
+async def _dns_query_batch(resolver, names, concurrency, timeout):
+    """Concurrent queries (at most `concurrency` in flight); returns (ms or None, rcode or None) per name."""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    async def one(name):
+        async with semaphore:
+            try: return await dns_query_rcode(resolver["host"], resolver["port"], timeout, name)
+            except Exception: return None, None # Timeout, socket error or an unencodable name (label > 63 chars): a failed query
+    return await asyncio.gather(*(one(name) for name in names))
+
+async def _dns_benchmark(resolvers, batches, concurrency, timeout, progress):
+    rows = []
+    for i, resolver in enumerate(resolvers):
+        for j, (category, names, warmup) in enumerate(batches):
+            progress((i * len(batches) + j) / (len(resolvers) * len(batches)), f"{resolver['name']}: {category}")
+            if warmup: await _dns_query_batch(resolver, warmup, concurrency, timeout) # Prime the resolver's cache
+            answers = await _dns_query_batch(resolver, names, concurrency, timeout)
+            latencies = [ms for ms, rcode in answers if ms is not None and rcode not in DNS_FAILURE_RCODES]
+            p50, p95, p99 = latency_percentiles(latencies)
+            rows.append({"resolver": resolver["name"], "address": f"{resolver['host']}:{resolver['port']}", "category": category,
+                         "queries": len(answers), "failures": len(answers) - len(latencies),
+                         "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+                         "mean_ms": statistics.fmean(latencies) if latencies else float("nan")})
+    return rows
+
+
+def run_dns_benchmark(progress=None, resolvers=None, cached_names=DNS_BENCHMARK_CACHED_NAMES, blocked_names=DNS_BENCHMARK_BLOCKED_NAMES,
+                      queries=30, concurrency=10, timeout=2.0):
+    """Benchmarks each resolver with cached, uncached and blocked names; stores and returns the per-batch stats.
+
+    cached: names queried once to warm the cache, then `queries` repeats.
+    uncached: random subdomains of the cached names, so every query recurses upstream.
+    blocked: ad/tracking domains that a Pi-hole answers from its blocklist.
+    A timeout or a FORMERR/SERVFAIL/NOTIMP/REFUSED answer counts as a failure.
+    """
+    progress = progress or (lambda fraction, message=None: None)
+    cached_names, blocked_names = list(cached_names) or list(DNS_BENCHMARK_CACHED_NAMES), list(blocked_names) or list(DNS_BENCHMARK_BLOCKED_NAMES)
+    batches = [
+        ("cached", [cached_names[i % len(cached_names)] for i in range(queries)], cached_names),
+        ("uncached", [f"cnq-{random.getrandbits(48):012x}.{cached_names[i % len(cached_names)]}" for i in range(queries)], None),
+        ("blocked", [blocked_names[i % len(blocked_names)] for i in range(queries)], None),
+    ]
+    started = time.time()
+    rows = asyncio.run(_dns_benchmark(list(resolvers or []), batches, concurrency, timeout, progress))
+    get_dns_benchmark_history(get_history_store().db_path).record(started, rows)
+    return {"ts": started, "rows": rows}
+
+
+def start_dns_benchmark_job():
+    """Starts a background DNS benchmark with the [dns_benchmark] settings (single-flight across sessions)."""
+    config = get_dns_benchmark_config()
+    blocked_names = config["blocked_names"]
+    if pihole_enabled: # Prefer the Pi-hole's own most-blocked domains
+        data = get_pihole_top_items_api(10).get("data")
+        top_ads = data.get("top_ads") if isinstance(data, dict) else None
+        if isinstance(top_ads, dict) and top_ads: blocked_names = list(top_ads)
+    return get_job_manager().submit(DNS_BENCHMARK_JOB_KEY, run_dns_benchmark, resolvers=config["resolvers"], cached_names=config["cached_names"],
+                                    blocked_names=blocked_names, queries=config["queries"], concurrency=config["concurrency"], timeout=config["timeout"])
+
+
+class DnsBenchmarkHistory:
+    """Per-run, per-resolver, per-category DNS benchmark stats in a dns_benchmark_runs table."""
+    COLUMNS = ("ts", "resolver", "address", "category", "queries", "failures", "p50_ms", "p95_ms", "p99_ms", "mean_ms")
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = MetricsStore._connect(db_path)
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS dns_benchmark_runs (
+                ts REAL NOT NULL, resolver TEXT NOT NULL, address TEXT, category TEXT NOT NULL,
+                queries INTEGER, failures INTEGER, p50_ms REAL, p95_ms REAL, p99_ms REAL, mean_ms REAL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_dns_benchmark_runs_ts ON dns_benchmark_runs (ts)")
+
+    def record(self, ts, rows):
+        values = [(ts,) + tuple(None if row[c] != row[c] else row[c] for c in self.COLUMNS[1:]) for row in rows] # NaN -> NULL
+        with self._lock, self._conn:
+            self._conn.executemany(f"INSERT INTO dns_benchmark_runs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})", values)
+
+    def frame(self, since=0.0):
+        """Rows since `since` (epoch seconds), oldest first, with a failure_pct column."""
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM dns_benchmark_runs WHERE ts >= ? ORDER BY ts", (since,)).fetchall()
+        frame = pd.DataFrame(rows, columns=list(self.COLUMNS))
+        frame["time"] = pd.to_datetime(frame["ts"], unit="s")
+        frame["failure_pct"] = frame["failures"] / frame["queries"].where(frame["queries"] > 0) * 100
+        return frame
+
+
+@st.cache_resource(show_spinner=False)
+def get_dns_benchmark_history(db_path):
+    return DnsBenchmarkHistory(db_path)
+
+
+def render_dns_benchmark():
+    """Resolver list and run button for the DNS benchmark; progress is polled only while a run is active."""
+    config = get_dns_benchmark_config()
+    if not config["resolvers"]:
+        st.warning("No valid resolvers. Use `label=host:port` in `[dns_benchmark] resolvers`.")
+        return
+    st.caption("Resolvers: " + ", ".join(f"`{r['name']}` ({r['host']}:{r['port']})" for r in config["resolvers"])
+               + f" | {config['queries']} queries per batch, {config['concurrency']} in flight")
+    if st.button("⏱️ Run DNS Benchmark", key="dns_benchmark_run_btn"):
+        st.session_state.dns_benchmark_job_id = start_dns_benchmark_job()
+    dns_benchmark_panel()
+
+
+def render_azure_connection_stats():
+    """Sidebar expander: connection reuse and latency of the shared Azure AI client, once one has been built."""
+    metrics = get_azure_runtime().get("metrics") if azure_ai_enabled else None # Never builds the client here
+    if not metrics: return
+    with st.expander("📡 Azure AI Connection"):
+        fmt = lambda ms: f"{ms:,.0f} ms" if ms is not None else "N/A"
+        service = get_azure_runtime().get("service") # Only if a request already started it
+        if service:
+            queue_stats = service.snapshot()
+            st.caption(f"Async queue: `{queue_stats['queued']}` waiting from `{queue_stats['sessions_waiting']}` session(s) | Running: `{queue_stats['running']}/{queue_stats['workers']}` | "
+                       f"Done: `{queue_stats['completed']}` | Failed: `{queue_stats['failed']}` | Rejected: `{queue_stats['rejected']}`")
+            for kind, timings in sorted(queue_stats["kinds"].items()):
+                st.caption(f"{kind.capitalize()} queue wait p50/p95: `{fmt(timings.get('wait_p50_ms'))}` / `{fmt(timings.get('wait_p95_ms'))}` | "
+                           f"First token p50: `{fmt(timings.get('first_token_p50_ms'))}`")
+        stats = metrics.snapshot()
+        if stats["requests"]:
+            st.caption(f"{'Synchronous client requests' if service else 'Requests'}: `{stats['requests']}` | New connections: `{stats['new_connections']}` | Reused: `{stats['reused_pct']:.0f}%` | Errors: `{stats['errors']}`")
+            st.caption(f"TTFB p50/p95: `{fmt(stats['ttfb_p50_ms'])}` / `{fmt(stats['ttfb_p95_ms'])}`")
+            st.caption(f"First token p50/p95: `{fmt(stats['first_token_p50_ms'])}` / `{fmt(stats['first_token_p95_ms'])}`")
+        elif not service:
+            st.caption("No Azure AI requests yet.")
+        guard = get_azure_call_guard_from_secrets().snapshot()
+        circuit = f"{guard['state']}" + (f" ({guard['open_for']:.0f}s left)" if guard["state"] == "open" else "")
+        st.caption(f"Circuit: `{circuit}` | Retries: `{guard['retries']}` | Short-circuited: `{guard['short_circuits']}` | In flight: `{guard['in_flight']}/{guard['max_concurrent']}`")
+        cache_stats = get_response_cache_from_secrets().snapshot()
+        st.caption(f"Response cache: `{cache_stats['entries']}` entries | " + (" | ".join(
+            f"{kind}: `{c['hits']}/{c['hits'] + c['misses']}` hits ({c['hit_pct']:.0f}%)" for kind, c in sorted(cache_stats["kinds"].items())) or "no lookups yet"))
+
+
+def render_inference_benchmark():
+    """Run button for the offline inference benchmark; progress is polled only while it runs."""
+    workers = get_azure_call_guard_from_secrets().max_concurrent
+    workers = st.number_input("Concurrent workers", min_value=2, max_value=32, value=max(2, workers), key="inference_benchmark_workers",
+                              help="Compared with a single worker. Uses a local mock endpoint: no Azure quota is spent.")
+    if st.button("🧪 Run Inference Benchmark", key="inference_benchmark_run_btn"):
+        st.session_state.inference_benchmark_job_id = start_inference_benchmark_job(int(workers))
+    inference_benchmark_panel()
+
+
+def render_startup_timing_report():
+    """Shows per-module import cost (eager vs lazy) and this script run's time so far."""
+    timings = get_import_timings()
+    with st.expander("⏱️ Startup Timing"):
+        run_ms = (time.perf_counter() - _SCRIPT_START) * 1000
+        st.caption(f"This script run: `{run_ms:.0f} ms` so far")
+        if not timings:
+            st.caption("No imports recorded yet.")
+            return
+        rows = sorted(timings.items(), key=lambda item: item[1]["ms"], reverse=True)
+        eager_ms = sum(t["ms"] for _, t in rows if t["mode"] == "eager")
+        lazy_ms = sum(t["ms"] for _, t in rows if t["mode"] == "lazy")
+        lines = [f"{'Module':<28}{'Mode':<7}{'ms':>8}  Subsystem"]
+        for module_name, t in rows:
+            status = f" ({t['error']})" if t.get("error") else ""
+            lines.append(f"{module_name[:27]:<28}{t['mode']:<7}{t['ms']:>8.1f}  {t['subsystem']}{status}")
+        st.text("\n".join(lines)) # Plain text table, avoids importing pandas just for this
+        st.caption(f"Eager imports: `{eager_ms:.0f} ms` | Lazy (on first use): `{lazy_ms:.0f} ms`")
+
+
 # --- Pi-hole API Functions ---
-@st.cache_data(ttl=3600)  # Cache token for an hour
 def get_pihole_api_token():
-    """Attempts to find API token from file or secrets."""
+    """Attempts to find API token from file or secrets. Resolved once by PiholeClient (re-read after auth errors)."""
     token = None
     # Define potential paths (adjust if non-standard install)
     token_paths = [
@@ -1252,133 +3723,174 @@ def get_pihole_api_token():
     return token
 
 # Unified Pi-hole Request Function
-def make_pihole_api_request(endpoint, params=None, method='GET', data=None):
-    """Makes a request to the Pi-hole API using token or password auth."""
-    # Ensure feature is enabled and URL is configured and not a placeholder
-    pihole_api_secrets = st.secrets.get("pihole_api", {})
-    base_url_secret = pihole_api_secrets.get("url", "")
-    if not pihole_enabled or not base_url_secret or base_url_secret == "YOUR_PIHOLE_IP_OR_HOSTNAME":
-        return {"error": "Pi-hole feature disabled or URL not configured/placeholder."}
-
-    password_secret = pihole_api_secrets.get("password", "")
-    api_token = get_pihole_api_token() # Tries file then secret token
-
-    auth_params = {}
-    auth_method_used = "None"
-
-    # --- Authentication Logic ---
-    # 1. Prioritize API Token (if found and valid)
-    if api_token:
-        auth_params['auth'] = api_token
-        auth_method_used = "API Token"
-    # 2. Fallback to Password from secrets (if not placeholder)
-    elif password_secret and password_secret != "YOUR_PIHOLE_WEB_PASSWORD":
-        auth_params['auth'] = password_secret
-        auth_method_used = "Password (secrets)"
-    # 3. No valid auth method
-    else:
-        return {"error": "Pi-hole Auth Failed: No valid API Token or Password found."}
-
-    # Construct the full API URL
-    api_url = base_url_secret.rstrip('/') + "/admin/api.php"
-    # Merge query parameters safely
-    all_params = {**(params or {}), **auth_params}
+class PiholeClient:
+    """Pi-hole API client: URL/auth/verify_ssl/timeout are resolved once, requests go through a
+    pooled keep-alive requests.Session (with retries for idempotent calls), shared process-wide."""
+
+    def __init__(self, base_url, password, verify_ssl=None, timeout=15, retries=2, pool_size=8):
+        self.api_url = base_url.rstrip('/') + "/admin/api.php"
+        self.password = password
+        self.timeout = timeout
+        # --- SSL Verification ---
+        self.verify_ssl = self.api_url.lower().startswith('https://') # Default True for https
+        if isinstance(verify_ssl, bool): # Allow overriding via secrets (for self-signed certs)
+            self.verify_ssl = verify_ssl
+            if not verify_ssl and self.api_url.lower().startswith('https://'):
+                try: import urllib3; urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+                except ImportError: pass # Ignore if urllib3 not available
+        self._token = None
+        self._token_resolved = False
+        self._token_lock = threading.Lock()
+
+        # --- Pooled Session ---
+        from urllib3.util.retry import Retry
+        retry = Retry(
+            total=retries, connect=retries, read=retries, status=retries, backoff_factor=0.3,
+            status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET"}), # Never replay list edits (POST)
+            raise_on_status=False, # Hand the final response to raise_for_status() below
+        )
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Connection": "keep-alive", "Accept": "application/json"})
+
+    def _auth(self):
+        """Returns (auth_params, auth_method_used). The API token is looked up once."""
+        with self._token_lock:
+            if not self._token_resolved:
+                self._token = get_pihole_api_token() # Tries file then secret token
+                self._token_resolved = True
+            api_token = self._token
+        # 1. Prioritize API Token (if found and valid)
+        if api_token:
+            return {'auth': api_token}, "API Token"
+        # 2. Fallback to Password from secrets (if not placeholder)
+        if self.password and self.password != "YOUR_PIHOLE_WEB_PASSWORD":
+            return {'auth': self.password}, "Password (secrets)"
+        # 3. No valid auth method
+        return None, "None"
+
+    def invalidate_token(self):
+        """Forces the API token to be looked up again on the next request."""
+        with self._token_lock:
+            self._token_resolved = False
+
+    def request(self, endpoint, params=None, method='GET', data=None):
+        """Makes a request to the Pi-hole API using token or password auth."""
+        auth_params, auth_method_used = self._auth()
+        if auth_params is None:
+            return {"error": "Pi-hole Auth Failed: No valid API Token or Password found."}
+        api_url = self.api_url
+        timeout_seconds = self.timeout
+        verify_ssl = self.verify_ssl
+        # Merge query parameters safely
+        all_params = {**(params or {}), **auth_params}
 
-    # --- SSL Verification ---
-    verify_ssl = api_url.lower().startswith('https://') # Default True for https
-    # Allow overriding via secrets (for self-signed certs)
-    if isinstance(pihole_api_secrets.get("verify_ssl"), bool):
-         verify_ssl = pihole_api_secrets["verify_ssl"]
-         if not verify_ssl and api_url.lower().startswith('https://'):
-               try: import urllib3; urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-               except ImportError: pass # Ignore if urllib3 not available
+        try:
+            # Make the request on the pooled keep-alive session
+            response = self.session.request(
+                method=method.upper(),
+                url=api_url,
+                params=all_params, # URL query parameters
+                data=data, # Use data for POST body if present
+                timeout=timeout_seconds,
+                verify=verify_ssl,
+            )
+            response.raise_for_status() # Raise HTTPError automatically for 4xx/5xx
 
-    # --- Timeout ---
-    timeout_seconds = pihole_api_secrets.get("timeout", 15) # Allow config via secrets, default 15s
+            # --- Process Successful Response (Status Code 2xx) ---
+            if response.content:
+                try:
+                    # Attempt to parse JSON first (most common)
+                    json_response = response.json()
+
+                    # Check for specific error formats within valid JSON
+                    if isinstance(json_response, dict) and "error" in json_response:
+                        return {"error": f"API Error: {json_response['error']}"}
+                    if isinstance(json_response, list) and json_response and isinstance(json_response[0], str) and ("invalid" in json_response[0].lower() or "not found" in json_response[0].lower()):
+                        return {"error": f"API Error: {json_response[0]}"}
+
+                    # Determine the structure for successful data return
+                    if isinstance(json_response, dict):
+                        # If 'data' key exists and is a list (like from list GET) -> return the list
+                        if "data" in json_response and isinstance(json_response["data"], list):
+                            return {"success": True, "data": json_response["data"]}
+                        # Otherwise (status, summary dicts) -> return the full dict
+                        else:
+                             return {"success": True, "data": json_response}
+                    elif isinstance(json_response, list): # Direct list response (older API?)
+                        return {"success": True, "data": json_response}
+                    else: # Valid JSON, but unexpected structure
+                        return {"success": True, "data": json_response, "warning": f"Unexpected JSON structure"}
+
+                except json.JSONDecodeError:
+                    # Handle non-JSON success responses (e.g., simple text messages)
+                     resp_text = response.text.strip()
+                     # Check for common success keywords in text response for actions
+                     success_keywords = ["enabled", "disabled", "added successfully", "removed successfully", "database updated"]
+                     if any(keyword in resp_text.lower() for keyword in success_keywords):
+                          return {"success": True, "message": resp_text}
+                     else: # Treat other non-JSON OK responses as success with the message
+                          return {"success": True, "message": f"OK (Non-JSON): {resp_text[:100]}"}
+            else: # Empty response content, but status code was OK (2xx)
+                 # For actions (enable/disable/add/sub/edit), empty OK often means success
+                 action_params = ['enable', 'disable', 'add', 'sub', 'edit']
+                 is_action = any(action in (params or {}) for action in action_params)
+                 if is_action:
+                      return {"success": True, "message": f"Action OK (empty response)"}
+                 else: # Empty OK on a GET request? Might be valid but unusual.
+                      return {"success": True, "data": None, "message":"OK (Empty Response)"}
+
+
+        # --- Specific Exception Handling ---
+        except requests.exceptions.SSLError as e:
+             return {"error": f"SSL Error: {e}. Check Pi-hole cert or set 'verify_ssl: false'."}
+        except requests.exceptions.Timeout:
+            return {"error": f"Timeout ({timeout_seconds}s) connecting to {api_url}."}
+        except requests.exceptions.ConnectionError as e:
+             return {"error": f"Connection Failed: {e}. Check Pi-hole IP/hostname and port."}
+        except requests.exceptions.HTTPError as e: # Handles 4xx/5xx raised by raise_for_status()
+            status_code = e.response.status_code
+            error_msg = f"API HTTP Error: {status_code}."
+            error_detail = ""
+            try: # Try to get structured error detail from response body
+                error_content = e.response.json()
+                if isinstance(error_content, dict) and "error" in error_content: error_detail = error_content["error"]
+                else: error_detail = e.response.text # Fallback to raw text
+            except: error_detail = e.response.text if hasattr(e.response, 'text') and e.response.text else str(e)
+            error_msg += f" Detail: {str(error_detail)[:150]}"
+            # Advice for auth errors
+            if status_code in [401, 403]:
+                error_msg += f" (Auth Error using {auth_method_used}? Check API Token/Password & Web UI permissions)."
+                if auth_method_used == "API Token": self.invalidate_token(); error_msg += " Cleared cached token."
+            return {"error": error_msg}
+        except requests.exceptions.RequestException as e: # Catch other request-related errors
+            return {"error": f"Request Failed: {e}"}
+        except Exception as e: # Catch unexpected errors during the request/processing
+            print(f"Traceback (Pi-hole Request): {traceback.format_exc()}") # Log full trace
+            return {"error": f"Unexpected API Error: {type(e).__name__}"}
+
+
+@st.cache_resource(show_spinner=False)
+def get_pihole_client():
+    """One Pi-hole client (and connection pool) per server process, built from [pihole_api] secrets."""
+    pihole_api_secrets = st.secrets.get("pihole_api", {})
+    return PiholeClient(
+        base_url=pihole_api_secrets.get("url", ""),
+        password=pihole_api_secrets.get("password", ""),
+        verify_ssl=pihole_api_secrets.get("verify_ssl"),
+        timeout=pihole_api_secrets.get("timeout", 15), # Allow config via secrets, default 15s
+        retries=int(pihole_api_secrets.get("retries", 2)),
+    )
 
-    try:
-        # Make the request using python-requests
-        response = requests.request(
-            method=method.upper(),
-            url=api_url,
-            params=all_params, # URL query parameters
-            data=data, # Use data for POST body if present
-            timeout=timeout_seconds,
-            verify=verify_ssl,
-        )
-        response.raise_for_status() # Raise HTTPError automatically for 4xx/5xx
 
-        # --- Process Successful Response (Status Code 2xx) ---
-        if response.content:
-            try:
-                # Attempt to parse JSON first (most common)
-                json_response = response.json()
-
-                # Check for specific error formats within valid JSON
-                if isinstance(json_response, dict) and "error" in json_response:
-                    return {"error": f"API Error: {json_response['error']}"}
-                if isinstance(json_response, list) and json_response and isinstance(json_response[0], str) and ("invalid" in json_response[0].lower() or "not found" in json_response[0].lower()):
-                    return {"error": f"API Error: {json_response[0]}"}
-
-                # Determine the structure for successful data return
-                if isinstance(json_response, dict):
-                    # If 'data' key exists and is a list (like from list GET) -> return the list
-                    if "data" in json_response and isinstance(json_response["data"], list):
-                        return {"success": True, "data": json_response["data"]}
-                    # Otherwise (status, summary dicts) -> return the full dict
-                    else:
-                         return {"success": True, "data": json_response}
-                elif isinstance(json_response, list): # Direct list response (older API?)
-                    return {"success": True, "data": json_response}
-                else: # Valid JSON, but unexpected structure
-                    return {"success": True, "data": json_response, "warning": f"Unexpected JSON structure"}
-
-            except json.JSONDecodeError:
-                # Handle non-JSON success responses (e.g., simple text messages)
-                 resp_text = response.text.strip()
-                 # Check for common success keywords in text response for actions
-                 success_keywords = ["enabled", "disabled", "added successfully", "removed successfully", "database updated"]
-                 if any(keyword in resp_text.lower() for keyword in success_keywords):
-                      return {"success": True, "message": resp_text}
-                 else: # Treat other non-JSON OK responses as success with the message
-                      return {"success": True, "message": f"OK (Non-JSON): {resp_text[:100]}"}
-        else: # Empty response content, but status code was OK (2xx)
-             # For actions (enable/disable/add/sub/edit), empty OK often means success
-             action_params = ['enable', 'disable', 'add', 'sub', 'edit']
-             is_action = any(action in (params or {}) for action in action_params)
-             if is_action:
-                  return {"success": True, "message": f"Action OK (empty response)"}
-             else: # Empty OK on a GET request? Might be valid but unusual.
-                  return {"success": True, "data": None, "message":"OK (Empty Response)"}
-
-
-    # --- Specific Exception Handling ---
-    except requests.exceptions.SSLError as e:
-         return {"error": f"SSL Error: {e}. Check Pi-hole cert or set 'verify_ssl: false'."}
-    except requests.exceptions.Timeout:
-        return {"error": f"Timeout ({timeout_seconds}s) connecting to {api_url}."}
-    except requests.exceptions.ConnectionError as e:
-         return {"error": f"Connection Failed: {e}. Check Pi-hole IP/hostname and port."}
-    except requests.exceptions.HTTPError as e: # Handles 4xx/5xx raised by raise_for_status()
-        status_code = e.response.status_code
-        error_msg = f"API HTTP Error: {status_code}."
-        error_detail = ""
-        try: # Try to get structured error detail from response body
-            error_content = e.response.json()
-            if isinstance(error_content, dict) and "error" in error_content: error_detail = error_content["error"]
-            else: error_detail = e.response.text # Fallback to raw text
-        except: error_detail = e.response.text if hasattr(e.response, 'text') and e.response.text else str(e)
-        error_msg += f" Detail: {str(error_detail)[:150]}"
-        # Advice for auth errors
-        if status_code in [401, 403]:
-            error_msg += f" (Auth Error using {auth_method_used}? Check API Token/Password & Web UI permissions)."
-            if auth_method_used == "API Token": get_pihole_api_token.clear(); error_msg += " Cleared cached token."
-        return {"error": error_msg}
-    except requests.exceptions.RequestException as e: # Catch other request-related errors
-        return {"error": f"Request Failed: {e}"}
-    except Exception as e: # Catch unexpected errors during the request/processing
-        print(f"Traceback (Pi-hole Request): {traceback.format_exc()}") # Log full trace
-        return {"error": f"Unexpected API Error: {type(e).__name__}"}
+def make_pihole_api_request(endpoint, params=None, method='GET', data=None):
+    """Makes a request to the Pi-hole API via the shared pooled client."""
+    # Ensure feature is enabled and URL is configured and not a placeholder (checked once per run at startup)
+    if not pihole_enabled:
+        return {"error": "Pi-hole feature disabled or URL not configured/placeholder."}
+    return get_pihole_client().request(endpoint, params=params, method=method, data=data)
 
 
 # --- Specific Pi-hole Action Functions (Wrappers around unified request fn) ---
@@ -1393,6 +3905,11 @@ def get_pihole_status_from_api():
     else:
         return f"api_error: {result.get('error', 'Unknown status error')}"
 
+@st.cache_data(ttl=8)
+def get_cached_pihole_status_display():
+    """Pi-hole status for display (Pi-hole tab and chat action), cached briefly."""
+    return get_pihole_status_from_api()
+
 def enable_pihole_api():
     """Enables Pi-hole via API."""
     result = make_pihole_api_request("enable", params={'enable': ''})
@@ -1417,11 +3934,22 @@ def get_pihole_summary_api():
     """Gets Pi-hole summary statistics via API."""
     result = make_pihole_api_request("summaryRaw", params={'summaryRaw': ''}) # Prefer raw data
     if result.get("success") and isinstance(result.get("data"), dict):
-         if 'dns_queries_today' in result['data']: return result # Check for a key field
+         if 'dns_queries_today' in result['data']:
+             record_pihole_summary_history(result['data'])
+             return result # Check for a key field
          else: return {"warning": "Summary received, but keys unexpected.", "data": result['data']} # Pass data but warn
     else:
         return result # Return original result (likely includes error)
 
+def record_pihole_summary_history(summary):
+    """Persists the numeric summaryRaw fields to the metrics history."""
+    fields = ["dns_queries_today", "ads_blocked_today", "ads_percentage_today", "unique_clients", "queries_cached", "queries_forwarded"]
+    values = {}
+    for field in fields:
+        try: values[f"pihole.{field}"] = float(summary[field])
+        except (KeyError, TypeError, ValueError): continue
+    get_history_store().record_many(values)
+
 def get_pihole_top_items_api(count=10):
     """Gets Pi-hole top queried/blocked domains and clients via API."""
     result = make_pihole_api_request("topItems", params={'topItems': int(count)})
@@ -1431,6 +3959,72 @@ def get_pihole_top_items_api(count=10):
     else:
         return result
 
+def get_pihole_query_sources_api():
+    """Gets Pi-hole per-client query counts via API."""
+    result = make_pihole_api_request("getQuerySources", params={'getQuerySources': ''})
+    if result.get("success") and isinstance(result.get("data"), dict):
+        if 'top_sources' in result['data']: return result
+        else: return {"warning": "Query sources received, but keys unexpected.", "data": result['data']}
+    else:
+        return result
+
+def get_pihole_over_time_api():
+    """Gets Pi-hole queries/blocked counts in 10 minute buckets via API."""
+    result = make_pihole_api_request("overTimeData10mins", params={'overTimeData10mins': ''})
+    if result.get("success") and isinstance(result.get("data"), dict):
+        if 'domains_over_time' in result['data'] or 'ads_over_time' in result['data']: return result
+        else: return {"warning": "Over-time data received, but keys unexpected.", "data": result['data']}
+    else:
+        return result
+
+def _pihole_status_call():
+    """Status wrapper returning the same dict shape as the other API wrappers."""
+    status = get_pihole_status_from_api()
+    if status.startswith("api_error"): return {"error": status.split(":", 1)[1].strip()}
+    return {"success": True, "data": {"status": status}}
+
+def fetch_pihole_dashboard(top_count=7, include_sources=False, include_over_time=False):
+    """Fetches status, summary, top items (and optionally sources/over-time data) concurrently.
+
+    Returns {"results": {name: result dict}, "timings": {name: seconds}, "errors": {name: message},
+    "elapsed": wall seconds}. A failing endpoint only adds to "errors"; the other results are kept.
+    """
+    calls = {
+        "status": _pihole_status_call,
+        "summary": get_pihole_summary_api,
+        "top_items": lambda: get_pihole_top_items_api(count=top_count),
+    }
+    if include_sources: calls["query_sources"] = get_pihole_query_sources_api
+    if include_over_time: calls["over_time"] = get_pihole_over_time_api
+
+    batch = {"results": {}, "timings": {}, "errors": {}, "elapsed": 0.0}
+    if not pihole_enabled:
+        batch["errors"] = {name: "Pi-hole feature disabled or URL not configured/placeholder." for name in calls}
+        return batch
+
+    get_pihole_client() # Build the shared client (and its token) once, before the workers race for it
+    get_history_store()
+
+    def timed(fn):
+        start = time.perf_counter()
+        try: result = fn()
+        except Exception as e:
+            print(f"Traceback (Pi-hole Batch): {traceback.format_exc()}")
+            result = {"error": f"Unexpected API Error: {type(e).__name__}"}
+        return result, time.perf_counter() - start
+
+    batch_start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(calls), thread_name_prefix="pihole-fetch") as pool:
+        futures = {name: pool.submit(timed, fn) for name, fn in calls.items()}
+        for name, future in futures.items():
+            result, duration = future.result()
+            batch["results"][name] = result
+            batch["timings"][name] = duration
+            if not result.get("success"):
+                batch["errors"][name] = result.get("error") or result.get("warning") or "Failed or invalid data"
+    batch["elapsed"] = time.perf_counter() - batch_start
+    return batch
+
 def add_pihole_list_api(list_type, domain):
     """Adds a domain to the specified Pi-hole list (white/black) via API."""
     # Pi-hole v5+ uses POST for list modifications
@@ -1455,35 +4049,274 @@ def get_pihole_list_content_api(list_type='white'):
 
 
 
+# --- Background Jobs ---
+class BackgroundJobManager:
+    """Runs long tasks on daemon threads with progress reporting and single-flight keys.
+
+    submit(key, fn) returns a job ID; while a job for the same key is queued or
+    running, further submits return that job's ID instead of starting another.
+    fn is called as fn(progress, *args, **kwargs), where progress(fraction, message)
+    updates the job. Jobs never touch st.* - the UI polls snapshot(job_id).
+    """
+
+    def __init__(self, max_finished=20):
+        self._lock = threading.Lock()
+        self._jobs = {} # job_id -> job dict
+        self._active = {} # key -> job_id of the queued/running job
+        self._max_finished = max_finished
+        self._counter = 0
+
+    def submit(self, key, fn, *args, **kwargs):
+        with self._lock:
+            if key in self._active:
+                return self._active[key]
+            self._counter += 1
+            job_id = f"{key}-{int(time.time())}-{self._counter}"
+            self._jobs[job_id] = {
+                "id": job_id, "key": key, "status": "queued", "progress": 0.0, "message": "Queued",
+                "result": None, "error": None, "submitted": time.time(), "started": None, "finished": None,
+            }
+            self._active[key] = job_id
+            self._trim()
+        threading.Thread(target=self._run, args=(job_id, fn, args, kwargs), daemon=True, name=f"job-{key}").start()
+        return job_id
+
+    def _run(self, job_id, fn, args, kwargs):
+        job = self._jobs[job_id]
+        def progress(fraction, message=None):
+            with self._lock:
+                job["progress"] = max(0.0, min(1.0, float(fraction)))
+                if message: job["message"] = message
+        with self._lock:
+            job["status"], job["started"], job["message"] = "running", time.time(), "Starting"
+        try:
+            result = fn(progress, *args, **kwargs)
+            status, error = "done", None
+        except Exception as e:
+            print(f"Background Job Error ({job_id}): {traceback.format_exc()}")
+            result, status, error = None, "error", f"{type(e).__name__}: {e}"
+        with self._lock:
+            job.update(status=status, result=result, error=error, finished=time.time(),
+                       progress=1.0 if status == "done" else job["progress"],
+                       message="Finished" if status == "done" else "Failed")
+            if self._active.get(job["key"]) == job_id:
+                del self._active[job["key"]]
+
+    def _trim(self):
+        finished = sorted((j for j in self._jobs.values() if j["finished"]), key=lambda j: j["finished"])
+        for job in finished[:max(0, len(finished) - self._max_finished)]:
+            del self._jobs[job["id"]]
+
+    def snapshot(self, job_id):
+        """Copy of the job's state, or None for an unknown (or trimmed) job ID."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def active(self, key):
+        """ID of the queued/running job for key, or None."""
+        with self._lock:
+            return self._active.get(key)
+
+
+@st.cache_resource(show_spinner=False)
+def get_job_manager():
+    """One job manager per server process, so all sessions share single-flight keys."""
+    return BackgroundJobManager()
+
+
 # --- Speedtest Functions ---
-@st.cache_data(ttl=300)  # Cache speedtest for 5 mins if run dedicated
-def run_speedtest_dedicated():
-    """Runs a dedicated network speed test. Uses cache. Returns results dict."""
+SPEEDTEST_JOB_KEY = "speedtest"
+SPEEDTEST_STALE_AFTER = 300 # Seconds before a stored result triggers a new background test after login
+SPEEDTEST_POLL_INTERVAL = 1 # Seconds between progress refreshes while a test runs
+
+SPEEDTEST_SERVER_CACHE_KEY = "speedtest.server_cache"
+# speedtest-cli (2.1.3) pings each server 3 times, counts a failed ping as 3600 s and reports sum / 6 * 1000 ms,
+# so a server that failed every ping shows 1,800,000 ms and even one failed ping means >= 600,000 ms
+SPEEDTEST_PINGS, SPEEDTEST_FAILED_PING_S = 3, 3600
+SPEEDTEST_UNREACHABLE_MS = SPEEDTEST_PINGS * SPEEDTEST_FAILED_PING_S / 6 * 1000
+SPEEDTEST_MAX_ACCEPTABLE_LATENCY_MS = 3600 # A cached server slower than this is rediscovered
+
+def get_speedtest_config():
+    """[speedtest] server_cache_hours (default: 24) and timeout (default: 40)."""
+    try: speedtest_secrets = st.secrets.get("speedtest", {})
+    except Exception: speedtest_secrets = {}
+    return float(speedtest_secrets.get("server_cache_hours", 24)) * 3600, float(speedtest_secrets.get("timeout", 40))
+
+def select_speedtest_server(st_cli, store, cache_ttl):
+    """Picks the server, skipping discovery when a cached choice is still fresh. Returns how it was chosen.
+
+    Order: cached best server (one latency check), then the cached closest-server list,
+    then full discovery (server list download + pinging the closest servers), whose
+    result is cached for cache_ttl seconds.
+    """
+    cache = store.load_state(SPEEDTEST_SERVER_CACHE_KEY, max_age=cache_ttl) or {}
+    for label, servers in (("cached best server", [cache.get("best")]), ("cached server list", cache.get("closest"))):
+        if servers and all(servers):
+            best = st_cli.get_best_server(servers)
+            if best.get("latency", SPEEDTEST_UNREACHABLE_MS) < SPEEDTEST_MAX_ACCEPTABLE_LATENCY_MS:
+                if label == "cached server list": # Cached best went away: remember the new one, keep the list's age
+                    store.save_state(SPEEDTEST_SERVER_CACHE_KEY, dict(cache, best=best))
+                return label
+    st_cli.get_best_server()
+    store.save_state(SPEEDTEST_SERVER_CACHE_KEY, {"best": st_cli.best, "closest": st_cli.closest})
+    return "full discovery"
+
+
+def run_speedtest(progress=None, timeout=None):
+    """Runs a network speed test, reporting progress(fraction, message). Returns results dict and stores it."""
+    progress = progress or (lambda fraction, message=None: None)
+    cache_ttl, configured_timeout = get_speedtest_config()
+    store = get_history_store()
+    started = time.time()
     results = {
          "download_speed": None, "upload_speed": None, "ping": None,
-         "speedtest_server": None, "client_isp": None, "error": None
+         "speedtest_server": None, "client_isp": None, "error": None, "finished": None,
+         "server_selection": None,
          }
+
+    def phase_callback(name, low, high):
+        done = {"count": 0}
+        def callback(i, total, start=False, end=False):
+            if end:
+                done["count"] += 1
+                progress(low + (high - low) * done["count"] / max(total, 1), f"{name} {done['count']}/{total}")
+        return callback
+
     try:
-        st_cli = speedtest.Speedtest(secure=True, timeout=40) # Longer timeout for dedicated run
-        st_cli.get_best_server()
-        st_cli.download(threads=None)
-        st_cli.upload(threads=None)
+        progress(0.02, "Selecting server")
+        st_cli = speedtest.Speedtest(secure=True, timeout=timeout or configured_timeout)
+        results["server_selection"] = select_speedtest_server(st_cli, store, cache_ttl)
+        progress(0.1, f"Server: {st_cli.best.get('sponsor', 'N/A')} ({st_cli.best.get('name', 'N/A')}, {results['server_selection']})")
+        st_cli.download(callback=phase_callback("Download", 0.1, 0.55), threads=None) # Use Speedtest default threads
+        st_cli.upload(callback=phase_callback("Upload", 0.55, 1.0), threads=None)
         res_dict = st_cli.results.dict() # Get results as dict
         results["download_speed"] = res_dict.get("download", 0) / 1_000_000
         results["upload_speed"] = res_dict.get("upload", 0) / 1_000_000
         results["ping"] = res_dict.get("ping")
         results["speedtest_server"] = res_dict.get('server',{}).get('name', 'N/A')
         results["client_isp"] = res_dict.get('client', {}).get('isp', 'N/A')
-        return results # Return the full dictionary
+        record_speedtest_history(results)
     except speedtest.SpeedtestException as e:
-        error_msg = f"Speed Test Failed: {e}"
-        results["error"] = error_msg
-        return results # Return dict with error
+        results["error"] = f"Speed Test Failed: {e}"
     except Exception as e:
-        error_msg = f"Unexpected error during speed test: {e}"
-        print(f"Dedicated Speedtest Error Traceback: {traceback.format_exc()}") # Log details
-        results["error"] = error_msg
-        return results
+        results["error"] = f"Unexpected error during speed test: {e}"
+        print(f"Speedtest Error Traceback: {traceback.format_exc()}") # Log details
+    results["finished"] = time.time()
+    results["duration"] = results["finished"] - started
+    # A failed run must not hide the last good numbers, so errors are kept under their own key
+    store.save_state("speedtest.last_error" if results["error"] else "speedtest.last_result", results)
+    get_speedtest_history(store.db_path).record(results)
+    return results
+
+
+def start_speedtest_job():
+    """Starts a background speedtest, or returns the ID of the one already running (any session)."""
+    return get_job_manager().submit(SPEEDTEST_JOB_KEY, run_speedtest)
+
+
+def get_last_speedtest_result():
+    """Most recent stored speedtest result dict (survives restarts), or None.
+
+    The last successful result is returned, with "error" set if a later run failed.
+    """
+    store = get_history_store()
+    last, failed = store.load_state("speedtest.last_result"), store.load_state("speedtest.last_error")
+    if not failed or (last and last.get("finished", 0) >= failed.get("finished", 0)):
+        return last
+    if not last:
+        return failed
+    return dict(last, error=failed.get("error"), attempted=failed.get("finished"))
+
+
+def record_speedtest_history(results):
+    """Persists a successful speedtest's download/upload/ping to the metrics history."""
+    get_history_store().record_many({
+        "speedtest.download_mbps": results.get("download_speed"),
+        "speedtest.upload_mbps": results.get("upload_speed"),
+        "speedtest.ping_ms": results.get("ping"),
+    })
+
+
+class SpeedtestHistory:
+    """Every speedtest run (successful or not) in a speedtest_runs table next to the metrics history."""
+    COLUMNS = ("ts", "server", "download_mbps", "upload_mbps", "ping_ms", "isp", "server_selection", "duration_s", "error")
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = MetricsStore._connect(db_path)
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS speedtest_runs (
+                ts REAL NOT NULL, server TEXT, download_mbps REAL, upload_mbps REAL, ping_ms REAL,
+                isp TEXT, server_selection TEXT, duration_s REAL, error TEXT)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_speedtest_runs_ts ON speedtest_runs (ts)")
+
+    def record(self, results):
+        row = (results.get("finished") or time.time(), results.get("speedtest_server"), results.get("download_speed"),
+               results.get("upload_speed"), results.get("ping"), results.get("client_isp"),
+               results.get("server_selection"), results.get("duration"), results.get("error"))
+        with self._lock, self._conn:
+            self._conn.execute(f"INSERT INTO speedtest_runs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})", row)
+
+    def frame(self, since=0.0, limit=1000):
+        """Runs since `since` (epoch seconds), newest first, as a DataFrame."""
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM speedtest_runs WHERE ts >= ? ORDER BY ts DESC LIMIT ?",
+                                      (since, int(limit))).fetchall()
+        frame = pd.DataFrame(rows, columns=list(self.COLUMNS))
+        frame["time"] = pd.to_datetime(frame["ts"], unit="s")
+        return frame
+
+
+@st.cache_resource(show_spinner=False)
+def get_speedtest_history(db_path):
+    return SpeedtestHistory(db_path)
+
+
+def render_speedtest_history():
+    """Trend chart and table of past speedtest runs."""
+    range_label = st.radio("Range:", list(HISTORY_RANGES), index=3, horizontal=True, key="speedtest_history_range")
+    frame = get_speedtest_history(get_history_store().db_path).frame(since=time.time() - HISTORY_RANGES[range_label])
+    if frame.empty:
+        st.caption("No speed tests recorded in this range yet.")
+        return
+    ok = frame[frame["error"].isna()].set_index("time").sort_index()
+    if not ok.empty:
+        st.line_chart(ok[["download_mbps", "upload_mbps"]], height=220)
+        st.line_chart(ok[["ping_ms"]], height=140)
+    durations = frame.dropna(subset=["duration_s"]).groupby("server_selection")["duration_s"].mean()
+    if not durations.empty:
+        st.caption("Mean duration by server selection: " + " | ".join(f"{label}: `{secs:.1f} s`" for label, secs in durations.items()))
+    table = frame[["time", "server", "download_mbps", "upload_mbps", "ping_ms", "isp", "server_selection", "duration_s", "error"]].head(50)
+    st.dataframe(table.rename(columns={"time": "Time", "server": "Server", "download_mbps": "Down (Mbps)", "upload_mbps": "Up (Mbps)",
+                                       "ping_ms": "Ping (ms)", "isp": "ISP", "server_selection": "Server Selection",
+                                       "duration_s": "Duration (s)", "error": "Error"}),
+                 hide_index=True, use_container_width=True)
+
+
+# Time ranges offered by the history chart: label -> seconds
+HISTORY_RANGES = {"1h": 3600, "6h": 6 * 3600, "24h": 86400, "7d": 7 * 86400, "30d": 30 * 86400}
+
+def render_metrics_history():
+    """Charts persisted metrics (system, network, Pi-hole, speedtest) over a selectable range."""
+    store = get_history_store()
+    metric_names = store.list_metrics()
+    if not metric_names:
+        st.caption("No history recorded yet. Samples are written every few seconds.")
+        return
+    default_metrics = [m for m in ("system.cpu_percent", "system.ram_percent") if m in metric_names]
+    selected = st.multiselect("Metrics:", metric_names, default=default_metrics, key="history_metrics")
+    range_label = st.radio("Range:", list(HISTORY_RANGES), index=2, horizontal=True, key="history_range")
+    if not selected:
+        return
+    started = time.perf_counter()
+    frame, resolution = store.query_frame(selected, time.time() - HISTORY_RANGES[range_label])
+    query_ms = (time.perf_counter() - started) * 1000
+    if frame.empty:
+        st.caption("No data in this range yet.")
+        return
+    st.line_chart(frame)
+    st.caption(f"Resolution: `{resolution}` | Points: `{len(frame):,}` | Query: `{query_ms:.0f} ms`")
 
 
 def display_speedtest_results(results):
@@ -1516,36 +4349,337 @@ def display_speedtest_results(results):
     st.caption(f"Server: `{server_name}` | ISP: `{isp_name}`")
 
 
-# --- Azure AI SDK Call Functions ---
+# --- LAN Throughput Tester ---
+# Node-to-node TCP throughput against another dashboard, to tell a slow LAN path from a slow Internet path.
+# Per stream: the client sends a hello; the sender writes length-prefixed chunks (sendfile from a temp file),
+# a zero-length chunk and a JSON report; the receiver drains into one reusable buffer and answers with its own report.
+THROUGHPUT_MAGIC = b"CNQT"
+THROUGHPUT_HELLO = struct.Struct("!4sBBd") # magic, version, direction (0: client -> server, 1: server -> client), seconds
+THROUGHPUT_CHUNK = 1 << 20 # Bytes per framed chunk, also the receive buffer size
+THROUGHPUT_IO_TIMEOUT = 10.0 # Seconds a stream may stall before it is abandoned
+THROUGHPUT_MAX_DURATION = 30.0 # Server-side cap on the requested test length
+THROUGHPUT_MAX_STREAMS = 16 # Server-side cap on concurrent test streams
+THROUGHPUT_JOB_KEY = "throughput"
+
+def get_throughput_config():
+    """[throughput] server (default: false), bind, port (default: 5202), peer, streams (default: 4), duration (default: 5)."""
+    try: throughput_secrets = st.secrets.get("throughput", {})
+    except Exception: throughput_secrets = {}
+    return {
+        "server": bool(throughput_secrets.get("server", False)), "bind": throughput_secrets.get("bind", "0.0.0.0"),
+        "port": int(throughput_secrets.get("port", 5202)), "peer": throughput_secrets.get("peer", ""),
+        "streams": int(throughput_secrets.get("streams", 4)), "duration": float(throughput_secrets.get("duration", 5)),
+    }
 
-def get_azure_ai_text_response_stream(prompt, chat_history):
-    """Gets a streaming text response using the Azure AI Inference SDK."""
-    global azure_client, azure_ai_enabled
-    if not azure_ai_enabled or not azure_client:
-        yield "[Error: Azure AI Client not available. Check configuration and secrets.]"
-        return
 
-    messages = [SystemMessage(content=system_instruction)]
-    history_limit = 10
-    limited_history = chat_history[-history_limit*2:]
-    for msg in limited_history:
-        if isinstance(msg, dict) and msg.get("content"):
-            role = msg["role"]
-            if role == "user":
-                messages.append(UserMessage(content=msg["content"]))
-            elif role == "assistant":
-                messages.append(AssistantMessage(content=msg["content"]))
-
-    if prompt:
-        messages.append(UserMessage(content=prompt))
-    else:
-         yield "[Error: No prompt provided to generate response.]"
-         return
+def tcp_total_retransmits(sock):
+    """tcpi_total_retrans of the socket (Linux TCP_INFO), or None where unavailable."""
+    if not hasattr(socket, "TCP_INFO"): return None
+    try: info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except OSError: return None
+    return struct.unpack_from("I", info, 100)[0] if len(info) >= 104 else None
+
+def _recv_exact(sock, view):
+    """Fills the memoryview from sock; raises ConnectionError if the peer closes first."""
+    filled = 0
+    while filled < len(view):
+        received = sock.recv_into(view[filled:])
+        if not received: raise ConnectionError("peer closed the connection mid-test")
+        filled += received
+
+def _send_report(sock, report):
+    data = json.dumps(report).encode()
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+def _recv_report(sock):
+    header = bytearray(4)
+    _recv_exact(sock, memoryview(header))
+    (length,) = struct.unpack("!I", header)
+    if length > 65536: raise ConnectionError("oversized report from peer")
+    data = bytearray(length)
+    _recv_exact(sock, memoryview(data))
+    return json.loads(data)
+
+
+def _throughput_send(sock, duration):
+    """Sender side of one stream. Returns (own report, receiver's report)."""
+    cpu_started, started = time.thread_time(), time.perf_counter()
+    retransmits_before = tcp_total_retransmits(sock)
+    sent = 0
+    header = struct.pack("!I", THROUGHPUT_CHUNK)
+    with tempfile.TemporaryFile() as payload:
+        payload.write(os.urandom(THROUGHPUT_CHUNK))
+        payload.flush()
+        while time.perf_counter() - started < duration:
+            sock.sendall(header)
+            sock.sendfile(payload, 0, THROUGHPUT_CHUNK) # Zero-copy os.sendfile where available, plain send() otherwise
+            sent += THROUGHPUT_CHUNK
+    sock.sendall(struct.pack("!I", 0))
+    retransmits = tcp_total_retransmits(sock)
+    report = {"bytes": sent, "cpu_s": time.thread_time() - cpu_started,
+              "retransmits": retransmits - retransmits_before if retransmits is not None and retransmits_before is not None else None}
+    _send_report(sock, report)
+    return report, _recv_report(sock)
+
+def _throughput_receive(sock, started):
+    """Receiver side of one stream; `started` is the perf_counter() of the hello. Returns (own report, sender's report)."""
+    cpu_started = time.thread_time()
+    buffer, header = memoryview(bytearray(THROUGHPUT_CHUNK)), memoryview(bytearray(4))
+    received, finished = 0, started
+    while True:
+        _recv_exact(sock, header)
+        (length,) = struct.unpack("!I", header)
+        if not length: break
+        if length > THROUGHPUT_CHUNK: raise ConnectionError(f"chunk of {length} bytes exceeds {THROUGHPUT_CHUNK}")
+        _recv_exact(sock, buffer[:length])
+        received += length
+        finished = time.perf_counter()
+    sender_report = _recv_report(sock)
+    report = {"bytes": received, "elapsed_s": finished - started, "cpu_s": time.thread_time() - cpu_started}
+    _send_report(sock, report)
+    return report, sender_report
+
+
+class ThroughputServer:
+    """Accepts throughput test streams from other nodes, one daemon thread per stream.
+
+    Unauthenticated by design (LAN use), so it only listens once enabled from the
+    Network tab or via [throughput] server = true, and caps stream count and length.
+    """
 
+    def __init__(self, bind="0.0.0.0", port=5202):
+        self.bind, self.port = bind, int(port)
+        self.error = None
+        self.streams_served = 0
+        self._listener = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(THROUGHPUT_MAX_STREAMS)
+
+    @property
+    def running(self):
+        return self._listener is not None
+
+    def start(self):
+        """Starts listening (no-op if already running). Returns False and sets .error if the port is unavailable."""
+        with self._lock:
+            if self._listener: return True
+            try:
+                listener = socket.create_server((self.bind, self.port))
+            except OSError as e:
+                self.error = f"Cannot listen on {self.bind}:{self.port}: {e}"
+                return False
+            listener.settimeout(1.0) # Lets the accept loop notice stop()
+            self._listener, self.error = listener, None
+        threading.Thread(target=self._accept_loop, args=(listener,), name="cnq-throughput-server", daemon=True).start()
+        return True
+
+    def stop(self):
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener: listener.close()
+
+    def _accept_loop(self, listener):
+        with listener:
+            while self._listener is listener:
+                try:
+                    conn, addr = listener.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                if not self._slots.acquire(blocking=False):
+                    conn.close()
+                    continue
+                threading.Thread(target=self._serve, args=(conn, addr), name="cnq-throughput-stream", daemon=True).start()
+
+    def _serve(self, conn, addr):
+        try:
+            with conn:
+                conn.settimeout(THROUGHPUT_IO_TIMEOUT)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                hello = bytearray(THROUGHPUT_HELLO.size)
+                _recv_exact(conn, memoryview(hello))
+                magic, version, direction, duration = THROUGHPUT_HELLO.unpack(hello)
+                if magic != THROUGHPUT_MAGIC or version != 1: return
+                if direction == 0: _throughput_receive(conn, time.perf_counter())
+                else: _throughput_send(conn, min(max(duration, 0.5), THROUGHPUT_MAX_DURATION))
+                with self._lock: self.streams_served += 1
+        except (OSError, ValueError) as e:
+            print(f"Throughput server: stream from {addr[0]} failed: {e}")
+        finally:
+            self._slots.release()
+
+
+@st.cache_resource(show_spinner=False)
+def get_throughput_server(bind, port, autostart=False):
+    """One throughput server per process; autostart applies only when it is first created."""
+    server = ThroughputServer(bind, port)
+    if autostart: server.start()
+    return server
+
+def get_throughput_server_from_secrets():
+    config = get_throughput_config()
+    return get_throughput_server(config["bind"], config["port"], config["server"])
+
+
+def _throughput_stream(host, port, direction, duration, timeout):
+    """One client stream; returns connect time plus the sender's and receiver's reports."""
+    started = time.perf_counter()
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        connect_ms = (time.perf_counter() - started) * 1000
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(THROUGHPUT_HELLO.pack(THROUGHPUT_MAGIC, 1, direction, duration))
+        if direction == 0: local, remote = _throughput_send(sock, duration)
+        else: local, remote = _throughput_receive(sock, time.perf_counter())
+    sender, receiver = (local, remote) if direction == 0 else (remote, local)
+    return {"connect_ms": connect_ms, "sender": sender, "receiver": receiver, "local": local, "remote": remote}
+
+
+def run_throughput_test(progress=None, host=None, port=5202, streams=4, duration=5.0, timeout=THROUGHPUT_IO_TIMEOUT):
+    """Upload then download against a peer's ThroughputServer, `streams` parallel TCP streams each.
+
+    Returns a display_speedtest_results-compatible dict (ping = TCP connect time) plus
+    per-direction retransmits and CPU cost, and stores it as throughput.last_result.
+    """
+    progress = progress or (lambda fraction, message=None: None)
+    streams = max(1, min(int(streams), THROUGHPUT_MAX_STREAMS))
+    results = {
+         "download_speed": None, "upload_speed": None, "ping": None,
+         "speedtest_server": f"{host}:{port} (LAN, {streams} streams)", "client_isp": "LAN",
+         "error": None, "finished": None, "directions": {},
+         }
     try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=streams, thread_name_prefix="cnq-throughput") as pool:
+            for step, (direction, label, key) in enumerate(((0, "Upload", "upload_speed"), (1, "Download", "download_speed"))):
+                started = time.perf_counter()
+                futures = [pool.submit(_throughput_stream, host, port, direction, duration, timeout) for _ in range(streams)]
+                while concurrent.futures.wait(futures, timeout=0.5)[1]:
+                    progress((step + min(1.0, (time.perf_counter() - started) / duration)) / 2, f"{label}: {streams} streams")
+                runs = [future.result() for future in futures]
+                wall = time.perf_counter() - started
+                received = sum(run["receiver"]["bytes"] for run in runs)
+                elapsed = max(run["receiver"]["elapsed_s"] for run in runs) or wall
+                retransmits = [run["sender"].get("retransmits") for run in runs]
+                results[key] = received * 8 / elapsed / 1_000_000
+                results["ping"] = min([run["connect_ms"] for run in runs] + [results["ping"] or float("inf")])
+                results["directions"][label] = {
+                    "mbps": results[key], "bytes": received,
+                    "retransmits": sum(retransmits) if None not in retransmits else None,
+                    "local_cpu_pct": sum(run["local"]["cpu_s"] for run in runs) / wall * 100,
+                    "peer_cpu_pct": sum(run["remote"]["cpu_s"] for run in runs) / wall * 100,
+                }
+        get_history_store().record_many({"throughput.download_mbps": results["download_speed"], "throughput.upload_mbps": results["upload_speed"]})
+    except (OSError, ValueError) as e:
+        hint = " (is the peer's throughput server enabled?)" if isinstance(e, ConnectionRefusedError) else ""
+        results["error"] = f"Throughput test against {host}:{port} failed: {e}{hint}"
+    results["finished"] = time.time()
+    get_history_store().save_state("throughput.last_result", results)
+    return results
+
+
+def start_throughput_job(host, port, streams, duration):
+    """Starts a background throughput test, or returns the ID of the one already running (any session)."""
+    return get_job_manager().submit(THROUGHPUT_JOB_KEY, run_throughput_test, host=host, port=port, streams=streams, duration=duration)
+
+
+# --- Azure AI SDK Call Functions ---
+
+class ResponseCache:
+    """Bounded LRU + TTL cache of AI answers, shared by all sessions, with per-kind hit/miss counters.
+
+    Keys are digests built by chat_cache_key / vision_cache_key; values are whatever the
+    caller replays (a tuple of stream chunks for chat, the answer string for vision).
+    """
+
+    def __init__(self, max_entries=200, ttl=600.0):
+        self.max_entries, self.ttl = max(1, int(max_entries)), float(ttl)
+        self._entries = collections.OrderedDict() # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self.stats = collections.defaultdict(lambda: {"hits": 0, "misses": 0})
+
+    def get(self, kind, key):
+        """(value, age_seconds) on a fresh hit, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.stats[kind]["hits"] += 1
+                return entry[1], time.monotonic() - entry[0]
+            if entry: del self._entries[key] # Expired
+            self.stats[kind]["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def snapshot(self):
+        """Entry count plus hits, misses and hit rate per kind."""
+        with self._lock:
+            kinds = {kind: dict(counts, hit_pct=counts["hits"] / (counts["hits"] + counts["misses"]) * 100 if counts["hits"] + counts["misses"] else None)
+                     for kind, counts in self.stats.items()}
+            return {"entries": len(self._entries), "kinds": kinds}
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache(max_entries, ttl):
+    return ResponseCache(max_entries, ttl)
+
+def get_response_cache_from_secrets():
+    """Process-wide response cache sized by [azure_ai] response_cache_size (default: 200) and response_cache_ttl (default: 600 s)."""
+    try: azure_secrets = st.secrets.get("azure_ai", {})
+    except Exception: azure_secrets = {}
+    return get_response_cache(int(azure_secrets.get("response_cache_size", 200)), float(azure_secrets.get("response_cache_ttl", 600)))
+
+
+FOLLOW_UP_PATTERN = re.compile(r"\b(it|its|this|that|these|those|they|them|above|previous|again|more|why)\b", re.I)
+
+def normalize_prompt(prompt):
+    """Case-, whitespace- and trailing-punctuation-insensitive form of a prompt."""
+    return " ".join(prompt.lower().split()).rstrip(" ?!.")
+
+def chat_cache_key(prompt, context):
+    """Digest of the normalized prompt, the system prompt variant and, for follow-ups, the previous answer.
+
+    Standalone questions ("what is my cpu load") hit regardless of the conversation;
+    follow-ups ("explain this stat") only hit after the same preceding answer.
+    """
+    previous = next((content for role, content in reversed(context["turns"]) if role == "assistant"), "") if FOLLOW_UP_PATTERN.search(prompt) else ""
+    parts = (PHI4_MODEL_NAME, "compact" if context["compact"] else "full", normalize_prompt(prompt), previous)
+    return "chat:" + hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+def image_fingerprint(image_bytes):
+    """SHA-256 of the decoded pixels: the same screen (even re-encoded losslessly) gives the same value, any visible change a new one."""
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    digest = hashlib.sha256(f"{img.width}x{img.height}".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+def vision_cache_key(prompt, image_bytes):
+    return "vision:" + hashlib.sha256(f"{PHI4_MODEL_NAME}\x1f{normalize_prompt(prompt)}\x1f{image_fingerprint(image_bytes)}".encode()).hexdigest()
+
+
+def _stream_chat_completion(client, messages, retries):
+    """Text deltas of a streaming chat completion on the synchronous shared client.
+
+    Holds a guard slot for the whole stream, so concurrent sessions queue there; retry
+    notes are appended to `retries`.
+    """
+    metrics = get_azure_transport_metrics()
+    guard = get_azure_call_guard_from_secrets()
+    attempt_started = {}
+    def complete(**kwargs):
+        attempt_started["t"] = time.perf_counter() # First-token latency excludes backoff waits
+        return client.complete(**kwargs)
+    with guard.slot():
         # *** FIX: Use client.complete instead of client.chat_completions ***
         # Also pass model name directly to complete method as per docs
-        response_stream = azure_client.complete(
+        response_stream = guard.call(
+            complete,
+            on_retry=lambda attempt, delay, reason: retries.append(f"{reason}, retry {attempt} after {delay:.1f}s"),
             model=PHI4_MODEL_NAME,
             messages=messages,
             temperature=0.6,
@@ -1555,83 +4689,120 @@ def get_azure_ai_text_response_stream(prompt, chat_history):
             # Optional: Include usage data in stream as per docs example
             # model_extras = {'stream_options': {'include_usage': True}},
         )
-
-        chunk_count = 0
-        # Usage data handling if model_extras is enabled:
-        # usage = {}
+        first_token = True
         for chunk in response_stream:
             # Check for content delta
             if chunk.choices and len(chunk.choices) > 0:
                 delta = chunk.choices[0].delta
                 if delta and delta.content:
+                    if first_token and metrics: metrics.record_first_token((time.perf_counter() - attempt_started["t"]) * 1000)
+                    first_token = False
                     yield delta.content
-                    chunk_count += 1
-            # Optional: Handle usage data accumulation if included in stream
-            # if chunk.usage:
-            #    usage = chunk.usage
-            #    print(f"DEBUG Usage Update: {usage}") # For debugging
 
-        # End of stream signal - keep this
-        yield "[STREAM_DONE]"
 
-        # Optional: Print final usage if collected
-        # if usage:
-        #    print("\n--- Final Stream Usage ---")
-        #    for k, v in usage.items(): print(f"{k} = {v}")
-        #    print("------------------------")
+def get_azure_ai_text_response_stream(prompt, chat_history, use_cache=True):
+    """Gets a streaming text response using the Azure AI Inference SDK.
+
+    With use_cache, a fresh cached answer to the same question is replayed chunk by chunk instead.
+    """
+    client = get_azure_client() # Built on first use
+    if not azure_ai_enabled or not client:
+        yield "[Error: Azure AI Client not available. Check configuration and secrets.]"
+        return
 
+    if not prompt:
+         yield "[Error: No prompt provided to generate response.]"
+         return
 
-    except ClientAuthenticationError:
+    context = build_chat_context(prompt, chat_history, *get_context_config())
+    messages = [azure_models.SystemMessage(content=context["system"])]
+    for role, content in context["turns"]:
+        messages.append(azure_models.UserMessage(content=content) if role == "user" else azure_models.AssistantMessage(content=content))
+    messages.append(azure_models.UserMessage(content=context["prompt"]))
+    if context["dropped"]:
+        yield f"[Info: Context trimmed to ~{context['tokens']:,} tokens; {context['dropped']} older message(s) summarized.]"
+
+    cache = get_response_cache_from_secrets() if use_cache else None
+    cache_key = chat_cache_key(prompt, context) if cache else None
+    cached = cache.get("chat", cache_key) if cache else None
+    if cached:
+        chunks, age = cached
+        yield f"[Info: Cached answer from {age:.0f}s ago (turn off response cache for a fresh one).]"
+        yield from chunks
+        yield "[STREAM_DONE]"
+        return
+
+    service = get_inference_service_from_secrets()
+    retries, ticket, deltas = [], None, None
+    try:
+        if service: # Queued fairly with other sessions' requests on the shared event loop
+            ticket = service.submit(messages, get_session_uid(), kind="chat", priority=INFERENCE_PRIORITY["chat"],
+                                    temperature=0.6, top_p=0.9, max_tokens=2048, stream=True)
+            deltas, retries = ticket.stream(), ticket.retries
+        else:
+            deltas = _stream_chat_completion(client, messages, retries)
+
+        chunks = []
+        for delta in deltas:
+            if not chunks and retries: yield f"[Warning: Azure AI was busy ({retries[-1]}); answered after {len(retries)} retr{'y' if len(retries) == 1 else 'ies'}.]"
+            yield delta
+            chunks.append(delta)
+        if cache and chunks: cache.put(cache_key, tuple(chunks)) # Only complete answers are cached
+        # End of stream signal - keep this. Sent after the slot is released: consumers stop reading here
+        yield "[STREAM_DONE]"
+
+    except AzureUnavailableError as e:
+        yield f"[Error: {e}]"
+    except azure_exceptions.ClientAuthenticationError:
         yield "[Error: Azure AI Authentication Failed. Check API Key in secrets.]"
-    except HttpResponseError as e:
-        # ... (existing HttpResponseError handling remains the same) ...
-        error_details = f"Status: {getattr(e, 'status_code', 'N/A')}"
-        nested_error_msg = ""
-        try:
-            error_body = e.response.json().get("error", {})
-            nested_error_msg = error_body.get("message", getattr(e, 'message', str(e)))
-            nested_error_code = error_body.get("code", "")
-            if nested_error_code: error_details += f" Code: {nested_error_code}"
-        except: nested_error_msg = getattr(e, 'message', str(e)) # Fallback
-        error_details += f" | Detail: {nested_error_msg}"
+    except azure_exceptions.HttpResponseError as e:
+        error_details = describe_azure_error(e)
         print(f"Azure Text Stream _HttpResponseError_: Status={e.status_code}, Response: {e.response.text if e.response else 'N/A'}")
         yield f"[Error: API Call Failed ({e.__class__.__name__}). {error_details}]"
 
     except Exception as e:
         print(f"Traceback (Azure Text Stream Error): {traceback.format_exc()}")
         yield f"[Error: Unexpected SDK streaming error - {type(e).__name__}]"
+    finally:
+        if deltas is not None: deltas.close() # Releases the slot / stops the queued request if the reader gave up
+        if ticket: ticket.cancel()
+
+
+def describe_azure_error(e):
+    """'Status: ... Code: ... | Detail: ...' summary of an azure-core HttpResponseError."""
+    error_details = f"Status: {getattr(e, 'status_code', 'N/A')}"
+    try:
+        error_body = e.response.json().get("error", {})
+        nested_error_msg = error_body.get("message", getattr(e, 'message', str(e)))
+        nested_error_code = error_body.get("code", "")
+        if nested_error_code: error_details += f" Code: {nested_error_code}"
+    except Exception: nested_error_msg = getattr(e, 'message', str(e)) # Fallback
+    return error_details + f" | Detail: {nested_error_msg}"
 
-def get_azure_ai_vision_response(prompt, image_bytes):
-    """Gets a response for multimodal input (text + image) using Azure AI SDK."""
-    global azure_client, azure_ai_enabled
-    if not azure_ai_enabled or not azure_client:
-        return "[Error: Azure AI Client not available. Check configuration and secrets.]"
 
+def build_vision_messages(prompt, image_bytes):
+    """SDK message list (text + image data URL) for a vision question; raises if the image can't be encoded."""
     # --- Image Processing (Existing code is likely fine) ---
+    # Determine MIME type programmatically if possible, or assume JPEG/PNG
     try:
-        # Determine MIME type programmatically if possible, or assume JPEG/PNG
-        try:
-            temp_img = Image.open(io.BytesIO(image_bytes))
-            img_format = temp_img.format if temp_img.format else "JPEG" # Default to JPEG
-            image_mime_type = Image.MIME.get(img_format.upper(), "image/jpeg")
-        except Exception: # Fallback if Pillow can't identify
-            image_mime_type = "image/jpeg" # Default assumption
-
-        img_base64 = base64.b64encode(image_bytes).decode("utf-8")
-        image_data_url = f"data:{image_mime_type};base64,{img_base64}"
-    except Exception as e:
-        print(f"Error encoding image for Azure Vision: {traceback.format_exc()}")
-        return f"[Error: Failed to encode image - {type(e).__name__}]"
+        temp_img = Image.open(io.BytesIO(image_bytes))
+        img_format = temp_img.format if temp_img.format else "JPEG" # Default to JPEG
+        image_mime_type = Image.MIME.get(img_format.upper(), "image/jpeg")
+    except Exception: # Fallback if Pillow can't identify
+        image_mime_type = "image/jpeg" # Default assumption
+
+    img_base64 = base64.b64encode(image_bytes).decode("utf-8")
+    image_data_url = f"data:{image_mime_type};base64,{img_base64}"
 
     # --- Construct multimodal message payload using SDK models (as per docs) ---
-    messages = [
-        UserMessage(
+    return [
+        azure_models.UserMessage(
             content=[
                 # *** FIX: Use TextContentItem ***
-                TextContentItem(text=prompt),
+                azure_models.TextContentItem(text=prompt),
                 # *** FIX: Use ImageContentItem wrapping ImageUrl ***
-                ImageContentItem(
-                    image_url=ImageUrl(
+                azure_models.ImageContentItem(
+                    image_url=azure_models.ImageUrl(
                         url=image_data_url
                         # Optional: Set detail level if needed, default is often 'auto'
                         # detail=ImageDetailLevel.LOW # or HIGH
@@ -1640,69 +4811,99 @@ def get_azure_ai_vision_response(prompt, image_bytes):
             ]
         )
         # Optional System Message for Vision tasks
-        # SystemMessage(content="Describe the provided image accurately based on the user's text query."),
+        # azure_models.SystemMessage(content="Describe the provided image accurately based on the user's text query."),
     ]
 
-    try:
-        # *** FIX: Use client.complete instead of client.chat_completions ***
-        # Pass model name directly to complete method
-        response = azure_client.complete(
-            model=PHI4_MODEL_NAME,
-            messages=messages,
-            max_tokens=2048,
-            temperature=0.3,
-            top_p=0.9,
-            stream=False, # Vision is typically synchronous
-        )
 
-        # --- Process Response (Existing logic seems okay) ---
-        if response.choices and len(response.choices) > 0:
-            # ... (your existing logic for processing choice, message, finish_reason) ...
-            choice = response.choices[0]
-            message_content = choice.message.content if choice.message else None
-            finish_reason = choice.finish_reason # Correct attribute based on SDK structure
-
-            if message_content:
-                # Basic check for common refusal phrases / content policy issues
-                refusal_phrases = [
-                    "unable to process", "cannot process", "can't process", "i cannot", "unable to create",
-                    "i'm sorry", "cannot fulfill this request", "content policy", "violates my safety policies"
-                    ]
-                # Also check finish reason if available (might indicate content filtering)
-                is_filtered = finish_reason == "content_filter"
-                is_refusal_phrase = any(phrase in message_content.lower() for phrase in refusal_phrases)
-                # Heuristic for short refusals vs potentially short valid answers
-                is_short_refusal_heuristic = len(message_content) < 80 and is_refusal_phrase
-
-                if is_filtered or is_short_refusal_heuristic:
-                    # Provide more context in the warning/error
-                    return f"[Info: Model refused or response filtered. Finish reason: '{finish_reason}'. Response: '{message_content.strip()}']"
-                else:
-                    return message_content.strip() # Return the actual analysis content
+def format_vision_completion(response):
+    """Answer text of a vision ChatCompletions response, or an [Info:/[Error: string for refusals and bad responses."""
+    # --- Process Response (Existing logic seems okay) ---
+    if response.choices and len(response.choices) > 0:
+        # ... (your existing logic for processing choice, message, finish_reason) ...
+        choice = response.choices[0]
+        message_content = choice.message.content if choice.message else None
+        finish_reason = choice.finish_reason # Correct attribute based on SDK structure
+
+        if message_content:
+            # Basic check for common refusal phrases / content policy issues
+            refusal_phrases = [
+                "unable to process", "cannot process", "can't process", "i cannot", "unable to create",
+                "i'm sorry", "cannot fulfill this request", "content policy", "violates my safety policies"
+                ]
+            # Also check finish reason if available (might indicate content filtering)
+            is_filtered = finish_reason == "content_filter"
+            is_refusal_phrase = any(phrase in message_content.lower() for phrase in refusal_phrases)
+            # Heuristic for short refusals vs potentially short valid answers
+            is_short_refusal_heuristic = len(message_content) < 80 and is_refusal_phrase
+
+            if is_filtered or is_short_refusal_heuristic:
+                # Provide more context in the warning/error
+                return f"[Info: Model refused or response filtered. Finish reason: '{finish_reason}'. Response: '{message_content.strip()}']"
             else:
-                # Content is empty, provide finish reason if available
-                return f"[Error: Azure Vision response received, but content was empty. Finish Reason: '{finish_reason}']"
+                return message_content.strip() # Return the actual analysis content
         else:
-            # ... (your existing logic for handling invalid response structure) ...
-             usage_info = response.usage if hasattr(response, 'usage') else 'N/A'
-             try: raw_response_str = response.model_dump_json(indent=2)
-             except: raw_response_str = str(response)
-             print(f"DEBUG: Invalid Azure Vision response structure. Usage: {usage_info}. Raw: {raw_response_str[:500]}")
-             return f"[Error: Invalid Azure Vision response structure (no choices?). Usage: {usage_info}.]"
-
-    except ClientAuthenticationError:
+            # Content is empty, provide finish reason if available
+            return f"[Error: Azure Vision response received, but content was empty. Finish Reason: '{finish_reason}']"
+    else:
+        # ... (your existing logic for handling invalid response structure) ...
+         usage_info = response.usage if hasattr(response, 'usage') else 'N/A'
+         try: raw_response_str = response.model_dump_json(indent=2)
+         except: raw_response_str = str(response)
+         print(f"DEBUG: Invalid Azure Vision response structure. Usage: {usage_info}. Raw: {raw_response_str[:500]}")
+         return f"[Error: Invalid Azure Vision response structure (no choices?). Usage: {usage_info}.]"
+
+
+def get_azure_ai_vision_response(prompt, image_bytes, use_cache=True):
+    """Gets a response for multimodal input (text + image) using Azure AI SDK.
+
+    With use_cache, the same question about an unchanged screen (identical pixels) returns the cached answer.
+    """
+    client = get_azure_client() # Built on first use
+    if not azure_ai_enabled or not client:
+        return "[Error: Azure AI Client not available. Check configuration and secrets.]"
+
+    cache = get_response_cache_from_secrets() if use_cache else None
+    try: cache_key = vision_cache_key(prompt, image_bytes) if cache else None
+    except Exception: cache, cache_key = None, None # Unreadable image: let the API report it
+    cached = cache.get("vision", cache_key) if cache else None
+    if cached: return cached[0]
+
+    try:
+        messages = build_vision_messages(prompt, image_bytes)
+    except Exception as e:
+        print(f"Error encoding image for Azure Vision: {traceback.format_exc()}")
+        return f"[Error: Failed to encode image - {type(e).__name__}]"
+
+    service = get_inference_service_from_secrets()
+    try:
+        if service: # Served after queued chat requests, fairly with other sessions
+            response = service.submit(messages, get_session_uid(), kind="vision", priority=INFERENCE_PRIORITY["vision"],
+                                      max_tokens=2048, temperature=0.3, top_p=0.9, stream=False).result()
+        else:
+            guard = get_azure_call_guard_from_secrets()
+            # *** FIX: Use client.complete instead of client.chat_completions ***
+            # Pass model name directly to complete method
+            with guard.slot():
+                response = guard.call(
+                    client.complete,
+                    model=PHI4_MODEL_NAME,
+                    messages=messages,
+                    max_tokens=2048,
+                    temperature=0.3,
+                    top_p=0.9,
+                    stream=False, # Vision is typically synchronous
+                )
+
+        result = format_vision_completion(response)
+        if cache and not result.startswith("["): cache.put(cache_key, result) # Refusals and errors are not cached
+        return result
+
+    except AzureUnavailableError as e:
+        return f"[Error: {e}]"
+    except azure_exceptions.ClientAuthenticationError:
         return "[Error: Azure AI Authentication Failed. Check API Key.]"
-    except HttpResponseError as e:
-        # ... (existing HttpResponseError handling remains the same) ...
-        error_details = f"Status: {getattr(e, 'status_code', 'N/A')}"
-        nested_error_msg = ""
-        try:
-            error_body = e.response.json().get("error", {})
-            nested_error_msg = error_body.get("message", getattr(e, 'message', str(e)))
-            nested_error_code = error_body.get("code", "")
-            if nested_error_code: error_details += f" Code: {nested_error_code}"
-        except: nested_error_msg = getattr(e, 'message', str(e))
-        error_details += f" | Detail: {nested_error_msg}"
+    except azure_exceptions.HttpResponseError as e:
+        error_details = describe_azure_error(e)
         print(f"Azure Vision _HttpResponseError_: Status={e.status_code}, Response Body: {e.response.text if e.response else 'N/A'}")
         return f"[Error: Vision API Call Failed ({e.__class__.__name__}). {error_details}]"
 
@@ -1712,6 +4913,123 @@ def get_azure_ai_vision_response(prompt, image_bytes):
 
 
 
+class MockInferenceEndpoint:
+    """Local stand-in for the Azure AI chat completions endpoint, for offline benchmarks.
+
+    Answers any POST after `first_token_delay` seconds: a ChatCompletions JSON body, or for
+    stream=true an SSE stream of `tokens` deltas `token_delay` seconds apart.
+    """
+
+    def __init__(self, first_token_delay=0.25, token_delay=0.02, tokens=20):
+        self.first_token_delay, self.token_delay, self.tokens = float(first_token_delay), float(token_delay), int(tokens)
+        self.requests = 0
+        endpoint = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, like the real endpoint
+            def log_message(self, *args): pass
+            def do_POST(self): endpoint._handle(self)
+            def handle(self):
+                try: super().handle()
+                except ConnectionError: pass # Client closed a keep-alive connection (e.g. its service stopped)
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, name="mock-inference", daemon=True).start()
+
+    def _handle(self, handler):
+        body = json.loads(handler.rfile.read(int(handler.headers.get("Content-Length", 0))) or b"{}")
+        self.requests += 1
+        time.sleep(self.first_token_delay)
+        if not body.get("stream"):
+            out = json.dumps({"id": "mock", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", "mock"),
+                              "choices": [{"index": 0, "message": {"role": "assistant", "content": "mock " * self.tokens}, "finish_reason": "stop"}],
+                              "usage": {"prompt_tokens": 1, "completion_tokens": self.tokens, "total_tokens": self.tokens + 1}}).encode()
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(out)))
+            handler.end_headers()
+            handler.wfile.write(out)
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        def send(data):
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            handler.wfile.flush()
+        for i in range(self.tokens):
+            if i: time.sleep(self.token_delay)
+            chunk = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model", "mock"),
+                     "choices": [{"index": 0, "delta": {"role": "assistant", "content": "mock "}, "finish_reason": None}]}
+            send(f"data: {json.dumps(chunk)}\n\n".encode())
+        send(b"data: [DONE]\n\n")
+        handler.wfile.write(b"0\r\n\r\n")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+INFERENCE_BENCHMARK_JOB_KEY = "inference_benchmark"
+
+def _inference_benchmark_round(url, workers, sessions, requests_per_session, burst, timeout):
+    """One round against the mock: a burst session queues `burst` vision requests, then the
+    other sessions `requests_per_session` streaming chat requests each. Returns a result row."""
+    service = AsyncInferenceService(url, "mock", AzureCallGuard(max_retries=0, max_concurrent=workers, slot_timeout=timeout),
+                                    workers=workers, max_queued_per_session=max(burst, requests_per_session))
+    message = [azure_models.UserMessage(content="benchmark")]
+    try:
+        started = time.monotonic()
+        tickets = [service.submit(message, "burst", kind="vision", priority=INFERENCE_PRIORITY["vision"], max_tokens=64) for _ in range(burst)]
+        tickets += [service.submit(message, f"session-{s}", kind="chat", priority=INFERENCE_PRIORITY["chat"], max_tokens=64, stream=True)
+                    for s in range(1, sessions) for _ in range(requests_per_session)] # Session by session: FIFO would serve them in turn
+        errors = 0
+        for ticket in tickets:
+            try: ticket.result(timeout=timeout)
+            except Exception: errors += 1
+        elapsed = time.monotonic() - started
+    finally:
+        service.stop()
+    ms = lambda tickets_of, start, end: [(getattr(t, end) - getattr(t, start)) * 1000 for t in tickets_of if getattr(t, start) and getattr(t, end)]
+    chat, vision = [t for t in tickets if t.kind == "chat"], [t for t in tickets if t.kind == "vision"]
+    session_waits = [statistics.mean(ms([t for t in chat if t.session_id == s], "submitted", "started") or [0.0]) for s in {t.session_id for t in chat}]
+    row = {"workers": workers, "requests": len(tickets), "errors": errors, "seconds": elapsed, "req_per_s": len(tickets) / elapsed if elapsed else None,
+           "session_wait_spread_ms": max(session_waits) - min(session_waits) if session_waits else None}
+    for kind, group in (("chat", chat), ("vision", vision)):
+        for metric, start, end in (("wait", "submitted", "started"), ("first_token", "submitted", "first_token"), ("total", "submitted", "finished")):
+            values = ms(group, start, end)
+            p50, p95 = latency_percentiles(values, (50, 95))
+            row[f"{kind}_{metric}_p50_ms"], row[f"{kind}_{metric}_p95_ms"] = p50, p95
+    return row
+
+
+def run_inference_benchmark(progress=None, workers=4, sessions=4, requests_per_session=4, burst=8,
+                            first_token_delay=0.25, token_delay=0.02, tokens=20, timeout=60.0):
+    """Offline benchmark of AsyncInferenceService against a MockInferenceEndpoint.
+
+    Runs the same mixed load with one worker (a strictly serial client) and with `workers`
+    workers, so the rows show the concurrency speed-up, chat latency while vision requests
+    are queued (priority) and how evenly chat sessions were served (fairness).
+    """
+    progress = progress or (lambda fraction, message=None: None)
+    endpoint = MockInferenceEndpoint(first_token_delay, token_delay, tokens)
+    rows = []
+    try:
+        for i, worker_count in enumerate(sorted({1, max(1, int(workers))})):
+            progress(i / 2, f"{worker_count} worker(s): {burst + (sessions - 1) * requests_per_session} requests")
+            rows.append(_inference_benchmark_round(endpoint.url, worker_count, max(2, int(sessions)), int(requests_per_session), int(burst), timeout))
+    finally:
+        endpoint.stop()
+    result = {"ts": time.time(), "rows": rows, "mock": {"first_token_delay": first_token_delay, "token_delay": token_delay, "tokens": tokens}}
+    get_history_store().save_state("inference_benchmark.last_result", result)
+    return result
+
+
+def start_inference_benchmark_job(workers):
+    """Starts the offline inference benchmark in the background (single-flight across sessions)."""
+    return get_job_manager().submit(INFERENCE_BENCHMARK_JOB_KEY, run_inference_benchmark, workers=workers)
+
+
 # --- Simulated Quantum Security Audit ---
 def simulate_quantum_security_audit():
     """Performs basic CLASSICAL checks and reports them with Azure Quantum inspired terminology."""
@@ -1772,13 +5090,16 @@ def simulate_quantum_security_audit():
     open_access_details = []
 
     try:
-        listening_conns = psutil.net_connections(kind="inet")
+        if get_proc_fast_path_enabled(): # No pids needed: read the socket tables directly
+            proc, proc_lock = get_shared_proc_fast_path()
+            with proc_lock: sockets = proc.tcp_sockets()
+            listeners = [(lip, lport) for _family, lip, lport, _rip, _rport, state in sockets if state == "LISTEN"]
+        else:
+            listeners = [(conn.laddr.ip, conn.laddr.port) for conn in psutil.net_connections(kind="inet") if conn.status == psutil.CONN_LISTEN]
         # Check ports listening on ALL non-loopback interfaces
-        listening_ports_all_if = { conn.laddr.port for conn in listening_conns
-            if conn.status == psutil.CONN_LISTEN and conn.laddr.ip not in ['127.0.0.1', '::1', 'localhost'] }
+        listening_ports_all_if = { port for ip, port in listeners if ip not in ['127.0.0.1', '::1', 'localhost'] }
         # Check localhost listeners separately
-        listening_ports_local = { conn.laddr.port for conn in listening_conns
-            if conn.status == psutil.CONN_LISTEN and conn.laddr.ip in ['127.0.0.1', '::1', 'localhost'] }
+        listening_ports_local = { port for ip, port in listeners if ip in ['127.0.0.1', '::1', 'localhost'] }
 
         # Classify open ports
         for port, reason in common_risky_ports.items():
@@ -1835,6 +5156,923 @@ def simulate_quantum_security_audit():
     return report
 
 
+# --- Live Panels (Fragments) ---
+# Each live panel is a Streamlit fragment with its own refresh interval: only the panel
+# re-executes on its timer, the rest of the page (tabs, chat history) stays idle and interactive.
+LIVE_STATS_INTERVAL = max(1.0, get_metrics_sampler_config()[0]) # No point refreshing faster than the sampler
+TRAFFIC_SCAN_INTERVAL = 3 # Seconds between traffic rate calculations
+CONNECTION_REFRESH_INTERVAL = 5 # Seconds between connection table polls (shared snapshot TTL)
+LATENCY_PROBE_REFRESH_INTERVAL = 5 # Seconds between prober panel refreshes
+SCREEN_REFRESH_INTERVAL = 0.7 # ~1.4 FPS. Increase if CPU usage too high
+
+
+@st.fragment(run_every=LIVE_STATS_INTERVAL)
+def render_live_stats():
+    """Sidebar vitals from the background sampler."""
+    col_cpu, col_temp = st.columns(2)
+    col_ram, col_disk = st.columns(2)
+    try:
+        pi_stats = get_pi_status() # Latest background sample
+        # Define colors based on thresholds
+        cpu_color = "#ccff00"; temp_color="#ff9933"; ram_color="#00ffff"; disk_color="#ff00ff"
+        try: temp_val = float(re.findall(r"[-+]?\d*\.\d+|\d+", pi_stats['cpu_temperature'])[0])
+        except: temp_val = -100
+        if temp_val > 75: temp_color = "#ff0000" # Red
+        elif temp_val > 60: temp_color = "#ffff00" # Yellow
+
+        try: cpu_val = float(pi_stats['cpu_usage'].strip('%'))
+        except: cpu_val = 0
+        if cpu_val > 90: cpu_color = "#ff0000"
+        elif cpu_val > 70: cpu_color = "#ffff00"
+
+        try: ram_val = float(pi_stats['ram_usage'].split('%')[0])
+        except: ram_val = 0
+        if ram_val > 90: ram_color = "#ff0000"
+        elif ram_val > 75: ram_color = "#ffff00"
+
+        try: disk_val = float(pi_stats['disk_usage'].split('%')[0])
+        except: disk_val = 0
+        if disk_val > 90: disk_color = "#ff0000"
+        elif disk_val > 80: disk_color = "#ffff00"
+
+
+        with col_cpu: st.markdown(f"**CPU:** <span style='color: {cpu_color};'>{pi_stats['cpu_usage']}</span>", unsafe_allow_html=True)
+        with col_temp: st.markdown(f"**Temp:** <span style='color: {temp_color};'>{pi_stats['cpu_temperature']}</span>", unsafe_allow_html=True)
+        with col_ram: st.markdown(f"**RAM:** <span style='color: {ram_color};'>{pi_stats['ram_usage'].split(' ')[0]}</span>", unsafe_allow_html=True)
+        with col_disk: st.markdown(f"**Disk:** <span style='color: {disk_color};'>{pi_stats['disk_usage'].split(' ')[0]}</span>", unsafe_allow_html=True)
+
+        # Detailed usage in caption
+        ram_detail = pi_stats['ram_usage'].split(' (',1)[1].split(')',1)[0] if ' (' in pi_stats['ram_usage'] else '-'
+        disk_detail = pi_stats['disk_usage'].split(' (',1)[1].split(')',1)[0] if ' (' in pi_stats['disk_usage'] else '-'
+        st.caption(f"RAM: {ram_detail} | Disk: {disk_detail}")
+
+    except Exception as e: st.error(f"Live stats error: {type(e).__name__}")
+
+
+@st.fragment(run_every=SPEEDTEST_POLL_INTERVAL)
+def job_progress_fragment(job_key, session_key, label):
+    """Progress bar of a running background job, refreshed every SPEEDTEST_POLL_INTERVAL; reruns the page once it finishes."""
+    manager = get_job_manager()
+    job_id = manager.active(job_key) or st.session_state.get(session_key)
+    job = manager.snapshot(job_id) if job_id else None
+    if job and job["status"] in ("queued", "running"):
+        st.progress(job["progress"], text=f"{label} running: {job['message']}")
+        st.caption(f"Job `{job['id']}`")
+        return
+    st.rerun() # Finished: the caller redraws its (static) result
+
+def poll_background_job(job_key, session_key, label, icon):
+    """Shows a polling progress fragment and returns True while the job is queued or running.
+
+    Otherwise returns False without polling; a finished job started by this session is
+    cleared from session_state (failures are toasted), so idle pages don't refresh at all.
+    """
+    manager = get_job_manager()
+    job_id = manager.active(job_key) or st.session_state.get(session_key)
+    job = manager.snapshot(job_id) if job_id else None
+    if job and job["status"] in ("queued", "running"):
+        job_progress_fragment(job_key, session_key, label)
+        return True
+    if job and job_id == st.session_state.get(session_key):
+        del st.session_state[session_key]
+        if job["status"] == "error": st.toast(f"{label} failed: {job['error']}", icon=icon)
+    return False
+
+
+def speedtest_overview_panel():
+    """Last known speedtest result, plus the progress of a running background test (the only time it polls)."""
+    poll_background_job(SPEEDTEST_JOB_KEY, 'speedtest_job_id', "Speed test", "⚡")
+
+    network_data = get_network_overview()
+    st.markdown("#### Network Overview (Last Scan)")
+    if network_data.get("download_speed") is None: st.caption("No speed test result yet.")
+    else: display_speedtest_results(dict(network_data, error=None))
+    if network_data.get("speedtest_error"): st.caption(f"*Speedtest Note (latest run):* _{network_data['speedtest_error']}_")
+    finished = network_data.get("speedtest_finished")
+    if finished: st.caption(f"Measured {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(finished))} ({(time.time() - finished) / 60:.0f} min ago)")
+    st.caption(f"External IP: `{network_data.get('external_ip', 'N/A')}`")
+    if network_data.get("external_ip_error"): st.caption(f"*Ext. IP Note:* _{network_data['external_ip_error']}_")
+
+
+def throughput_test_panel():
+    """Progress of a running LAN throughput test (polled), then its result next to the last Internet speedtest."""
+    if poll_background_job(THROUGHPUT_JOB_KEY, 'throughput_job_id', "Throughput test", "🔁"): return
+
+    lan = get_history_store().load_state("throughput.last_result")
+    if not lan:
+        st.caption("No LAN throughput test yet.")
+        return
+    col_lan, col_wan = st.columns(2)
+    with col_lan:
+        st.markdown("##### LAN (node to node)")
+        display_speedtest_results(lan)
+    with col_wan:
+        st.markdown("##### Internet (last speed test)")
+        wan = get_last_speedtest_result()
+        if wan and wan.get("download_speed") is not None: display_speedtest_results(dict(wan, error=None))
+        else: st.caption("No speed test result yet.")
+    if lan.get("directions"):
+        st.dataframe(pd.DataFrame([{
+            "Direction": label, "Mbps": d["mbps"], "Transferred": format_bytes(d["bytes"]),
+            "Retransmits": d["retransmits"], "CPU here (% core)": d["local_cpu_pct"], "CPU peer (% core)": d["peer_cpu_pct"],
+        } for label, d in lan["directions"].items()]).style.format(
+            {"Mbps": "{:.1f}", "Retransmits": "{:.0f}", "CPU here (% core)": "{:.0f}", "CPU peer (% core)": "{:.0f}"}, na_rep="N/A"),
+            hide_index=True, use_container_width=True)
+        if wan and wan.get("download_speed") and not lan.get("error"):
+            lan_down, wan_down = lan["download_speed"], wan["download_speed"]
+            st.caption(f"LAN download is {lan_down / wan_down:.1f}x the Internet download: "
+                       + ("the LAN path is the likely bottleneck." if lan_down < wan_down * 1.5 else "the Internet link is the likely bottleneck."))
+    st.caption(f"Measured {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(lan['finished']))}")
+
+
+def render_throughput_tester():
+    """Server toggle and client controls for the node-to-node throughput test."""
+    config = get_throughput_config()
+    server = get_throughput_server_from_secrets()
+    st.session_state.throughput_server_on = server.running # Process-wide state; another session may have changed it
+    st.checkbox(f"Accept tests from other nodes (TCP {server.port})", key="throughput_server_on",
+                on_change=lambda: server.start() if st.session_state.throughput_server_on else server.stop(),
+                help="Unauthenticated listener for LAN use; also enabled at startup by [throughput] server = true.")
+    if server.error: st.warning(server.error)
+    elif server.running: st.caption(f"Listening on `{server.bind}:{server.port}` | Streams served: `{server.streams_served}`")
+
+    col_peer, col_streams, col_duration = st.columns([2, 1, 1])
+    with col_peer: peer = st.text_input("Peer node (host or host:port):", value=config["peer"], key="throughput_peer")
+    with col_streams: streams = st.number_input("Streams:", 1, THROUGHPUT_MAX_STREAMS, max(1, min(config["streams"], THROUGHPUT_MAX_STREAMS)), key="throughput_streams")
+    with col_duration: duration = st.number_input("Seconds per direction:", 1, int(THROUGHPUT_MAX_DURATION), max(1, min(int(config["duration"]), int(THROUGHPUT_MAX_DURATION))), key="throughput_duration")
+    if st.button("🔁 Run LAN Throughput Test", key="throughput_run_btn", disabled=not peer.strip()):
+        peer = peer.strip()
+        host, _, port = peer.rpartition(":") if peer.count(":") == 1 or peer.startswith("[") else (peer, "", "")
+        try: port = int(port) if port else config["port"]
+        except ValueError: st.error(f"Invalid port in `{peer}`."); return
+        st.session_state.throughput_job_id = start_throughput_job(host.strip("[]"), port, int(streams), float(duration))
+    throughput_test_panel() # Polls only while a test runs
+
+
+def dns_benchmark_panel():
+    """Progress of a running DNS benchmark (polled), then the latest run and p50 latency over time (loaded once per run)."""
+    if poll_background_job(DNS_BENCHMARK_JOB_KEY, 'dns_benchmark_job_id', "DNS benchmark", "⏱️"): return
+
+    history = get_dns_benchmark_history(get_history_store().db_path).frame(since=time.time() - HISTORY_RANGES["30d"])
+    if history.empty:
+        st.caption("No DNS benchmark recorded yet.")
+        return
+    latest = history[history["ts"] == history["ts"].max()]
+    st.markdown(f"**Latest run** ({time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(latest['ts'].iloc[0]))})")
+    st.dataframe(latest[["resolver", "category", "p50_ms", "p95_ms", "p99_ms", "failure_pct", "queries"]].rename(columns={
+        "resolver": "Resolver", "category": "Names", "p50_ms": "p50 (ms)", "p95_ms": "p95 (ms)", "p99_ms": "p99 (ms)",
+        "failure_pct": "Failures (%)", "queries": "Queries"}).style.format(
+        {"p50 (ms)": "{:.1f}", "p95 (ms)": "{:.1f}", "p99 (ms)": "{:.1f}", "Failures (%)": "{:.0f}"}, na_rep="—"),
+        hide_index=True, use_container_width=True)
+    p50 = latest.pivot_table(index="resolver", columns="category", values="p50_ms")
+    if {"cached", "uncached"} <= set(p50.columns):
+        st.caption("Cache-hit effect (uncached − cached p50): " + " | ".join(
+            f"{resolver}: `{row['uncached'] - row['cached']:.1f} ms`" for resolver, row in p50.iterrows() if row.notna().all()))
+    category = st.radio("Trend for:", DNS_BENCHMARK_CATEGORIES, horizontal=True, key="dns_benchmark_trend_category")
+    trend = history[history["category"] == category].pivot_table(index="time", columns="resolver", values="p50_ms")
+    if len(trend) > 1: st.line_chart(trend, height=200)
+    else: st.caption("Run the benchmark again to see p50 latency over time.")
+
+
+def inference_benchmark_panel():
+    """Progress of a running inference benchmark (polled), then serial vs concurrent results."""
+    if poll_background_job(INFERENCE_BENCHMARK_JOB_KEY, 'inference_benchmark_job_id', "Inference benchmark", "🧪"): return
+
+    result = get_history_store().load_state("inference_benchmark.last_result")
+    if not result or not result.get("rows"):
+        st.caption("No inference benchmark yet.")
+        return
+    mock = result["mock"]
+    st.caption(f"Run {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(result['ts']))} against the mock endpoint "
+               f"({mock['first_token_delay'] * 1000:.0f} ms to first token, {mock['tokens']} tokens {mock['token_delay'] * 1000:.0f} ms apart)")
+    st.dataframe(pd.DataFrame([{
+        "Workers": row["workers"], "Requests": row["requests"], "Errors": row["errors"], "Req/s": row["req_per_s"],
+        "Chat wait p95 (ms)": row["chat_wait_p95_ms"], "Chat first token p50 (ms)": row["chat_first_token_p50_ms"],
+        "Chat total p95 (ms)": row["chat_total_p95_ms"], "Vision total p50 (ms)": row["vision_total_p50_ms"],
+        "Vision total p95 (ms)": row["vision_total_p95_ms"], "Session wait spread (ms)": row["session_wait_spread_ms"],
+    } for row in result["rows"]]).style.format(precision=0, na_rep="—").format({"Req/s": "{:.2f}"}), hide_index=True, use_container_width=True)
+    if len(result["rows"]) > 1 and result["rows"][0]["req_per_s"]:
+        serial, concurrent = result["rows"][0], result["rows"][-1]
+        st.caption(f"{concurrent['workers']} workers: {concurrent['req_per_s'] / serial['req_per_s']:.1f}x the throughput of a serial client. "
+                   "Chat requests overtake the queued vision burst (priority), and the wait spread shows how evenly chat sessions were served.")
+
+
+def pause_latency_prober_if_off():
+    """Checkbox callback: unchecking idles the prober now (another session's panel resumes it on its next refresh)."""
+    if not st.session_state.get('latency_prober_on', False): get_latency_prober().pause()
+
+
+@st.fragment(run_every=LATENCY_PROBE_REFRESH_INTERVAL)
+def latency_prober_panel():
+    """Latest latency/jitter/loss per target plus an RTT chart over the rolling window."""
+    if not st.session_state.get('latency_prober_on', False): return
+    prober = get_latency_prober_from_secrets()
+    prober.keep_alive() # Probes only while some session shows this panel
+    if not prober.targets:
+        st.warning("No valid probe targets. Use `tcp:host:port` or `dns:host:port` in `[prober] targets`.")
+        return
+    st.dataframe(pd.DataFrame(prober.summary()).style.format(
+        {"RTT (ms)": "{:.1f}", "Jitter (ms)": "{:.1f}", "Loss (%)": "{:.0f}", "p95 RTT (ms)": "{:.1f}", "Window Loss (%)": "{:.1f}"}, na_rep="—"),
+        hide_index=True, use_container_width=True)
+    rtt_frame = prober.rtt_frame()
+    if not rtt_frame.empty: st.line_chart(rtt_frame, height=200)
+    st.caption(f"{prober.count} probes per target every {prober.interval:g}s, timeout {prober.timeout:g}s | A few packets per round, no bulk transfer")
+
+
+CONNECTION_TABLE_ROWS = 200 # Rows shown per table; thousands of sockets stay responsive
+
+@st.fragment(run_every=CONNECTION_REFRESH_INTERVAL)
+def connection_inventory_panel():
+    """Established connections grouped by remote host and by owning process, with recent changes."""
+    if not st.session_state.get('connection_inventory_on', False): return
+    inventory = get_connection_inventory(CONNECTION_REFRESH_INTERVAL)
+    established_only = st.checkbox("Established only", value=True, key="conn_established_only")
+    version, host_frame, process_frame = inventory.tables(established_only)
+    if inventory.error: st.warning(inventory.error)
+    changed = st.session_state.get('connection_inventory_version') != version
+    st.session_state['connection_inventory_version'] = version
+    st.caption(f"{int(host_frame['Connections'].sum()) if len(host_frame) else 0:,} connections | {len(host_frame):,} remote hosts | "
+               f"{len(process_frame):,} processes | Snapshot v{version}{' (updated)' if changed else ''} | Poll: {inventory.poll_ms or 0:.0f} ms")
+    col_hosts, col_procs = st.columns(2)
+    with col_hosts:
+        st.markdown("**By Remote Host**")
+        st.dataframe(host_frame.head(CONNECTION_TABLE_ROWS), hide_index=True, use_container_width=True, height=300)
+    with col_procs:
+        st.markdown("**By Process**")
+        st.dataframe(process_frame.head(CONNECTION_TABLE_ROWS), hide_index=True, use_container_width=True, height=300)
+    recent = inventory.recent_events(15)
+    if recent:
+        st.markdown("**Recent Changes**")
+        st.text('\n'.join(f"{time.strftime('%H:%M:%S', time.localtime(ts))} {sign} {c[0]}:{c[1]} ({c[3]}, pid {c[4]})" for ts, sign, c in reversed(recent)))
+
+
+@st.fragment(run_every=TRAFFIC_SCAN_INTERVAL)
+def traffic_scan_panel():
+    """Real-time traffic rates/anomalies. Only called while the traffic scan checkbox is on."""
+    if not st.session_state.get('network_anomaly_running', False): return
+    status_area = st.container()
+    stats_display_area = st.container()
+    current_net_stats = get_network_io_stats()
+    prev_net_stats = st.session_state.get('prev_net_stats')
+    stats_df = None # Initialize dataframe variable
+
+    monitor = get_interface_monitor(*get_interface_monitor_config())
+    if current_net_stats and prev_net_stats:
+        adaptive = monitor.detector.current_anomalies(max_age=2 * max(monitor.interval, TRAFFIC_SCAN_INTERVAL))
+        analysis_result = analyze_network_traffic(prev_net_stats, current_net_stats, adaptive_anomalies=adaptive)
+        if "⚠️ **Anomaly" in analysis_result: status_area.error(analysis_result, icon="🚨")
+        elif "Insufficient data" in analysis_result or "Interval too short" in analysis_result or "baseline reset" in analysis_result: status_area.info("Traffic Scan Activated... Waiting for interval.", icon="⏳")
+        else: status_area.success(analysis_result, icon="✅")
+        # Display *cumulative* stats
+        stats_readable = {
+            "Time": time.strftime('%H:%M:%S'), "Sent Σ": format_bytes(current_net_stats.get('bytes_sent')),
+            "Recv Σ": format_bytes(current_net_stats.get('bytes_recv')), "Pkt Sent Σ": f"{current_net_stats.get('packets_sent', 0):,}",
+            "Pkt Recv Σ": f"{current_net_stats.get('packets_recv', 0):,}", "Err Σ(I/O)": f"{current_net_stats.get('errin', 0)}/{current_net_stats.get('errout', 0)}",
+            "Drop Σ(I/O)": f"{current_net_stats.get('dropin', 0)}/{current_net_stats.get('dropout', 0)}",
+        }
+        stats_df = pd.DataFrame([stats_readable])
+        st.session_state['prev_net_stats'] = current_net_stats # Update for next cycle
+    elif not current_net_stats: status_area.warning("Could not retrieve current network IO stats.")
+    else: status_area.info("Waiting for next interval to calculate rates...") ; st.session_state['prev_net_stats'] = current_net_stats # Store first reading
+
+    # Display cumulative stats table
+    if stats_df is not None:
+         stats_display_area.dataframe( stats_df.style.set_properties(**{'text-align': 'left', 'font-size': '0.9em'}).hide(axis="index"), use_container_width=True )
+
+    # Per-interface rates from the shared monitor (one vectorized pass over all NICs per poll)
+    latest_rates = monitor.latest()
+    if not latest_rates:
+        st.caption("Per-interface rates: waiting for the second poll...")
+        return
+    st.markdown("**Per-Interface Rates**")
+    iface_rows = [{
+        "Interface": name, "Tx": f"{format_bytes(r['tx_bps'] / 8)}/s", "Rx": f"{format_bytes(r['rx_bps'] / 8)}/s",
+        "PPS (Tx/Rx)": f"{r['tx_pps']:,.0f}/{r['rx_pps']:,.0f}", "Err/s (I/O)": f"{r['errin_ps']:.1f}/{r['errout_ps']:.1f}",
+        "Drop/s (I/O)": f"{r['dropin_ps']:.1f}/{r['dropout_ps']:.1f}",
+    } for name, r in sorted(latest_rates.items(), key=lambda item: -(item[1]['tx_bps'] + item[1]['rx_bps']))]
+    st.dataframe(pd.DataFrame(iface_rows), hide_index=True, use_container_width=True)
+    chart_metric = st.radio("Chart:", ["rx_bps", "tx_bps", "rx_pps", "tx_pps", "errin_ps", "dropin_ps"], horizontal=True, key="nic_chart_metric")
+    chart_ifaces = [name for name in monitor.interfaces if not name.startswith("lo")]
+    chart_frame = monitor.history(chart_metric, interfaces=chart_ifaces)
+    if not chart_frame.empty: st.line_chart(chart_frame, height=220)
+    st.caption(f"Window: last {len(chart_frame)} polls every {monitor.interval:g}s (max {monitor.capacity}) | "
+               f"Counter wraps handled: {monitor.normalizer.wraps} | Interface resets: {monitor.normalizer.resets}")
+    recent_anomalies = monitor.detector.recent_anomalies()
+    if recent_anomalies:
+        with st.expander(f"Recent adaptive anomalies ({len(recent_anomalies)})"):
+            st.text('\n'.join(f"{time.strftime('%H:%M:%S', time.localtime(a['time']))}  {a['interface']:<10} {a['label']:<20} "
+                               f"value {a['value']:,.1f} vs baseline {a['baseline']:,.1f} (z={a['z']:.1f})"
+                               for a in recent_anomalies))
+
+
+@st.fragment(run_every=SCREEN_REFRESH_INTERVAL)
+def screen_feed_panel():
+    """Captures the primary monitor into session_state.current_frame and shows it. Only called while sharing."""
+    if not st.session_state.get('sharing', False): return # Feed stopped since the last full run
+    image_placeholder = st.empty()
+    try:
+        with mss_lib.mss(display=os.environ.get('DISPLAY')) as sct:
+            monitor_index = 1 # Try primary first
+            if len(sct.monitors) <= monitor_index: monitor_index = 0 # Fallback
+            if not sct.monitors: raise Exception("No monitors detected")
+            monitor = sct.monitors[monitor_index]
+
+            screen_frame_mss = sct.grab(monitor)
+            frame_np = np.array(screen_frame_mss)
+            frame_bgr = cv2.cvtColor(frame_np, cv2.COLOR_BGRA2BGR)
+            st.session_state.current_frame = frame_bgr
+
+            display_img_rgb = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
+            image_placeholder.image(display_img_rgb,
+                caption=f"Screen Feed Active - Monitor {monitor_index} ({monitor.get('width','?') }x{monitor.get('height','?')})",
+                use_container_width=True, output_format='RGB')
+
+    except ImportError:
+        st.session_state.screen_share_error = "Screen sharing requires `mss` and `opencv-python`: `pip install mss opencv-python`"
+        st.session_state.sharing = False; st.session_state.current_frame = None
+        st.rerun() # Full rerun: updates the Start/Stop button and stops this fragment's timer
+    except Exception as e:
+        st.session_state.screen_share_error = f"Screen sharing error: {type(e).__name__}. Feed stopped."
+        print(f"Screen Sharing Traceback: {traceback.format_exc()}")
+        st.session_state.sharing = False; st.session_state.current_frame = None
+        st.rerun()
+
+
+# --- App Sections (only the active one is executed) ---
+
+def render_chat_section():
+    """Agent Chat: chat history, text/voice input and AI or direct-action responses."""
+    # Create a container for the chat history for fixed height scrolling
+    chat_container = st.container(height=550) # Adjust height as needed
+
+    with chat_container:
+        # Display chat history
+        if not st.session_state.chat_history:
+             st.markdown("*(Chat history is clear. Ask me anything!)*")
+        for i, message in enumerate(st.session_state.chat_history):
+            is_user = message["role"] == "user"
+            avatar_display = circular_user_image if is_user else circular_ai_image
+            with st.chat_message(name=message["role"], avatar=avatar_display):
+                st.markdown(message["content"], unsafe_allow_html=True)
+
+    # Separate container for input elements below the chat history
+    input_container = st.container()
+    with input_container:
+         col_voice, col_input = st.columns([1, 6]) # Adjust ratio if needed
+         with col_voice:
+              voice_disabled = not HAS_STT_LIB or not azure_ai_enabled
+              if st.button("🎤", key="voice_cmd_main", help="Ask via Voice (if mic available & enabled)", disabled=voice_disabled, type="secondary"):
+                   voice_prompt = listen_for_command()
+                   if voice_prompt:
+                        st.session_state.main_chat_input_value = voice_prompt
+                        st.rerun() # Rerun to process the voice input
+
+         with col_input:
+              prompt_text = st.chat_input(
+                  "Ask CyberNexus Q...", key="main_chat_input", disabled=not azure_ai_enabled
+              )
+
+    # --- Process New Input (Check text input OR value from voice state) ---
+    final_prompt = prompt_text or st.session_state.pop('main_chat_input_value', None) # Prioritize text, fallback/clear voice state
+
+    if final_prompt:
+        st.session_state.chat_history.append({"role": "user", "content": final_prompt})
+        st.rerun() # Display user message immediately
+
+    # --- AI Response Generation Trigger ---
+    if st.session_state.chat_history and st.session_state.chat_history[-1]["role"] == "user":
+        last_user_prompt = st.session_state.chat_history[-1]["content"]
+
+        # Display thinking message inside the chat container
+        with chat_container:
+             with st.chat_message("assistant", avatar=circular_ai_image):
+                 ai_response_placeholder = st.empty()
+                 ai_response_placeholder.markdown("```processing\nThinking...\n```")
+
+                 full_response_text = ""
+                 action_response_md = None
+                 stream_error = False
+                 history_appended_this_turn = False
+
+                 try:
+                     prompt_lower = last_user_prompt.lower()
+                     action_executed = False
+                     network_keywords = ["network status", "internet status", "quick check", "ip address", "connection status", "network check", "netstat", "speed", "my ip"]
+                     pi_status_keywords = ["pi status", "system status", "specs", "check system", "raspberry pi status", "pi check", "server status", "status check", "sysinfo"]
+
+                     # --- Direct Action: Pi Status ---
+                     if any(k in prompt_lower for k in pi_status_keywords) or re.search(r"\b(cpu|ram|temp|disk)\b", prompt_lower):
+                         pi_stats_data = get_pi_status() # Latest background sample
+                         action_response_md = (f"⚙️ **Pi System Status (via `psutil`):**\n\n"
+                                               f"- **CPU:** `{pi_stats_data['cpu_usage']}`\n"
+                                               f"- **Temp:** `{pi_stats_data['cpu_temperature']}`\n"
+                                               f"- **RAM:** `{pi_stats_data['ram_usage']}`\n"
+                                               f"- **Disk:** `{pi_stats_data['disk_usage']}`")
+                         action_executed = True
+                         full_response_text = "Retrieved current system status:"
+
+                     # --- Direct Action: Network Quick Check (Cached) ---
+                     elif any(k in prompt_lower for k in network_keywords):
+                         net_stats_data = get_network_overview()
+                         if net_stats_data:
+                             dl_sp=net_stats_data.get('download_speed'); ul_sp=net_stats_data.get('upload_speed')
+                             ping_v=net_stats_data.get('ping')
+                             dl_str=f"{dl_sp:.2f}" if isinstance(dl_sp,(int,float)) else "N/A"
+                             ul_str=f"{ul_sp:.2f}" if isinstance(ul_sp,(int,float)) else "N/A"
+                             ping_str=f"{ping_v:.1f}" if isinstance(ping_v,(int,float)) else "N/A"
+                             action_response_md = (f"⚙️ **Network Quick Check (Cached):**\n\n"
+                                                   f"- **Down/Up:** `{dl_str}` / `{ul_str}` Mbps\n"
+                                                   f"- **Ping:** `{ping_str} ms`\n"
+                                                   f"- **External IP:** `{net_stats_data.get('external_ip', 'N/A')}`")
+                             if net_stats_data.get("speedtest_error"): action_response_md += f"\n\n  - *Speedtest Note:* _{net_stats_data['speedtest_error']}_"
+                             if net_stats_data.get("external_ip_error"): action_response_md += f"\n  - *Ext. IP Note:* _{net_stats_data['external_ip_error']}_"
+                             action_response_md += "\n\n*(Use Network Matrix tab for details/fresh tests)*"
+                         else: action_response_md = "⚙️ Cached network data not available yet. Try the Network Matrix tab."
+                         action_executed = True
+                         full_response_text = "Here's the last cached network overview:"
+
+                     # --- Direct Action: Pi-hole Status ---
+                     elif pihole_enabled and ("pi-hole status" in prompt_lower or "pihole status" in prompt_lower):
+                          with st.spinner("Checking Pi-hole status..."): status_result = get_cached_pihole_status_display() # Use cached one from display tab
+                          if status_result.startswith("api_error"): action_response_md = f"⚙️ **Pi-hole Status Error:** `{status_result}`"
+                          else: action_response_md = f"⚙️ **Pi-hole Status:** `{status_result.upper()}`"
+                          action_executed = True
+
+                     # --- Direct Action: Run Security Audit ---
+                     elif "security audit" in prompt_lower or "quantum check" in prompt_lower or "security scan" in prompt_lower or "run audit" in prompt_lower:
+                         with st.spinner("Initiating Simulated Azure Quantum Security Audit..."):
+                             action_response_md = simulate_quantum_security_audit()
+                         action_executed = True
+                         full_response_text = "Simulated Security Audit complete."
+
+                     # --- Fallback to LLM if NO direct action matched ---
+                     if not action_executed:
+                          response_stream = get_azure_ai_text_response_stream(
+                               last_user_prompt, st.session_state.chat_history[:-1], use_cache=st.session_state.get("response_cache_on", True)
+                          )
+                          streamed_chunks = []
+                          for chunk in response_stream:
+                              if chunk == "[STREAM_DONE]": break
+                              if chunk.startswith("[Error:") or chunk.startswith("[Warning:") or chunk.startswith("[Info:"):
+                                  if chunk.startswith("[Error:"):
+                                       full_response_text = chunk # Display error
+                                       ai_response_placeholder.error(full_response_text)
+                                       stream_error = True; break # Stop stream
+                                  else: st.toast(chunk[chunk.find(':')+1:].strip(), icon="⚠️" if chunk.startswith("[Warning:") else "ℹ️"); continue # Show toast, continue stream
+                              streamed_chunks.append(chunk)
+                              full_response_text = "".join(streamed_chunks)
+                              ai_response_placeholder.markdown(full_response_text + "▌", unsafe_allow_html=True) # Stream cursor
+
+                          if not stream_error: # Final update without cursor
+                               ai_response_placeholder.markdown(full_response_text, unsafe_allow_html=True)
+
+
+                     # --- Combine LLM/Action Results & Update History ---
+                     final_response_content = full_response_text
+                     if action_response_md:
+                         if final_response_content and not stream_error: final_response_content += f"\n\n---\n{action_response_md}"
+                         else: final_response_content = action_response_md # Only action result
+
+                     if not final_response_content and not stream_error: # Handle totally empty case
+                         final_response_content = "[AI response was empty and no specific action was taken.]"
+                         ai_response_placeholder.warning(final_response_content)
+
+                     if not stream_error: # Update placeholder if no error already shown
+                          ai_response_placeholder.markdown(final_response_content, unsafe_allow_html=True)
+
+                     if final_response_content: # Append final content to history
+                         st.session_state.chat_history.append({"role": "assistant", "content": final_response_content})
+                         history_appended_this_turn = True
+
+                     # --- Text-to-Speech ---
+                     text_for_tts = "" # Determine what to speak
+                     if action_executed and not stream_error: # Action completed
+                         if "Pi System Status" in final_response_content: text_for_tts = "Showing system status."
+                         elif "Network Quick Check" in final_response_content: text_for_tts = "Showing network overview."
+                         elif "Pi-hole Status:" in final_response_content: text_for_tts = "Pi-hole status: " + final_response_content.split("`")[-2]
+                         elif "Security Audit" in final_response_content: text_for_tts = "Simulated security audit complete."
+                         else: text_for_tts = "Action complete."
+                     elif not action_executed and full_response_text and not stream_error: text_for_tts = full_response_text # Speak LLM response
+                     elif stream_error: text_for_tts = "An error occurred generating the response."
+                     if text_for_tts: speak_text(text_for_tts)
+
+                 except Exception as e: # Catch errors during processing step
+                     st.error(f"💥 Error during response processing: {type(e).__name__}")
+                     detailed_error = traceback.format_exc()
+                     print(f"DEBUG: Response Processing Error:\n{detailed_error}")
+                     error_msg_display = f"[Internal Error processing response: {type(e).__name__}]"
+                     ai_response_placeholder.error(error_msg_display)
+                     if not history_appended_this_turn: # Append error if nothing else was
+                         st.session_state.chat_history.append({"role": "assistant", "content": error_msg_display})
+                         history_appended_this_turn = True
+
+        # Rerun AFTER the assistant's message processing is complete (normal or error)
+        # CORRECTED INDENTATION for this block:
+        if history_appended_this_turn:
+            st.rerun()
+
+
+def start_initial_network_scan():
+    """Login-time scan: external IP now, speedtest as a background job if the stored result is stale."""
+    with st.spinner("Performing initial network scan..."):
+        net_data = get_initial_network_status()
+    if net_data.get("external_ip_error"): st.toast(f"Initial Scan: {net_data['external_ip_error']}", icon="🌐")
+    last = get_last_speedtest_result()
+    if not last or time.time() - (last.get("attempted") or last.get("finished") or 0) > SPEEDTEST_STALE_AFTER:
+        st.session_state.speedtest_job_id = start_speedtest_job()
+        st.toast("Speed test started in the background.", icon="⚡")
+    else:
+        st.toast("Initial network scan complete.", icon="🛰️")
+    st.session_state.initial_network_data_loaded = True
+
+
+def render_network_section():
+    """Network Matrix: scans, speed tests, interface details and live traffic analysis."""
+    st.subheader("Network Matrix & Analysis")
+
+    col_ref, col_spd = st.columns([1,3])
+    with col_ref:
+         if st.button("🔄 Refresh Scan", key="refresh_network_button_network_tab", help="Runs speedtest and external IP check again"):
+             get_initial_network_status.clear()
+             with st.spinner("Refreshing external IP..."):
+                 net_data = get_initial_network_status()
+             if net_data.get("external_ip_error"): st.toast(f"Refresh: {net_data['external_ip_error']}", icon="🌐")
+             st.session_state.speedtest_job_id = start_speedtest_job()
+             st.toast("Speed test started in the background.", icon="⚡")
+    with col_spd:
+         if st.button("⚡ Run Dedicated Speed Test Now", key="speedtest_button_network_tab"):
+             st.session_state.speedtest_job_id = start_speedtest_job() # Joins a running test instead of starting a second one
+
+    st.markdown("---")
+    speedtest_overview_panel()
+    st.markdown("---")
+
+    with st.expander("📈 Metrics History (persistent)"):
+        render_metrics_history()
+
+    with st.expander("📊 Speed Test History"):
+        render_speedtest_history()
+
+    with st.expander("🔁 LAN Throughput (node to node)"):
+        render_throughput_tester()
+
+    with st.expander("📶 Latency / Jitter / Loss Prober"):
+        if st.checkbox("Run lightweight prober", key="latency_prober_on", on_change=pause_latency_prober_if_off, help="TCP-connect and DNS round trips to the gateway, Pi-hole and upstream resolvers every few seconds."):
+            latency_prober_panel() # Self-refreshing fragment
+        else:
+            st.caption("A cheap alternative to speed tests: a few small probes per target instead of tens of megabytes.")
+
+    with st.expander("📡 LAN Devices (neighbor table)"):
+        if st.checkbox("Show LAN device inventory", key="lan_devices_on", help="Reads the kernel ARP/neighbor table (no scanning) and matches devices to Pi-hole clients."):
+            render_lan_devices()
+
+    with st.expander("🧪 Collector Benchmark (/proc vs psutil)"):
+        if not proc_fast_path_available():
+            st.caption("The /proc fast path is Linux-only; psutil is used on this system.")
+        else:
+            st.caption(f"/proc fast path: `{'enabled' if get_proc_fast_path_enabled() else 'disabled ([metrics] proc_fast_path)'}`")
+            if st.button("Run Benchmark", key="collector_benchmark_btn"):
+                with st.spinner("Timing collectors..."):
+                    rows = benchmark_collectors()
+                st.dataframe(pd.DataFrame([{
+                    "Collector": r["collector"],
+                    "psutil (µs/call)": f"{r['psutil_us']:,.0f}" if r["psutil_us"] is not None else "N/A",
+                    "/proc (µs/call)": f"{r['proc_us']:,.0f}" if r["proc_us"] is not None else "N/A",
+                    "Speedup": f"{r['speedup']:.1f}x" if r["speedup"] is not None else "N/A",
+                    "Same Result": r["match"],
+                } for r in rows]), hide_index=True, use_container_width=True)
+
+    with st.expander("🧪 Inference Benchmark (offline, mock endpoint)"):
+        render_inference_benchmark()
+
+    # Interface Details and Traffic Analysis in Columns
+    col_net_iface, col_net_traffic = st.columns([1, 1.5])
+
+    with col_net_iface:
+        st.markdown("#### Interface Intelligence (psutil)")
+        interfaces_info = get_network_interfaces_psutil() # Cached data
+        interface_names = list(interfaces_info.keys()) if interfaces_info else []
+
+        if not interface_names: st.warning("No network interfaces found.")
+        else:
+            default_index = 0 # Find a sensible default
+            for i, name in enumerate(interface_names):
+                if interfaces_info[name].get('is_up') and not name.startswith('lo'):
+                    default_index = i; break
+            selected_interface = st.selectbox("Select Interface:", interface_names, key="interface_select", index=default_index)
+            if selected_interface:
+                iface_details = format_interface_details_psutil(interfaces_info, selected_interface)
+                if iface_details.get("Error"): st.error(iface_details["Error"])
+                else:
+                     st.markdown(f"""
+                     - Status: `{iface_details['Status']}` (Speed: `{iface_details['Speed']}`)
+                     - MAC: `{', '.join(iface_details['MAC'])}`
+                     - IPv4: `{', '.join(iface_details['IPv4'])}`
+                     - IPv6: `{', '.join(iface_details['IPv6'])}`
+                     """, unsafe_allow_html=True)
+
+    with col_net_traffic:
+        st.markdown("#### Real-time Traffic Analysis (psutil)")
+        run_analysis = st.checkbox("Activate Traffic Scan", key="anomaly_toggle", value=st.session_state.get('network_anomaly_running', False), help="Periodically checks network IO rates and errors/drops.")
+
+        if run_analysis:
+            if not st.session_state.get('network_anomaly_running', False):
+                 st.session_state['network_anomaly_running'] = True
+                 st.session_state['prev_net_stats'] = get_network_io_stats() # Initial baseline
+            traffic_scan_panel() # Self-refreshing fragment, reruns alone every TRAFFIC_SCAN_INTERVAL s
+
+        else: # Checkbox is off
+            if st.session_state.get('network_anomaly_running', False): # If it *was* running
+                st.session_state['network_anomaly_running'] = False
+                st.session_state['prev_net_stats'] = None
+                st.info("Traffic Scan Deactivated.")
+            else: # Already off
+                st.info("Activate scan to monitor traffic rates and detect anomalies.")
+
+    st.markdown("---")
+    st.markdown("#### Connection Inventory (psutil)")
+    if st.checkbox("Show Connection Inventory", key="connection_inventory_on", help="Lists connections grouped by remote host and process; refreshes every few seconds."):
+        connection_inventory_panel() # Self-refreshing fragment, reruns alone every CONNECTION_REFRESH_INTERVAL s
+
+
+def render_screen_section():
+    """Screen Analysis: live screen feed and Azure AI Vision questions about it."""
+    st.subheader("Multimodal Screen Analysis (Azure AI Vision)")
+    col_share_ctl, col_share_view = st.columns([1, 2])
+
+    with col_share_ctl:
+        st.markdown("#### Controls")
+        sharing_active = st.session_state.get('sharing', False)
+        button_text = "⏹️ Stop Screen Feed" if sharing_active else "▶️ Start Screen Feed"
+        if st.button(button_text, key="toggle_share"):
+            st.session_state.sharing = not st.session_state.sharing
+            if not st.session_state.sharing: st.session_state.current_frame = None
+            st.rerun() # Rerun to update viewport and button state
+
+        st.caption("Shares primary monitor for visual analysis.")
+        st.markdown("---")
+
+        st.markdown("#### Analyze Screen")
+        screen_chat_container = st.container(height=400)
+        current_screen_history = st.session_state.get('screen_chat_history', [])
+        with screen_chat_container:
+            if not current_screen_history: st.markdown("*(Start screen feed and ask questions about it...)*")
+            for message in current_screen_history:
+                msg_role = message["role"]
+                msg_avatar = circular_user_image if msg_role == "user" else circular_ai_image
+                with st.chat_message(msg_role, avatar=msg_avatar):
+                    st.markdown(message["content"], unsafe_allow_html=True)
+
+        input_disabled = not sharing_active or not azure_ai_enabled
+        disable_reason = ""
+        if not sharing_active: disable_reason = "Start screen feed first."
+        elif not azure_ai_enabled: disable_reason = "Azure AI Vision not available."
+
+        screen_prompt = st.chat_input("Ask about the screen feed...", key="screen_chat_input", disabled=input_disabled)
+        if input_disabled and not disable_reason.startswith("Azure"): st.caption(f":warning: Input disabled: {disable_reason}")
+        elif input_disabled: st.caption(f":warning: {disable_reason}") # Don't show warning if Azure is just off
+
+        if screen_prompt:
+            if not sharing_active: st.toast("Screen feed is not active.", icon="⚠️")
+            elif st.session_state.get('current_frame') is None: st.toast("Screen frame not captured yet.", icon="⏳")
+            else:
+                st.session_state.screen_chat_history.append({"role": "user", "content": screen_prompt})
+                st.rerun()
+
+    # --- Screen Analysis Processing Trigger ---
+    if current_screen_history and current_screen_history[-1]["role"] == "user":
+        last_screen_prompt = current_screen_history[-1]["content"]
+        current_frame = st.session_state.get('current_frame')
+
+        with screen_chat_container:
+            with st.chat_message("assistant", avatar=circular_ai_image):
+                analysis_placeholder = st.empty()
+                analysis_placeholder.markdown("```processing\n👁️ Analyzing screen with Azure AI Vision...\n```")
+
+                if current_frame is not None and azure_ai_enabled:
+                    analysis_result_text = "[Analysis Error: Placeholder]"
+                    try:
+                        img_rgb = cv2.cvtColor(current_frame, cv2.COLOR_BGR2RGB)
+                        pil_img = Image.fromarray(img_rgb)
+                        buffer = io.BytesIO()
+                        pil_img.save(buffer, format="JPEG", quality=85)
+                        img_bytes = buffer.getvalue()
+                        analysis_result_text = get_azure_ai_vision_response(last_screen_prompt, img_bytes, use_cache=st.session_state.get("response_cache_on", True))
+                    except Exception as e:
+                        error_msg = f"Screen Vision Prep/Analysis failed: {type(e).__name__}"
+                        st.toast(f"💥 {error_msg}", icon="👁️")
+                        print(f"Error during Vision call/prep: {traceback.format_exc()}")
+                        analysis_result_text = f"[Error: {error_msg}]"
+
+                    analysis_placeholder.markdown(analysis_result_text, unsafe_allow_html=True)
+                    st.session_state.screen_chat_history.append({"role": "assistant", "content": analysis_result_text})
+                    if not analysis_result_text.startswith(("[Error:", "[Info:")) and st.session_state.get('tts_toggle'):
+                        tts_summary = analysis_result_text.split('. ')[0] + "." if '.' in analysis_result_text else analysis_result_text[:150]
+                        speak_text(f"Vision analysis: {tts_summary}")
+                    st.rerun()
+
+                elif not azure_ai_enabled:
+                     error_msg = "[Error: Azure AI Vision client not available]"
+                     analysis_placeholder.error(error_msg)
+                     st.session_state.screen_chat_history.append({"role": "assistant", "content": error_msg}); st.rerun()
+                else: # Frame missing
+                    error_msg = "[Internal Error: Screen frame missing during analysis]"
+                    analysis_placeholder.warning(error_msg)
+                    st.session_state.screen_chat_history.append({"role": "assistant", "content": error_msg}); st.rerun()
+
+    # Screen Viewport (Right Column)
+    with col_share_view:
+        st.markdown("#### Live Feed Viewport")
+        if st.session_state.get('sharing', False):
+            screen_feed_panel() # Self-refreshing fragment, captures a frame every SCREEN_REFRESH_INTERVAL s
+
+        else: # Sharing is not active
+            if st.session_state.get('screen_share_error'): st.error(st.session_state.pop('screen_share_error'))
+            st.info("Screen sharing inactive. ▶️ Start feed to enable analysis.")
+            if st.session_state.get('current_frame') is not None:
+                st.session_state.current_frame = None # Clear frame when stopped
+
+
+def render_pihole_section():
+    """Pi-hole Control: status toggle, statistics and domain list management."""
+    st.subheader("Pi-hole Network Protection Control")
+
+    if not pihole_enabled:
+         st.warning("Pi-hole integration disabled. Configure `[pihole_api]` with `url` in `secrets.toml`.")
+    else:
+         # Status and Toggle
+         status_col, control_col = st.columns([1, 1.5])
+         with status_col:
+              st.markdown("#### Status & Toggle")
+              status_placeholder = st.empty()
+              current_status = get_cached_pihole_status_display()
+
+              with status_placeholder.container():
+                  if current_status.startswith("api_error"):
+                      st.error(f"Status Error:\n`{current_status}`")
+                      if st.button("Retry Status", key="retry_pihole_status"):
+                           get_cached_pihole_status_display.clear(); st.rerun()
+                  elif current_status in ["enabled", "disabled"]:
+                      status_color = "lightgreen" if current_status == "enabled" else "orange"
+                      st.markdown(f"Current Status: <span style='color:{status_color}; font-weight:bold;'>{current_status.upper()}</span>", unsafe_allow_html=True)
+                      is_enabled = current_status == "enabled"
+                      if is_enabled:
+                          disable_duration = st.selectbox("Disable Temporarily For:",
+                              options=[0, 10, 30, 60, 300, 900], index=1, # Default 10s
+                              format_func=lambda x: f"{x}s" if x==10 else (f"{x}s ({x//60}m)" if x>=60 else "Permanently"),
+                              key="pihole_disable_duration")
+                          if st.button("🚫 Disable Pi-hole", key="pihole_disable_btn"):
+                              duration_text = f" for {disable_duration}s" if disable_duration>0 else ""
+                              with st.spinner(f"Disabling Pi-hole{duration_text}..."): resp = disable_pihole_api(disable_duration)
+                              if resp.get("success"): st.success(f"✅ {resp.get('message', 'Disabled')}")
+                              else: st.error(f"❌ {resp.get('error', 'Failed')}")
+                              get_cached_pihole_status_display.clear(); time.sleep(0.5); st.rerun()
+                      else: # Pi-hole is disabled
+                          if st.button("✅ Enable Pi-hole", key="pihole_enable_btn"):
+                              with st.spinner("Enabling Pi-hole..."): resp = enable_pihole_api()
+                              if resp.get("success"): st.success(f"✅ {resp.get('message', 'Enabled')}")
+                              else: st.error(f"❌ {resp.get('error', 'Failed')}")
+                              get_cached_pihole_status_display.clear(); time.sleep(0.5); st.rerun()
+                  else: # Status is unknown
+                      st.warning(f"Status Unknown: `{current_status}`")
+                      if st.button("Retry Status", key="retry_pihole_status_unknown"):
+                           get_cached_pihole_status_display.clear(); st.rerun()
+
+         # Separator
+         st.markdown("<hr style='margin: 1rem 0;'>", unsafe_allow_html=True)
+
+         # Other Pi-hole functions
+         with control_col:
+               st.markdown("#### Statistics & Lists")
+               with st.expander("📊 View Summary & Top Items"):
+                   # Placeholder for results
+                    summary_placeholder = st.empty()
+                    top_items_placeholder = st.empty()
+                    include_sources = st.checkbox("Include per-client query sources", key="pihole_stats_sources")
+                    if st.button("Fetch Stats", key="pihole_stats_btn_tab"):
+                        with st.spinner("Fetching Pi-hole statistics..."):
+                            batch = fetch_pihole_dashboard(top_count=7, include_sources=include_sources)
+                        summary_resp = batch["results"]["summary"]
+                        top_resp = batch["results"]["top_items"]
+                        status_resp = batch["results"]["status"]
+                        if status_resp.get("success") and status_resp["data"]["status"] != current_status:
+                            get_cached_pihole_status_display.clear() # Toggle above is stale; refresh it on next run
+
+                        with summary_placeholder.container():
+                            if summary_resp.get("success"):
+                                data = summary_resp['data']
+                                st.markdown(f"""
+                                - Queries (Today): `{data.get('dns_queries_today', 'N/A'):,}`
+                                - Blocked (Today): `{data.get('ads_blocked_today', 'N/A'):,}` (`{data.get('ads_percentage_today', 'N/A')}%`)
+                                - Domains Blocked: `{data.get('domains_being_blocked', 'N/A'):,}`
+                                - Unique Clients: `{data.get('unique_clients', 'N/A')}`
+                                """, unsafe_allow_html=True)
+                            else: st.error(f"Summary Error: {summary_resp.get('error', 'Failed')}")
+
+                        with top_items_placeholder.container():
+                             st.markdown("---")
+                             if top_resp.get("success") and isinstance(top_resp.get('data'), dict):
+                                 data=top_resp['data']; st.markdown("**Top 7 Items:**")
+                                 st.markdown("<u>Queries / Blocked / Clients:</u>", unsafe_allow_html=True)
+                                 # Display in columns for better layout
+                                 col_tq, col_tb, col_tc = st.columns(3)
+                                 with col_tq: st.text('\n'.join([f"{d[:15]}: {h:,}" for d,h in list(data.get('top_queries',{}).items())[:7]]))
+                                 with col_tb: st.text('\n'.join([f"{d[:15]}: {h:,}" for d,h in list(data.get('top_ads',{}).items())[:7]]))
+                                 with col_tc: st.text('\n'.join([f"{c.split('|')[0]} ({c.split('|')[1]})"[:20]+f": {h:,}" if '|' in c else f"{c[:15]}: {h:,}" for c,h in list(data.get('top_sources',{}).items())[:7]]))
+                             else: st.error(f"Top Items Error: {top_resp.get('error', 'Failed or invalid data')}")
+
+                             if include_sources:
+                                 sources_resp = batch["results"]["query_sources"]
+                                 if sources_resp.get("success"):
+                                     sources = sources_resp['data'].get('top_sources', {})
+                                     st.markdown(f"**Query Sources ({len(sources)}):**")
+                                     st.text('\n'.join([f"{c.split('|')[0]} ({c.split('|')[1]})"[:30]+f": {h:,}" if '|' in c else f"{c[:30]}: {h:,}" for c,h in sources.items()]))
+                                 else: st.error(f"Query Sources Error: {sources_resp.get('error', 'Failed or invalid data')}")
+
+                             timing_text = " · ".join(f"{name} {secs*1000:.0f} ms" for name, secs in batch["timings"].items())
+                             st.caption(f"Fetched {len(batch['results'])} endpoints in {batch['elapsed']*1000:.0f} ms ({timing_text})")
+                             if batch["errors"]: st.caption(f"⚠️ Partial results — failed: {', '.join(batch['errors'])}")
+
+               with st.expander("📝 Manage Domain Lists"):
+                    list_type_manage = st.radio("Select List:", ["Whitelist", "Blacklist"], key="pihole_list_manage_type_tab", horizontal=True)
+                    list_type_arg = "white" if list_type_manage=="Whitelist" else "black"
+                    with st.form(key=f"list_manage_form_{list_type_arg}_tab"):
+                         domain_manage = st.text_input(f"Domain for {list_type_manage}:", key=f"pihole_domain_{list_type_arg}_tab")
+                         submitted_add = st.form_submit_button(f"➕ Add")
+                         submitted_rem = st.form_submit_button(f"➖ Remove")
+                         if submitted_add and domain_manage:
+                             with st.spinner(f"Adding {domain_manage} to {list_type_manage}..."): resp = add_pihole_list_api(list_type_arg, domain_manage)
+                             if resp.get("success"): st.success(f"✅ {resp.get('message', 'Added')}")
+                             else: st.error(f"❌ Add Error: {resp.get('error', 'Failed')}")
+                         elif submitted_add: st.warning("Enter domain.")
+                         if submitted_rem and domain_manage:
+                             with st.spinner(f"Removing {domain_manage} from {list_type_manage}..."): resp = remove_pihole_list_api(list_type_arg, domain_manage)
+                             if resp.get("success"): st.success(f"✅ {resp.get('message', 'Removed')}")
+                             else: st.error(f"❌ Remove Error: {resp.get('error', 'Failed')}")
+                         elif submitted_rem: st.warning("Enter domain.")
+
+               with st.expander("📄 View Domain Lists"):
+                   list_type_view = st.radio("Select List:", ["Whitelist", "Blacklist"], key="pihole_list_view_type_tab", horizontal=True)
+                   view_placeholder = st.container() # Placeholder for list content
+                   if st.button(f"View {list_type_view}", key="pihole_view_btn_tab"):
+                       list_type_arg_view = "white" if list_type_view=="Whitelist" else "black"
+                       with st.spinner(f"Fetching {list_type_view}..."): resp = get_pihole_list_content_api(list_type_arg_view)
+                       with view_placeholder: # Display results inside the placeholder
+                            if resp.get("success") and isinstance(resp.get("data"), list):
+                                entries = resp['data']
+                                st.markdown(f"**{list_type_view} ({len(entries)} entries):**")
+                                if not entries: st.write("*(List is empty)*")
+                                else:
+                                    list_display_area = st.container(height=200) # Scroll area
+                                    with list_display_area:
+                                        for item in entries:
+                                            if isinstance(item, dict):
+                                                domain=item.get('domain','?'); enabled_str=" " if item.get('enabled',1)==1 else "(D)"; comment=f" # {item.get('comment','')}" if item.get('comment') else ""
+                                                st.code(f"{domain}{enabled_str}{comment}", language=None) # Use code for monospace list
+                                            elif isinstance(item, str): st.code(f"{item}", language=None)
+                                            else: st.code(f"{str(item)}", language=None)
+                            else: st.error(f"❌ View Error: {resp.get('error', 'Failed')}")
+
+    st.markdown("---")
+    with st.expander("⏱️ DNS Benchmark (Pi-hole vs upstream resolvers)"):
+        render_dns_benchmark()
+
+
+def render_security_section():
+    """Security Audit: simulated quantum-inspired audit built on classical checks."""
+    st.subheader("Simulated Quantum Security Audit")
+    st.caption("Performs classical checks, reported with quantum-inspired framing.")
+    st.warning("🚨 **Disclaimer:** This is a **simulation**. It does **not** involve actual quantum computation or guarantee security against quantum attacks. Use professional tools for real security audits.")
+
+    audit_placeholder = st.container() # Use container for report display
+
+    if st.button("🔬 Run Simulated Audit Now", key="security_audit_button_tab"):
+         if 'audit_report' in st.session_state: del st.session_state['audit_report'] # Clear old report
+         with audit_placeholder: # Show spinner inside container
+             with st.spinner("Performing simulated audit checks..."):
+                 audit_report_md = simulate_quantum_security_audit()
+                 st.session_state.audit_report = audit_report_md
+                 speak_text("Simulated Security Audit complete.")
+         st.rerun() # Rerun to display the report below
+
+    # Display the stored report if it exists
+    if 'audit_report' in st.session_state and st.session_state.audit_report:
+         with audit_placeholder: # Display report inside the container
+             st.markdown("---")
+             st.markdown("#### Audit Report:")
+             st.markdown(st.session_state.audit_report, unsafe_allow_html=True)
+
+
+# Navigation label -> section renderer
+APP_SECTIONS = {
+    "🌌 Agent Chat": render_chat_section,
+    "🛰️ Network Matrix": render_network_section,
+    "👁️ Screen Analysis": render_screen_section,
+    "🛡️ Pi-hole Control": render_pihole_section,
+    "🔒 Security Audit": render_security_section,
+}
+
+
 # --- Main Streamlit App Function ---
 def main():
     # Page config is at the top
@@ -1865,19 +6103,12 @@ def main():
     if "prev_net_stats" not in st.session_state: st.session_state["prev_net_stats"] = None
     # Other UI or data states
     if "audit_report" not in st.session_state: st.session_state["audit_report"] = None
-    if "dedicated_speed_results" not in st.session_state: st.session_state["dedicated_speed_results"] = None
 
-    # Load initial network data **only once** after login if not already loaded
+    get_throughput_server_from_secrets() # Starts listening on first load when [throughput] server = true
+
+    # Start the initial network scan **only once** after login: the speedtest runs in the background
     if st.session_state.get('logged_in') and 'initial_network_data_loaded' not in st.session_state:
-        with st.spinner("Performing initial network scan..."):
-             st.session_state.current_network_data = get_initial_network_status()
-             # Show toasts based on initial scan results (only if not empty)
-             net_data = st.session_state.current_network_data
-             if net_data.get("speedtest_error"): st.toast(f"Initial Scan: {net_data['speedtest_error']}", icon="⚡")
-             if net_data.get("external_ip_error"): st.toast(f"Initial Scan: {net_data['external_ip_error']}", icon="🌐")
-             if not net_data.get("speedtest_error") and not net_data.get("external_ip_error"):
-                  st.toast("Initial network scan complete.", icon="🛰️")
-        st.session_state.initial_network_data_loaded = True
+        start_initial_network_scan()
 
 
     # --- Sidebar ---
@@ -1923,7 +6154,7 @@ def main():
                 for key in keys_to_clear:
                     if key != 'logged_in': del st.session_state[key]
                 st.session_state['logged_in'] = False
-                st.cache_data.clear(); st.cache_resource.clear()
+                st.cache_data.clear() # Shared resources (st.cache_resource) are process-wide and outlive a login
                 st.success("Logged out."); time.sleep(1); st.rerun()
 
         st.markdown("---")
@@ -1931,7 +6162,7 @@ def main():
         st.subheader("System Status")
         azure_secrets_exist = "azure_ai" in st.secrets and "api_key" in st.secrets.azure_ai
         azure_key_is_placeholder = azure_secrets_exist and st.secrets.azure_ai.api_key == "YOUR_AZURE_AI_API_KEY_OR_GITHUB_PAT"
-        if azure_client and azure_ai_enabled: st.markdown("🔵 **Azure AI:** <span class='status-ok'>Connected</span>", unsafe_allow_html=True)
+        if azure_ai_enabled: st.markdown("🔵 **Azure AI:** <span class='status-ok'>Connected</span>", unsafe_allow_html=True)
         elif not azure_secrets_exist: st.markdown("🔵 **Azure AI:** <span class='status-error'>No Config</span>", unsafe_allow_html=True)
         elif azure_key_is_placeholder: st.markdown("🔵 **Azure AI:** <span class='status-error'>Placeholder Key</span>", unsafe_allow_html=True)
         else: st.markdown("🔵 **Azure AI:** <span class='status-error'>Init Failed</span>", unsafe_allow_html=True)
@@ -1946,55 +6177,23 @@ def main():
         # Live System Stats (Only when logged in)
         if st.session_state.get("logged_in", False):
             st.subheader("Live Stats")
-            col_cpu, col_temp = st.columns(2)
-            col_ram, col_disk = st.columns(2)
-            try:
-                pi_stats = get_pi_status() # Cached
-                # Define colors based on thresholds
-                cpu_color = "#ccff00"; temp_color="#ff9933"; ram_color="#00ffff"; disk_color="#ff00ff"
-                try: temp_val = float(re.findall(r"[-+]?\d*\.\d+|\d+", pi_stats['cpu_temperature'])[0])
-                except: temp_val = -100
-                if temp_val > 75: temp_color = "#ff0000" # Red
-                elif temp_val > 60: temp_color = "#ffff00" # Yellow
-
-                try: cpu_val = float(pi_stats['cpu_usage'].strip('%'))
-                except: cpu_val = 0
-                if cpu_val > 90: cpu_color = "#ff0000"
-                elif cpu_val > 70: cpu_color = "#ffff00"
-
-                try: ram_val = float(pi_stats['ram_usage'].split('%')[0])
-                except: ram_val = 0
-                if ram_val > 90: ram_color = "#ff0000"
-                elif ram_val > 75: ram_color = "#ffff00"
-
-                try: disk_val = float(pi_stats['disk_usage'].split('%')[0])
-                except: disk_val = 0
-                if disk_val > 90: disk_color = "#ff0000"
-                elif disk_val > 80: disk_color = "#ffff00"
-
-
-                with col_cpu: st.markdown(f"**CPU:** <span style='color: {cpu_color};'>{pi_stats['cpu_usage']}</span>", unsafe_allow_html=True)
-                with col_temp: st.markdown(f"**Temp:** <span style='color: {temp_color};'>{pi_stats['cpu_temperature']}</span>", unsafe_allow_html=True)
-                with col_ram: st.markdown(f"**RAM:** <span style='color: {ram_color};'>{pi_stats['ram_usage'].split(' ')[0]}</span>", unsafe_allow_html=True)
-                with col_disk: st.markdown(f"**Disk:** <span style='color: {disk_color};'>{pi_stats['disk_usage'].split(' ')[0]}</span>", unsafe_allow_html=True)
-
-                # Detailed usage in caption
-                ram_detail = pi_stats['ram_usage'].split(' (',1)[1].split(')',1)[0] if ' (' in pi_stats['ram_usage'] else '-'
-                disk_detail = pi_stats['disk_usage'].split(' (',1)[1].split(')',1)[0] if ' (' in pi_stats['disk_usage'] else '-'
-                st.caption(f"RAM: {ram_detail} | Disk: {disk_detail}")
-
-            except Exception as e: st.error(f"Live stats error: {type(e).__name__}")
+            render_live_stats() # Self-refreshing fragment, reruns alone every LIVE_STATS_INTERVAL s
 
             st.markdown("---")
             # TTS Toggle
             st.subheader("Settings")
-            tts_available = st.session_state.get("tts_engine") is not None
+            tts_available = HAS_TTS_LIB and "tts_init_error_shown" not in st.session_state
             default_tts_state = tts_available
             st.session_state["tts_toggle"] = st.toggle(
                 "Enable TTS Output", value=st.session_state.get("tts_toggle", default_tts_state),
                 key="tts_main_toggle", disabled=not tts_available,
                 help="Enable/disable text-to-speech for AI responses and actions.")
-            if not tts_available: st.caption("TTS engine failed to initialize.")
+            if not tts_available: st.caption("TTS unavailable (pyttsx3 missing or engine failed to initialize).")
+            st.toggle("Reuse cached AI answers", value=True, key="response_cache_on", disabled=not azure_ai_enabled,
+                      help="Repeated questions (and the same question about a pixel-identical screen) are answered from a short-lived cache. Turn off to force a fresh answer.")
+
+            render_startup_timing_report()
+            render_azure_connection_stats()
 
 
     # --- Main Application Area (Displayed only if logged in) ---
@@ -2016,614 +6215,20 @@ def main():
         # Ensure network data is loaded (safe redundant check)
         if 'initial_network_data_loaded' not in st.session_state:
              # This block shouldn't normally be hit if login flow is correct, but acts as a fallback
-             with st.spinner("Performing initial network scan..."):
-                  st.session_state.current_network_data = get_initial_network_status()
-             st.session_state.initial_network_data_loaded = True
-        # Use the loaded data from session state
-        network_data = st.session_state.get("current_network_data")
-
-        # Define Tabs
-        tab_chat, tab_network, tab_screen, tab_pihole, tab_security = st.tabs([
-            "🌌 Agent Chat", "🛰️ Network Matrix", "👁️ Screen Analysis", "🛡️ Pi-hole Control", "🔒 Security Audit"
-            ])
-
-        # =========================
-        # Agent Chat Tab
-        # =========================
-        with tab_chat:
-            # Create a container for the chat history for fixed height scrolling
-            chat_container = st.container(height=550) # Adjust height as needed
-
-            with chat_container:
-                # Display chat history
-                if not st.session_state.chat_history:
-                     st.markdown("*(Chat history is clear. Ask me anything!)*")
-                for i, message in enumerate(st.session_state.chat_history):
-                    is_user = message["role"] == "user"
-                    avatar_display = circular_user_image if is_user else circular_ai_image
-                    with st.chat_message(name=message["role"], avatar=avatar_display):
-                        st.markdown(message["content"], unsafe_allow_html=True)
-
-            # Separate container for input elements below the chat history
-            input_container = st.container()
-            with input_container:
-                 col_voice, col_input = st.columns([1, 6]) # Adjust ratio if needed
-                 with col_voice:
-                      voice_disabled = st.session_state.get("recognizer") is None or not azure_ai_enabled
-                      if st.button("🎤", key="voice_cmd_main", help="Ask via Voice (if mic available & enabled)", disabled=voice_disabled, type="secondary"):
-                           voice_prompt = listen_for_command()
-                           if voice_prompt:
-                                st.session_state.main_chat_input_value = voice_prompt
-                                st.rerun() # Rerun to process the voice input
-
-                 with col_input:
-                      prompt_text = st.chat_input(
-                          "Ask CyberNexus Q...", key="main_chat_input", disabled=not azure_ai_enabled
-                      )
-
-            # --- Process New Input (Check text input OR value from voice state) ---
-            final_prompt = prompt_text or st.session_state.pop('main_chat_input_value', None) # Prioritize text, fallback/clear voice state
-
-            if final_prompt:
-                st.session_state.chat_history.append({"role": "user", "content": final_prompt})
-                st.rerun() # Display user message immediately
-
-            # --- AI Response Generation Trigger ---
-            if st.session_state.chat_history and st.session_state.chat_history[-1]["role"] == "user":
-                last_user_prompt = st.session_state.chat_history[-1]["content"]
-
-                # Display thinking message inside the chat container
-                with chat_container:
-                     with st.chat_message("assistant", avatar=circular_ai_image):
-                         ai_response_placeholder = st.empty()
-                         ai_response_placeholder.markdown("```processing\nThinking...\n```")
-
-                         full_response_text = ""
-                         action_response_md = None
-                         stream_error = False
-                         history_appended_this_turn = False
-
-                         try:
-                             prompt_lower = last_user_prompt.lower()
-                             action_executed = False
-                             network_keywords = ["network status", "internet status", "quick check", "ip address", "connection status", "network check", "netstat", "speed", "my ip"]
-                             pi_status_keywords = ["pi status", "system status", "specs", "check system", "raspberry pi status", "pi check", "server status", "status check", "sysinfo"]
-
-                             # --- Direct Action: Pi Status ---
-                             if any(k in prompt_lower for k in pi_status_keywords) or re.search(r"\b(cpu|ram|temp|disk)\b", prompt_lower):
-                                 pi_stats_data = get_pi_status() # Cached
-                                 action_response_md = (f"⚙️ **Pi System Status (via `psutil`):**\n\n"
-                                                       f"- **CPU:** `{pi_stats_data['cpu_usage']}`\n"
-                                                       f"- **Temp:** `{pi_stats_data['cpu_temperature']}`\n"
-                                                       f"- **RAM:** `{pi_stats_data['ram_usage']}`\n"
-                                                       f"- **Disk:** `{pi_stats_data['disk_usage']}`")
-                                 action_executed = True
-                                 full_response_text = "Retrieved current system status:"
-
-                             # --- Direct Action: Network Quick Check (Cached) ---
-                             elif any(k in prompt_lower for k in network_keywords):
-                                 net_stats_data = st.session_state.get('current_network_data')
-                                 if net_stats_data:
-                                     dl_sp=net_stats_data.get('download_speed'); ul_sp=net_stats_data.get('upload_speed')
-                                     ping_v=net_stats_data.get('ping')
-                                     dl_str=f"{dl_sp:.2f}" if isinstance(dl_sp,(int,float)) else "N/A"
-                                     ul_str=f"{ul_sp:.2f}" if isinstance(ul_sp,(int,float)) else "N/A"
-                                     ping_str=f"{ping_v:.1f}" if isinstance(ping_v,(int,float)) else "N/A"
-                                     action_response_md = (f"⚙️ **Network Quick Check (Cached):**\n\n"
-                                                           f"- **Down/Up:** `{dl_str}` / `{ul_str}` Mbps\n"
-                                                           f"- **Ping:** `{ping_str} ms`\n"
-                                                           f"- **External IP:** `{net_stats_data.get('external_ip', 'N/A')}`")
-                                     if net_stats_data.get("speedtest_error"): action_response_md += f"\n\n  - *Speedtest Note:* _{net_stats_data['speedtest_error']}_"
-                                     if net_stats_data.get("external_ip_error"): action_response_md += f"\n  - *Ext. IP Note:* _{net_stats_data['external_ip_error']}_"
-                                     action_response_md += "\n\n*(Use Network Matrix tab for details/fresh tests)*"
-                                 else: action_response_md = "⚙️ Cached network data not available yet. Try the Network Matrix tab."
-                                 action_executed = True
-                                 full_response_text = "Here's the last cached network overview:"
-
-                             # --- Direct Action: Pi-hole Status ---
-                             elif pihole_enabled and ("pi-hole status" in prompt_lower or "pihole status" in prompt_lower):
-                                  with st.spinner("Checking Pi-hole status..."): status_result = get_cached_pihole_status_display() # Use cached one from display tab
-                                  if status_result.startswith("api_error"): action_response_md = f"⚙️ **Pi-hole Status Error:** `{status_result}`"
-                                  else: action_response_md = f"⚙️ **Pi-hole Status:** `{status_result.upper()}`"
-                                  action_executed = True
-
-                             # --- Direct Action: Run Security Audit ---
-                             elif "security audit" in prompt_lower or "quantum check" in prompt_lower or "security scan" in prompt_lower or "run audit" in prompt_lower:
-                                 with st.spinner("Initiating Simulated Azure Quantum Security Audit..."):
-                                     action_response_md = simulate_quantum_security_audit()
-                                 action_executed = True
-                                 full_response_text = "Simulated Security Audit complete."
-
-                             # --- Fallback to LLM if NO direct action matched ---
-                             if not action_executed:
-                                  response_stream = get_azure_ai_text_response_stream(
-                                       last_user_prompt, st.session_state.chat_history[:-1]
-                                  )
-                                  streamed_chunks = []
-                                  for chunk in response_stream:
-                                      if chunk == "[STREAM_DONE]": break
-                                      if chunk.startswith("[Error:") or chunk.startswith("[Warning:") or chunk.startswith("[Info:"):
-                                          if chunk.startswith("[Error:"):
-                                               full_response_text = chunk # Display error
-                                               ai_response_placeholder.error(full_response_text)
-                                               stream_error = True; break # Stop stream
-                                          else: st.toast(chunk[chunk.find(':')+1:].strip(), icon="⚠️" if chunk.startswith("[Warning:") else "ℹ️"); continue # Show toast, continue stream
-                                      streamed_chunks.append(chunk)
-                                      full_response_text = "".join(streamed_chunks)
-                                      ai_response_placeholder.markdown(full_response_text + "▌", unsafe_allow_html=True) # Stream cursor
-
-                                  if not stream_error: # Final update without cursor
-                                       ai_response_placeholder.markdown(full_response_text, unsafe_allow_html=True)
-
-
-                             # --- Combine LLM/Action Results & Update History ---
-                             final_response_content = full_response_text
-                             if action_response_md:
-                                 if final_response_content and not stream_error: final_response_content += f"\n\n---\n{action_response_md}"
-                                 else: final_response_content = action_response_md # Only action result
-
-                             if not final_response_content and not stream_error: # Handle totally empty case
-                                 final_response_content = "[AI response was empty and no specific action was taken.]"
-                                 ai_response_placeholder.warning(final_response_content)
-
-                             if not stream_error: # Update placeholder if no error already shown
-                                  ai_response_placeholder.markdown(final_response_content, unsafe_allow_html=True)
-
-                             if final_response_content: # Append final content to history
-                                 st.session_state.chat_history.append({"role": "assistant", "content": final_response_content})
-                                 history_appended_this_turn = True
-
-                             # --- Text-to-Speech ---
-                             text_for_tts = "" # Determine what to speak
-                             if action_executed and not stream_error: # Action completed
-                                 if "Pi System Status" in final_response_content: text_for_tts = "Showing system status."
-                                 elif "Network Quick Check" in final_response_content: text_for_tts = "Showing network overview."
-                                 elif "Pi-hole Status:" in final_response_content: text_for_tts = "Pi-hole status: " + final_response_content.split("`")[-2]
-                                 elif "Security Audit" in final_response_content: text_for_tts = "Simulated security audit complete."
-                                 else: text_for_tts = "Action complete."
-                             elif not action_executed and full_response_text and not stream_error: text_for_tts = full_response_text # Speak LLM response
-                             elif stream_error: text_for_tts = "An error occurred generating the response."
-                             if text_for_tts: speak_text(text_for_tts)
-
-                         except Exception as e: # Catch errors during processing step
-                             st.error(f"💥 Error during response processing: {type(e).__name__}")
-                             detailed_error = traceback.format_exc()
-                             print(f"DEBUG: Response Processing Error:\n{detailed_error}")
-                             error_msg_display = f"[Internal Error processing response: {type(e).__name__}]"
-                             ai_response_placeholder.error(error_msg_display)
-                             if not history_appended_this_turn: # Append error if nothing else was
-                                 st.session_state.chat_history.append({"role": "assistant", "content": error_msg_display})
-                                 history_appended_this_turn = True
-
-                # Rerun AFTER the assistant's message processing is complete (normal or error)
-                # CORRECTED INDENTATION for this block:
-                if history_appended_this_turn:
-                    st.rerun()
-
-
-        # =========================
-        # Network Matrix Tab
-        # =========================
-        with tab_network:
-            st.subheader("Network Matrix & Analysis")
-
-            col_ref, col_spd = st.columns([1,3])
-            with col_ref:
-                 if st.button("🔄 Refresh Scan", key="refresh_network_button_network_tab", help="Runs speedtest and external IP check again"):
-                     get_initial_network_status.clear()
-                     with st.spinner("Refreshing network scan..."):
-                         st.session_state.current_network_data = get_initial_network_status()
-                         net_data = st.session_state.current_network_data
-                         if net_data.get("speedtest_error"): st.toast(f"Refresh: {net_data['speedtest_error']}", icon="⚡")
-                         if net_data.get("external_ip_error"): st.toast(f"Refresh: {net_data['external_ip_error']}", icon="🌐")
-                         else: st.toast("Network scan refresh complete.", icon="🛰️")
-                     st.session_state.initial_network_data_loaded = True
-                     if 'dedicated_speed_results' in st.session_state: del st.session_state['dedicated_speed_results'] # Clear dedicated results too
-                     st.rerun()
-            with col_spd:
-                 if st.button("⚡ Run Dedicated Speed Test Now", key="speedtest_button_network_tab"):
-                     run_speedtest_dedicated.clear()
-                     with st.spinner("Running dedicated speed test... This may take a minute."):
-                         speed_results = run_speedtest_dedicated()
-                     st.session_state.dedicated_speed_results = speed_results
-                     st.rerun()
-
-            st.markdown("---")
-            network_data = st.session_state.get('current_network_data', {}) # Use empty dict as default
-
-            # Display Initial/Refreshed Scan Results
-            st.markdown("#### Network Overview (Last Scan)")
-            display_speedtest_results(network_data)
-            st.caption(f"External IP: `{network_data.get('external_ip', 'N/A')}`")
-            if network_data.get("speedtest_error"): st.caption(f"*Speedtest Note:* _{network_data['speedtest_error']}_")
-            if network_data.get("external_ip_error"): st.caption(f"*Ext. IP Note:* _{network_data['external_ip_error']}_")
-            st.markdown("---")
-
-            # Display Dedicated Speed Test Results if they exist
-            if 'dedicated_speed_results' in st.session_state and st.session_state.dedicated_speed_results is not None:
-                 st.markdown("#### Dedicated Speed Test Results")
-                 display_speedtest_results(st.session_state.dedicated_speed_results)
-                 st.markdown("---")
-
-            # Interface Details and Traffic Analysis in Columns
-            col_net_iface, col_net_traffic = st.columns([1, 1.5])
-
-            with col_net_iface:
-                st.markdown("#### Interface Intelligence (psutil)")
-                interfaces_info = get_network_interfaces_psutil() # Cached data
-                interface_names = list(interfaces_info.keys()) if interfaces_info else []
-
-                if not interface_names: st.warning("No network interfaces found.")
-                else:
-                    default_index = 0 # Find a sensible default
-                    for i, name in enumerate(interface_names):
-                        if interfaces_info[name].get('is_up') and not name.startswith('lo'):
-                            default_index = i; break
-                    selected_interface = st.selectbox("Select Interface:", interface_names, key="interface_select", index=default_index)
-                    if selected_interface:
-                        iface_details = format_interface_details_psutil(interfaces_info, selected_interface)
-                        if iface_details.get("Error"): st.error(iface_details["Error"])
-                        else:
-                             st.markdown(f"""
-                             - Status: `{iface_details['Status']}` (Speed: `{iface_details['Speed']}`)
-                             - MAC: `{', '.join(iface_details['MAC'])}`
-                             - IPv4: `{', '.join(iface_details['IPv4'])}`
-                             - IPv6: `{', '.join(iface_details['IPv6'])}`
-                             """, unsafe_allow_html=True)
-
-            with col_net_traffic:
-                st.markdown("#### Real-time Traffic Analysis (psutil)")
-                run_analysis = st.checkbox("Activate Traffic Scan", key="anomaly_toggle", value=st.session_state.get('network_anomaly_running', False), help="Periodically checks network IO rates and errors/drops.")
-                status_area = st.container()
-                stats_display_area = st.container()
-
-                if run_analysis:
-                    if not st.session_state.get('network_anomaly_running', False):
-                         st.session_state['network_anomaly_running'] = True
-                         st.session_state['prev_net_stats'] = get_network_io_stats() # Initial baseline
-                         status_area.info("Traffic Scan Activated... Waiting for interval.")
-                         # No immediate rerun needed, let the loop start below
-
-                    # --- Analysis Loop Logic ---
-                    current_net_stats = get_network_io_stats()
-                    prev_net_stats = st.session_state.get('prev_net_stats')
-                    stats_df = None # Initialize dataframe variable
-
-                    if current_net_stats and prev_net_stats:
-                        analysis_result = analyze_network_traffic(prev_net_stats, current_net_stats)
-                        if "⚠️ **Anomaly" in analysis_result: status_area.error(analysis_result, icon="🚨")
-                        elif "Insufficient data" in analysis_result or "Interval too short" in analysis_result: status_area.warning(analysis_result, icon="⏳")
-                        else: status_area.success(analysis_result, icon="✅")
-                        # Display *cumulative* stats
-                        stats_readable = {
-                            "Time": time.strftime('%H:%M:%S'), "Sent Σ": format_bytes(current_net_stats.get('bytes_sent')),
-                            "Recv Σ": format_bytes(current_net_stats.get('bytes_recv')), "Pkt Sent Σ": f"{current_net_stats.get('packets_sent', 0):,}",
-                            "Pkt Recv Σ": f"{current_net_stats.get('packets_recv', 0):,}", "Err Σ(I/O)": f"{current_net_stats.get('errin', 0)}/{current_net_stats.get('errout', 0)}",
-                            "Drop Σ(I/O)": f"{current_net_stats.get('dropin', 0)}/{current_net_stats.get('dropout', 0)}",
-                        }
-                        stats_df = pd.DataFrame([stats_readable])
-                        st.session_state['prev_net_stats'] = current_net_stats # Update for next cycle
-                    elif not current_net_stats: status_area.warning("Could not retrieve current network IO stats.")
-                    else: status_area.info("Waiting for next interval to calculate rates...") ; st.session_state['prev_net_stats'] = current_net_stats # Store first reading
-
-                    # Display cumulative stats table
-                    if stats_df is not None:
-                         stats_display_area.dataframe( stats_df.style.set_properties(**{'text-align': 'left', 'font-size': '0.9em'}).hide(axis="index"), use_container_width=True )
-                    else: stats_display_area.empty()
-
-                    # --- Auto-refresh ---
-                    # Use time.sleep cautiously as it blocks interaction
-                    time.sleep(3) # Interval in seconds
-                    st.rerun()
-
-                else: # Checkbox is off
-                    if st.session_state.get('network_anomaly_running', False): # If it *was* running
-                        st.session_state['network_anomaly_running'] = False
-                        st.session_state['prev_net_stats'] = None
-                        status_area.info("Traffic Scan Deactivated.")
-                        stats_display_area.empty()
-                        st.rerun() # Rerun once to clear UI
-                    else: # Already off
-                        status_area.info("Activate scan to monitor traffic rates and detect anomalies.")
-                        stats_display_area.empty()
-
-
-        # =========================
-        # Screen Analysis Tab
-        # =========================
-        with tab_screen:
-            st.subheader("Multimodal Screen Analysis (Azure AI Vision)")
-            col_share_ctl, col_share_view = st.columns([1, 2])
-
-            with col_share_ctl:
-                st.markdown("#### Controls")
-                sharing_active = st.session_state.get('sharing', False)
-                button_text = "⏹️ Stop Screen Feed" if sharing_active else "▶️ Start Screen Feed"
-                if st.button(button_text, key="toggle_share"):
-                    st.session_state.sharing = not st.session_state.sharing
-                    if not st.session_state.sharing: st.session_state.current_frame = None
-                    st.rerun() # Rerun to update viewport and button state
-
-                st.caption("Shares primary monitor for visual analysis.")
-                st.markdown("---")
-
-                st.markdown("#### Analyze Screen")
-                screen_chat_container = st.container(height=400)
-                current_screen_history = st.session_state.get('screen_chat_history', [])
-                with screen_chat_container:
-                    if not current_screen_history: st.markdown("*(Start screen feed and ask questions about it...)*")
-                    for message in current_screen_history:
-                        msg_role = message["role"]
-                        msg_avatar = circular_user_image if msg_role == "user" else circular_ai_image
-                        with st.chat_message(msg_role, avatar=msg_avatar):
-                            st.markdown(message["content"], unsafe_allow_html=True)
-
-                input_disabled = not sharing_active or not azure_ai_enabled
-                disable_reason = ""
-                if not sharing_active: disable_reason = "Start screen feed first."
-                elif not azure_ai_enabled: disable_reason = "Azure AI Vision not available."
-
-                screen_prompt = st.chat_input("Ask about the screen feed...", key="screen_chat_input", disabled=input_disabled)
-                if input_disabled and not disable_reason.startswith("Azure"): st.caption(f":warning: Input disabled: {disable_reason}")
-                elif input_disabled: st.caption(f":warning: {disable_reason}") # Don't show warning if Azure is just off
-
-                if screen_prompt:
-                    if not sharing_active: st.toast("Screen feed is not active.", icon="⚠️")
-                    elif st.session_state.get('current_frame') is None: st.toast("Screen frame not captured yet.", icon="⏳")
-                    else:
-                        st.session_state.screen_chat_history.append({"role": "user", "content": screen_prompt})
-                        st.rerun()
-
-            # --- Screen Analysis Processing Trigger ---
-            if current_screen_history and current_screen_history[-1]["role"] == "user":
-                last_screen_prompt = current_screen_history[-1]["content"]
-                current_frame = st.session_state.get('current_frame')
-
-                with screen_chat_container:
-                    with st.chat_message("assistant", avatar=circular_ai_image):
-                        analysis_placeholder = st.empty()
-                        analysis_placeholder.markdown("```processing\n👁️ Analyzing screen with Azure AI Vision...\n```")
-
-                        if current_frame is not None and azure_ai_enabled:
-                            analysis_result_text = "[Analysis Error: Placeholder]"
-                            try:
-                                img_rgb = cv2.cvtColor(current_frame, cv2.COLOR_BGR2RGB)
-                                pil_img = Image.fromarray(img_rgb)
-                                buffer = io.BytesIO()
-                                pil_img.save(buffer, format="JPEG", quality=85)
-                                img_bytes = buffer.getvalue()
-                                analysis_result_text = get_azure_ai_vision_response(last_screen_prompt, img_bytes)
-                            except Exception as e:
-                                error_msg = f"Screen Vision Prep/Analysis failed: {type(e).__name__}"
-                                st.toast(f"💥 {error_msg}", icon="👁️")
-                                print(f"Error during Vision call/prep: {traceback.format_exc()}")
-                                analysis_result_text = f"[Error: {error_msg}]"
-
-                            analysis_placeholder.markdown(analysis_result_text, unsafe_allow_html=True)
-                            st.session_state.screen_chat_history.append({"role": "assistant", "content": analysis_result_text})
-                            if not analysis_result_text.startswith(("[Error:", "[Info:")) and st.session_state.get('tts_toggle'):
-                                tts_summary = analysis_result_text.split('. ')[0] + "." if '.' in analysis_result_text else analysis_result_text[:150]
-                                speak_text(f"Vision analysis: {tts_summary}")
-                            st.rerun()
-
-                        elif not azure_ai_enabled:
-                             error_msg = "[Error: Azure AI Vision client not available]"
-                             analysis_placeholder.error(error_msg)
-                             st.session_state.screen_chat_history.append({"role": "assistant", "content": error_msg}); st.rerun()
-                        else: # Frame missing
-                            error_msg = "[Internal Error: Screen frame missing during analysis]"
-                            analysis_placeholder.warning(error_msg)
-                            st.session_state.screen_chat_history.append({"role": "assistant", "content": error_msg}); st.rerun()
-
-            # Screen Viewport (Right Column)
-            with col_share_view:
-                st.markdown("#### Live Feed Viewport")
-                image_placeholder = st.empty()
-                if st.session_state.get('sharing', False):
-                    share_error_placeholder = st.empty() # For persistent errors
-                    try:
-                        with mss(display=os.environ.get('DISPLAY')) as sct:
-                            monitor_index = 1 # Try primary first
-                            if len(sct.monitors) <= monitor_index: monitor_index = 0 # Fallback
-                            if not sct.monitors: raise Exception("No monitors detected")
-                            monitor = sct.monitors[monitor_index]
-
-                            screen_frame_mss = sct.grab(monitor)
-                            frame_np = np.array(screen_frame_mss)
-                            frame_bgr = cv2.cvtColor(frame_np, cv2.COLOR_BGRA2BGR)
-                            st.session_state.current_frame = frame_bgr
-
-                            display_img_rgb = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
-                            image_placeholder.image(display_img_rgb,
-                                caption=f"Screen Feed Active - Monitor {monitor_index} ({monitor.get('width','?') }x{monitor.get('height','?')})",
-                                use_container_width=True, output_format='RGB')
-
-                        # --- Frame rate control ---
-                        refresh_interval = 0.7 # ~1.4 FPS. Increase if CPU usage too high
-                        time.sleep(refresh_interval)
-                        st.rerun()
-
-                    except ImportError:
-                        st.error("Screen sharing requires `mss` library: `pip install mss`")
-                        st.session_state.sharing = False; st.session_state.current_frame = None
-                        image_placeholder.warning("Sharing stopped: library missing."); st.rerun()
-                    except Exception as e:
-                        share_error_placeholder.error(f"Screen sharing error: {type(e).__name__}. Stopping feed.")
-                        print(f"Screen Sharing Traceback: {traceback.format_exc()}")
-                        st.session_state.sharing = False; st.session_state.current_frame = None
-                        # Don't rerun automatically on error, let user restart
-
-                else: # Sharing is not active
-                    image_placeholder.info("Screen sharing inactive. ▶️ Start feed to enable analysis.")
-                    if st.session_state.get('current_frame') is not None:
-                        st.session_state.current_frame = None # Clear frame when stopped
-
-
-        # =========================
-        # Pi-hole Control Tab
-        # =========================
-        with tab_pihole:
-             st.subheader("Pi-hole Network Protection Control")
-
-             if not pihole_enabled:
-                  st.warning("Pi-hole integration disabled. Configure `[pihole_api]` with `url` in `secrets.toml`.")
-             else:
-                  # Status and Toggle
-                  status_col, control_col = st.columns([1, 1.5])
-                  with status_col:
-                       st.markdown("#### Status & Toggle")
-                       status_placeholder = st.empty()
-                       # Use cached status function
-                       @st.cache_data(ttl=8)
-                       def get_cached_pihole_status_display():
-                            return get_pihole_status_from_api()
-
-                       current_status = get_cached_pihole_status_display()
-
-                       with status_placeholder.container():
-                           if current_status.startswith("api_error"):
-                               st.error(f"Status Error:\n`{current_status}`")
-                               if st.button("Retry Status", key="retry_pihole_status"):
-                                    get_cached_pihole_status_display.clear(); st.rerun()
-                           elif current_status in ["enabled", "disabled"]:
-                               status_color = "lightgreen" if current_status == "enabled" else "orange"
-                               st.markdown(f"Current Status: <span style='color:{status_color}; font-weight:bold;'>{current_status.upper()}</span>", unsafe_allow_html=True)
-                               is_enabled = current_status == "enabled"
-                               if is_enabled:
-                                   disable_duration = st.selectbox("Disable Temporarily For:",
-                                       options=[0, 10, 30, 60, 300, 900], index=1, # Default 10s
-                                       format_func=lambda x: f"{x}s" if x==10 else (f"{x}s ({x//60}m)" if x>=60 else "Permanently"),
-                                       key="pihole_disable_duration")
-                                   if st.button("🚫 Disable Pi-hole", key="pihole_disable_btn"):
-                                       duration_text = f" for {disable_duration}s" if disable_duration>0 else ""
-                                       with st.spinner(f"Disabling Pi-hole{duration_text}..."): resp = disable_pihole_api(disable_duration)
-                                       if resp.get("success"): st.success(f"✅ {resp.get('message', 'Disabled')}")
-                                       else: st.error(f"❌ {resp.get('error', 'Failed')}")
-                                       get_cached_pihole_status_display.clear(); time.sleep(0.5); st.rerun()
-                               else: # Pi-hole is disabled
-                                   if st.button("✅ Enable Pi-hole", key="pihole_enable_btn"):
-                                       with st.spinner("Enabling Pi-hole..."): resp = enable_pihole_api()
-                                       if resp.get("success"): st.success(f"✅ {resp.get('message', 'Enabled')}")
-                                       else: st.error(f"❌ {resp.get('error', 'Failed')}")
-                                       get_cached_pihole_status_display.clear(); time.sleep(0.5); st.rerun()
-                           else: # Status is unknown
-                               st.warning(f"Status Unknown: `{current_status}`")
-                               if st.button("Retry Status", key="retry_pihole_status_unknown"):
-                                    get_cached_pihole_status_display.clear(); st.rerun()
-
-                  # Separator
-                  st.markdown("<hr style='margin: 1rem 0;'>", unsafe_allow_html=True)
-
-                  # Other Pi-hole functions
-                  with control_col:
-                        st.markdown("#### Statistics & Lists")
-                        with st.expander("📊 View Summary & Top Items"):
-                            # Placeholder for results
-                             summary_placeholder = st.empty()
-                             top_items_placeholder = st.empty()
-                             if st.button("Fetch Stats", key="pihole_stats_btn_tab"):
-                                 summary_placeholder.text("Fetching summary...")
-                                 top_items_placeholder.text("Fetching top items...")
-                                 summary_resp = get_pihole_summary_api()
-                                 top_resp = get_pihole_top_items_api(count=7)
-
-                                 with summary_placeholder.container():
-                                     if summary_resp.get("success"):
-                                         data = summary_resp['data']
-                                         st.markdown(f"""
-                                         - Queries (Today): `{data.get('dns_queries_today', 'N/A'):,}`
-                                         - Blocked (Today): `{data.get('ads_blocked_today', 'N/A'):,}` (`{data.get('ads_percentage_today', 'N/A')}%`)
-                                         - Domains Blocked: `{data.get('domains_being_blocked', 'N/A'):,}`
-                                         - Unique Clients: `{data.get('unique_clients', 'N/A')}`
-                                         """, unsafe_allow_html=True)
-                                     else: st.error(f"Summary Error: {summary_resp.get('error', 'Failed')}")
-
-                                 with top_items_placeholder.container():
-                                      st.markdown("---")
-                                      if top_resp.get("success") and isinstance(top_resp.get('data'), dict):
-                                          data=top_resp['data']; st.markdown("**Top 7 Items:**")
-                                          st.markdown("<u>Queries / Blocked / Clients:</u>", unsafe_allow_html=True)
-                                          # Display in columns for better layout
-                                          col_tq, col_tb, col_tc = st.columns(3)
-                                          with col_tq: st.text('\n'.join([f"{d[:15]}: {h:,}" for d,h in list(data.get('top_queries',{}).items())[:7]]))
-                                          with col_tb: st.text('\n'.join([f"{d[:15]}: {h:,}" for d,h in list(data.get('top_ads',{}).items())[:7]]))
-                                          with col_tc: st.text('\n'.join([f"{c.split('|')[0]} ({c.split('|')[1]})"[:20]+f": {h:,}" if '|' in c else f"{c[:15]}: {h:,}" for c,h in list(data.get('top_sources',{}).items())[:7]]))
-                                      else: st.error(f"Top Items Error: {top_resp.get('error', 'Failed or invalid data')}")
-
-                        with st.expander("📝 Manage Domain Lists"):
-                             list_type_manage = st.radio("Select List:", ["Whitelist", "Blacklist"], key="pihole_list_manage_type_tab", horizontal=True)
-                             list_type_arg = "white" if list_type_manage=="Whitelist" else "black"
-                             with st.form(key=f"list_manage_form_{list_type_arg}_tab"):
-                                  domain_manage = st.text_input(f"Domain for {list_type_manage}:", key=f"pihole_domain_{list_type_arg}_tab")
-                                  submitted_add = st.form_submit_button(f"➕ Add")
-                                  submitted_rem = st.form_submit_button(f"➖ Remove")
-                                  if submitted_add and domain_manage:
-                                      with st.spinner(f"Adding {domain_manage} to {list_type_manage}..."): resp = add_pihole_list_api(list_type_arg, domain_manage)
-                                      if resp.get("success"): st.success(f"✅ {resp.get('message', 'Added')}")
-                                      else: st.error(f"❌ Add Error: {resp.get('error', 'Failed')}")
-                                  elif submitted_add: st.warning("Enter domain.")
-                                  if submitted_rem and domain_manage:
-                                      with st.spinner(f"Removing {domain_manage} from {list_type_manage}..."): resp = remove_pihole_list_api(list_type_arg, domain_manage)
-                                      if resp.get("success"): st.success(f"✅ {resp.get('message', 'Removed')}")
-                                      else: st.error(f"❌ Remove Error: {resp.get('error', 'Failed')}")
-                                  elif submitted_rem: st.warning("Enter domain.")
-
-                        with st.expander("📄 View Domain Lists"):
-                            list_type_view = st.radio("Select List:", ["Whitelist", "Blacklist"], key="pihole_list_view_type_tab", horizontal=True)
-                            view_placeholder = st.container() # Placeholder for list content
-                            if st.button(f"View {list_type_view}", key="pihole_view_btn_tab"):
-                                list_type_arg_view = "white" if list_type_view=="Whitelist" else "black"
-                                with st.spinner(f"Fetching {list_type_view}..."): resp = get_pihole_list_content_api(list_type_arg_view)
-                                with view_placeholder: # Display results inside the placeholder
-                                     if resp.get("success") and isinstance(resp.get("data"), list):
-                                         entries = resp['data']
-                                         st.markdown(f"**{list_type_view} ({len(entries)} entries):**")
-                                         if not entries: st.write("*(List is empty)*")
-                                         else:
-                                             list_display_area = st.container(height=200) # Scroll area
-                                             with list_display_area:
-                                                 for item in entries:
-                                                     if isinstance(item, dict):
-                                                         domain=item.get('domain','?'); enabled_str=" " if item.get('enabled',1)==1 else "(D)"; comment=f" # {item.get('comment','')}" if item.get('comment') else ""
-                                                         st.code(f"{domain}{enabled_str}{comment}", language=None) # Use code for monospace list
-                                                     elif isinstance(item, str): st.code(f"{item}", language=None)
-                                                     else: st.code(f"{str(item)}", language=None)
-                                     else: st.error(f"❌ View Error: {resp.get('error', 'Failed')}")
-
-
-        # =========================
-        # Security Audit Tab
-        # =========================
-        with tab_security:
-            st.subheader("Simulated Quantum Security Audit")
-            st.caption("Performs classical checks, reported with quantum-inspired framing.")
-            st.warning("🚨 **Disclaimer:** This is a **simulation**. It does **not** involve actual quantum computation or guarantee security against quantum attacks. Use professional tools for real security audits.")
-
-            audit_placeholder = st.container() # Use container for report display
-
-            if st.button("🔬 Run Simulated Audit Now", key="security_audit_button_tab"):
-                 if 'audit_report' in st.session_state: del st.session_state['audit_report'] # Clear old report
-                 with audit_placeholder: # Show spinner inside container
-                     with st.spinner("Performing simulated audit checks..."):
-                         audit_report_md = simulate_quantum_security_audit()
-                         st.session_state.audit_report = audit_report_md
-                         speak_text("Simulated Security Audit complete.")
-                 st.rerun() # Rerun to display the report below
-
-            # Display the stored report if it exists
-            if 'audit_report' in st.session_state and st.session_state.audit_report:
-                 with audit_placeholder: # Display report inside the container
-                     st.markdown("---")
-                     st.markdown("#### Audit Report:")
-                     st.markdown(st.session_state.audit_report, unsafe_allow_html=True)
+             start_initial_network_scan()
 
+        # Navigation: only the selected section's code runs on a rerun (unlike st.tabs, which runs every tab body).
+        # The selection and each section's state live in st.session_state.
+        section_label = st.radio("Section", list(APP_SECTIONS), key="active_section", horizontal=True, label_visibility="collapsed")
+        st.markdown("<hr style='margin: 0.3rem 0 1rem 0;'>", unsafe_allow_html=True)
+        APP_SECTIONS[section_label]()
 
 
 
 # --- Main Execution Guard ---
 if __name__ == "__main__":
     # Optional: Clear specific state keys at start for testing during dev
-    # keys_to_clear = ['main_chat_input_value', 'audit_report', 'prev_net_stats', 'dedicated_speed_results']
+    # keys_to_clear = ['main_chat_input_value', 'audit_report', 'prev_net_stats', 'speedtest_job_id']
     # for key in keys_to_clear:
     #      if key in st.session_state: del st.session_state[key]
 